@@ -1,94 +1,168 @@
 """
 
-This Python script benchmarks the performance of running queries using duckdb as engine and 
-an object storage as data source. 
+This Python script benchmarks the performance of running queries using duckdb as engine and
+an object storage as data source.
 
-The script is minimal and not very configurable, but should be enough to give you a 
-feeling of how the different setups perform and the trade-offs involved.
+The workload is declared in a json file (benchmark_workload.json by default): the queries
+(templates with the dataset scan and the date range as placeholders), the day ranges, the
+execution modes (map_reduce, serverless, local), the fan-out levels for map reduce and the
+backends (see executors.py - null means the one configured through QUACK_EXECUTOR).
 
-Please note we basically start with 2019-04-01 and based on the -d flag we add days to the date.
-So by increasing -d you will increase the amount of data to be processed. The map reduce version
-manually unpacks the queries into queries-by-date and then runs them in parallel.
+Please note we basically start with 2019-04-01 and add days to the date, so by increasing the
+days you will increase the amount of data to be processed. The map reduce version uses the
+planner in planner.py to split the query by date partition and then runs the parts in parallel.
 
-Due to cold start, the first run of the serverless version may be slower than the others, so you should
-re-run the same script multiple times to get a better idea of the performance.
+Cold and warm runs are measured separately: a run is cold when the lambda (or at least one
+map task) reports warm=False. After the cold runs, `warmup` runs are discarded and then
+`repetitions` runs are measured; we report p50 / p95 / p99 and the throughput (queries per
+second), write everything as json with -o, and compare with a previous output with --baseline,
+flagging (and failing on) regressions. The results of every mode are checked against each other.
+
+With --layouts, the benchmark compares data layouts instead (benchmark_layouts.json): the
+dataset is partitioned once per layout (sorted, Z-ordered, bucketed... see ingest.py) and
+uploaded under s3://bucket/layouts/<name>/, then selective queries run on each copy. Besides
+the latency, we report the bytes each query has to read, estimated from the parquet footers:
+the chunks of the columns it uses, in the row groups duckdb cannot skip with their statistics.
 
 """
 
 import os
+import re
+import math
 import duckdb
 import json
+import datetime
 import statistics
 import time
-from fastcore.parallel import parallel
-from quack import invoke_lambda, display_table
+from quack import invoke_lambda, display_table, fetch_map_reduce, get_executor, set_executor, get_s3_client
+from executors import executor_from_env
+from ingest import partition_dataset, upload_directory, describe_uploaded_files
+from local_storage import localize_paths
+from manifest import partition_values, describe_parquet_file, file_may_match, to_json_value, stats_type, build_manifest, write_manifest
+from queryparse import split_clauses, extract_predicates
 from dotenv import load_dotenv
-from collections import defaultdict
 from rich.console import Console
 
 
 # get the environment variables from the .env file
 load_dotenv()
+# with the local-data executor, the "local" version reads the same local folder
+LOCAL_DATA_ROOT = os.environ.get('QUACK_LOCAL_DATA_ROOT') if os.environ.get('QUACK_EXECUTOR') == 'local-data' else None
+DEFAULT_WORKLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_workload.json')
+DEFAULT_LAYOUT_WORKLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_layouts.json')
+LAYOUTS_PREFIX = 'layouts'
+FIRST_DAY = datetime.date(2019, 4, 1)
+MODES = ('map_reduce', 'serverless', 'local')
+# a case regresses if its warm p50 (or p95) is slower than the baseline by more than this
+DEFAULT_TOLERANCE = 0.2
 
 
-def run_benchmarks(
-    bucket: str,
-    repetitions: int,
-    threads: int,
-    days: int,
-    is_debug: bool = False
-):
-    test_location_id = 237
-    execution_times = []
+def load_workload(path: str, overrides: dict = None) -> dict:
+    with open(path) as f:
+        workload = json.load(f)
+    workload.update({ k: v for k, v in (overrides or {}).items() if v is not None })
+    for mode in workload['modes']:
+        assert mode in MODES, f"Unknown mode {mode}, use one of {MODES}"
+
+    return workload
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Percentile with linear interpolation between the closest ranks.
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100.0
+    low, high = math.floor(rank), math.ceil(rank)
+
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(times: list) -> dict:
+    """
+    Summary statistics of a list of run times in seconds (None if there are no runs).
+    """
+    if not times:
+        return None
+
+    return {
+        'n': len(times),
+        'mean': round(statistics.mean(times), 3),
+        # stdev needs at least two runs
+        'std': round(statistics.stdev(times), 3) if len(times) > 1 else 0.0,
+        'p50': round(percentile(times, 50), 3),
+        'p95': round(percentile(times, 95), 3),
+        'p99': round(percentile(times, 99), 3),
+        'qps': round(len(times) / sum(times), 3) if sum(times) > 0 else None
+    }
+
+
+def build_query(template: str, bucket: str, days: int, local: bool = False) -> str:
     # NOTE: as usual we re-use the same naming convention as in the setup script
     # and all the others
-    partitioned_dataset_scan = f"s3://{bucket}/partitioned/*/*.parquet"
-    # run the map reduce version
-    repetition_times = []
-    print("\n====> Running map reduce version")
-    for i in range(repetitions):
-        start_time = time.time()
-        map_reduce_results = run_map_reduce(
-            bucket=bucket,
-            days=days,
-            threads=threads,
-            is_debug=is_debug
-        )
-        repetition_times.append(time.time() - start_time)
-        time.sleep(3)
-    
-    execution_times.append({
-        'type': 'map_reduce',
-        'mean': round(sum(repetition_times) / len(repetition_times), 3),
-        'std': round(statistics.stdev(repetition_times), 3),
-        'test location': map_reduce_results[test_location_id]
-    })
-    # run the standard serverless version
-    repetition_times = []
-    print("\n====> Running serverless duckdb")
-    for i in range(repetitions):
+    scan = f"s3://{bucket}/partitioned/*/*.parquet"
+    if local and LOCAL_DATA_ROOT:
+        scan = localize_paths(scan, LOCAL_DATA_ROOT)
+
+    return template.format(
+        scan=scan,
+        start=FIRST_DAY.isoformat(),
+        end=(FIRST_DAY + datetime.timedelta(days=days)).isoformat()
+    )
+
+
+def run_once(mode: str, query: dict, bucket: str, days: int, threads: int, workload: dict, con=None) -> tuple:
+    """
+    Run a query once in the given mode: return the results (key -> other columns)
+    and whether the run was cold.
+    """
+    if mode == 'map_reduce':
+        return run_map_reduce(query, bucket, days, threads, workload)
+    if mode == 'serverless':
+        return run_serverless_lambda(query, bucket, days, workload)
+
+    return run_local_db(con, query, bucket, days, workload)
+
+
+def run_case(mode: str, query: dict, bucket: str, days: int, threads: int, workload: dict, is_debug: bool) -> dict:
+    """
+    Run the cold runs, the warm-up and the measured runs of one case.
+    """
+    con = None
+    cold_times, warm_times, results = [], [], None
+    # cold runs: a fresh connection for local duckdb, a reset for the local executors,
+    # on lambda we take what we get (the lambda tells us if it was cold)
+    for i in range(workload.get('cold_runs', 1)):
+        if mode == 'local':
+            con = local_connection()
+        elif hasattr(get_executor(), 'reset'):
+            get_executor().reset()
         start_time = time.time()
-        results = run_serverless_lambda(
-            partitioned_dataset_scan=partitioned_dataset_scan,
-            days=days,
-            is_debug=is_debug
-        )
-        repetition_times.append(time.time() - start_time)
-        time.sleep(3)
-
-    execution_times.append({
-        'type': 'serverless',
-        'mean': round(sum(repetition_times) / len(repetition_times), 3),
-        'std': round(statistics.stdev(repetition_times), 3),
-        'test location': results[test_location_id]
-    })
-    # run a local db querying the data lake
-    repetition_times = []
-    print("\n====> Running local duckdb")
-    for i in range(repetitions):
+        results, is_cold = run_once(mode, query, bucket, days, threads, workload, con)
+        (cold_times if is_cold or mode == 'local' else warm_times).append(time.time() - start_time)
+    con = local_connection() if mode == 'local' and con is None else con
+    # warm-up runs are not measured
+    for i in range(workload.get('warmup', 0)):
+        run_once(mode, query, bucket, days, threads, workload, con)
+    for i in range(workload['repetitions']):
         start_time = time.time()
-        # just re-use the code inside the lambda without thinking too much ;-)
-        con = duckdb.connect(database=':memory:')
+        results, is_cold = run_once(mode, query, bucket, days, threads, workload, con)
+        (cold_times if is_cold else warm_times).append(time.time() - start_time)
+        time.sleep(workload.get('pause_seconds', 0))
+    if is_debug:
+        print(f"{mode} {query['name']} days={days}: cold {cold_times}, warm {warm_times}")
+
+    return {
+        'cold': summarize(cold_times),
+        'warm': summarize(warm_times),
+        'results': results
+    }
+
+
+def local_connection():
+    # just re-use the code inside the lambda without thinking too much ;-)
+    con = duckdb.connect(database=':memory:')
+    if not LOCAL_DATA_ROOT:
         con.execute(f"""
             INSTALL httpfs;
             LOAD httpfs;
@@ -96,184 +170,414 @@ def run_benchmarks(
             SET s3_access_key_id='{os.environ['AWS_ACCESS_KEY_ID']}';
             SET s3_secret_access_key='{os.environ['AWS_SECRET_ACCESS_KEY']}';
         """)
-        local_results = run_local_db(
-            con=con,
-            partitioned_dataset_scan=partitioned_dataset_scan,
-            days=days,
-            is_debug=is_debug
-        )
-        del con
-        repetition_times.append(time.time() - start_time)
-        time.sleep(3)
-    
-    execution_times.append({
-        'type': 'local',
-        'mean': round(sum(repetition_times) / len(repetition_times), 3),
-        'std': round(statistics.stdev(repetition_times), 3),
-        'test location': local_results[test_location_id]
-    })
-    # make sure the results are the same
-    assert results[test_location_id] == map_reduce_results[test_location_id] == local_results[test_location_id], "The results are not the same!"
-
-    # display results in a table
+
+    return con
+
+
+def same_results(a: dict, b: dict) -> bool:
+    """
+    Same keys and same values, up to float rounding (partial sums are added in a
+    different order by the different modes).
+    """
+    if a.keys() != b.keys():
+        return False
+    for key, row in a.items():
+        for x, y in zip(row, b[key]):
+            if isinstance(x, float) or isinstance(y, float):
+                if not math.isclose(x, y, rel_tol=1e-9, abs_tol=1e-9):
+                    return False
+            elif x != y:
+                return False
+
+    return True
+
+
+def run_benchmarks(
+    bucket: str,
+    workload: dict,
+    is_debug: bool = False
+) -> dict:
+    cases = []
+    for backend in workload.get('backends', [None]):
+        if backend or len(workload.get('backends', [None])) > 1:
+            set_executor(executor_from_env(backend))
+        backend_name = get_executor().name
+        for query in workload['queries']:
+            for days in query['days']:
+                reference = None
+                for mode in workload['modes']:
+                    # fan-out levels only make sense for map reduce
+                    for threads in (workload['threads'] if mode == 'map_reduce' else [None]):
+                        print(f"\n====> Running {query['name']} over {days} days, {mode} on {backend_name}" + (f" ({threads} threads)" if threads else ""))
+                        case = run_case(mode, query, bucket, days, threads, workload, is_debug)
+                        # make sure the results are the same across modes
+                        if reference is None:
+                            reference = case['results']
+                        assert same_results(reference, case['results']), f"The results of {mode} are not the same!"
+                        cases.append({
+                            'query': query['name'],
+                            'days': days,
+                            'mode': mode,
+                            'backend': backend_name if mode != 'local' else 'local-duckdb',
+                            'threads': threads,
+                            'cold': case['cold'],
+                            'warm': case['warm']
+                        })
+
+    return {
+        'createdAt': datetime.datetime.utcnow().isoformat(),
+        'workload': workload,
+        'cases': cases
+    }
+
+
+def case_key(case: dict) -> tuple:
+    return (case['query'], case['days'], case['mode'], case['backend'], case['threads'])
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return the regressions: cases whose warm p50 or p95 got slower than the baseline
+    by more than the tolerance (e.g. 0.2 is 20%).
+    """
+    baseline_cases = { case_key(c): c for c in baseline['cases'] }
+    regressions = []
+    for case in report['cases']:
+        old = baseline_cases.get(case_key(case))
+        if not old or not old['warm'] or not case['warm']:
+            continue
+        for stat in ('p50', 'p95'):
+            if case['warm'][stat] > old['warm'][stat] * (1 + tolerance):
+                regressions.append({
+                    'case': ' '.join(str(k) for k in case_key(case) if k is not None),
+                    'stat': stat,
+                    'baseline': old['warm'][stat],
+                    'current': case['warm'][stat]
+                })
+
+    return regressions
+
+
+def display_report(report: dict, regressions: list):
     console = Console()
-    display_table(console, execution_times, title="Benchmarks", color="cyan")
+    rows = []
+    for case in report['cases']:
+        cold, warm = case['cold'] or {}, case['warm'] or {}
+        rows.append({
+            'query': case['query'],
+            'days': case['days'],
+            'type': case['mode'] + (f" (t={case['threads']})" if case['threads'] else ''),
+            'backend': case['backend'],
+            'runs (cold/warm)': f"{cold.get('n', 0)}/{warm.get('n', 0)}",
+            'cold p50': cold.get('p50', '-'),
+            'warm p50': warm.get('p50', '-'),
+            'warm p95': warm.get('p95', '-'),
+            'warm p99': warm.get('p99', '-'),
+            'qps': warm.get('qps', '-')
+        })
+    display_table(console, rows, title="Benchmarks", color="cyan")
+    if regressions:
+        display_table(console, regressions, title="Regressions", color="red")
 
-    # all done, say goodbye
-    print("All done! See you, duck cowboy!")
-    return     
+    return
 
 
 def run_local_db(
     con,
-    partitioned_dataset_scan: str,
+    query: dict,
+    bucket: str,
     days: int,
-    is_debug: bool
+    workload: dict
 ):
-    single_query = """
-        SELECT 
-            pickup_location_id AS location_id, 
-            COUNT(*) AS counts 
-        FROM 
-            parquet_scan('{}', HIVE_PARTITIONING=1)
-        WHERE 
-            DATE >= '2019-04-01' AND DATE < '2019-04-{}'
-        GROUP BY 1
-    """.format(
-        partitioned_dataset_scan,
-        "{:02d}".format(1 + days)
-    )
-    if is_debug:
-        print(single_query)
+    single_query = build_query(query['sql'], bucket, days, local=True)
     # just re-use the code inside the lambda with no particular changes
     _df = con.execute(single_query).df()
-    _df = _df.head(1000)
-    records = _df.to_dict('records')
+    _df = _df.head(workload['limit'])
 
-    return { row['location_id']: row['counts'] for row in records }
+    return to_results(_df.to_dict('records'), query['key']), False
 
 
 def run_serverless_lambda(
-    partitioned_dataset_scan: str,
+    query: dict,
+    bucket: str,
     days: int,
-    is_debug: bool
+    workload: dict
 ):
-    single_query = """
-        SELECT 
-            pickup_location_id AS location_id, 
-            COUNT(*) AS counts 
-        FROM 
-            parquet_scan('{}', HIVE_PARTITIONING=1)
-        WHERE 
-            DATE >= '2019-04-01' AND DATE < '2019-04-{}'
-        GROUP BY 1
-    """.format(
-        partitioned_dataset_scan,
-        "{:02d}".format(1 + days)
-    )
-    if is_debug:
-        print(single_query)
-    response = invoke_lambda(json.dumps({ 'q': single_query, 'limit': 1000}))
+    single_query = build_query(query['sql'], bucket, days)
+    # we measure the engine, not the result cache of the lambda
+    response = invoke_lambda(json.dumps({ 'q': single_query, 'limit': workload['limit'], 'cache': False }))
     if 'errorMessage' in response:
         print(response['errorMessage'])
         raise Exception("There was an error in the serverless invocation")
     records = response['data']['records']
 
-    return { row['location_id']: row['counts'] for row in records }
+    return to_results(records, query['key']), not response['metadata']['warm']
 
 
 def run_map_reduce(
+    query: dict,
     bucket: str,
     days: int,
     threads: int,
-    is_debug: bool
+    workload: dict
 ):
-    query = """
-        SELECT 
-            pickup_location_id AS location_id, 
-            COUNT(*) AS counts 
-        FROM 
-            read_parquet('{}', HIVE_PARTITIONING=1)
-        WHERE 
-            DATE >= '2019-04-{}' AND DATE < '2019-04-{}'
-        GROUP BY 1
-    """.strip()
-    # prepare the queries for the map step
-    queries = prepare_map_queries(query, bucket, days)
-    if is_debug:
-        print(queries[:3])
-    assert len(queries) == days, "The number of queries is not correct"
-    # run the queries in parallel
-    payloads = [json.dumps({'q': q, 'limit': 1000 }) for q in queries]
-    _results = parallel(
-            invoke_lambda, 
-            payloads,
-            n_workers=threads)
-    # check for errors in ANY response
-    if any(['errorMessage' in response for response in _results]):
-        print(next(response['errorMessage'] for response in _results if 'errorMessage' in response))
-        raise Exception("There was an error in the parallel invocation")
-    # do the "reduce" step in code
-    results = defaultdict(lambda: 0)
-    # loop over the results
-    for response in _results:
-        records = response['data']['records']
-        for row in records:
-            results[row['location_id']] += row['counts']
-        
-    return results
-
-
-def prepare_map_queries(
-        query: str,
-        bucket: str,
-        days: int
-        ):
-    # template for parquet scan
-    queries = []
-    for i in range(1, days + 1):
-        start_day_as_str = "{:02d}".format(i)
-        end_day_as_str = "{:02d}".format(i + 1)
-        parquet_scan = f"s3://{bucket}/partitioned/date=2019-04-{start_day_as_str}/*.parquet"
-        queries.append(query.format(parquet_scan, start_day_as_str, end_day_as_str))
-    
-    return queries
+    # same query as the other versions: the planner takes care of splitting
+    # it by partition and of combining the partial states back
+    _df, metadata = fetch_map_reduce(
+        build_query(query['sql'], bucket, days),
+        limit=workload['limit'],
+        threads=threads,
+        use_cache=False
+    )
+    assert metadata.get('mapTasks') == days, "The number of map queries is not correct"
+
+    return to_results(_df.to_dict('records'), query['key']), metadata['warmTasks'] < metadata['mapTasks']
+
+
+def to_results(records: list, key: str) -> dict:
+    return { row[key]: tuple(v for k, v in sorted(row.items()) if k != key) for row in records }
+
+
+def estimate_scan_bytes(files: list, sql: str) -> dict:
+    """
+    Bytes the query has to read from the (local copies of the) files: the column chunks of
+    the columns it uses, in the files the manifest keeps (partitions, buckets) and in the row
+    groups whose statistics may match its predicates, as duckdb skips the others.
+    Deterministic, and the same for every backend.
+    """
+    import pyarrow.parquet as pq
+
+    clauses = split_clauses(sql.strip()) or {}
+    predicates = extract_predicates(clauses.get('WHERE'))
+    total_bytes, read_bytes, total_groups, read_groups = 0, 0, 0, 0
+    for path in files:
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.metadata
+        entry = {
+            'partition': partition_values(path.replace(os.sep, '/')),
+            **{ k: v for k, v in describe_parquet_file(parquet_file).items() if k == 'bucket' }
+        }
+        file_matches = file_may_match(entry, predicates)
+        names = [metadata.schema.column(c).name for c in range(metadata.num_columns)]
+        # duckdb only reads the columns the query mentions
+        used = [c for c, name in enumerate(names) if re.search(rf"\b{name}\b", sql, re.IGNORECASE)]
+        for rg in range(metadata.num_row_groups):
+            row_group = metadata.row_group(rg)
+            size = sum(row_group.column(c).total_compressed_size for c in used)
+            stats = {}
+            for c in range(row_group.num_columns):
+                statistics = row_group.column(c).statistics
+                if statistics is not None and statistics.has_min_max:
+                    _min, _max = to_json_value(statistics.min), to_json_value(statistics.max)
+                    if _min is not None and _max is not None:
+                        stats[names[c]] = { 'min': _min, 'max': _max, 'type': stats_type(statistics.min) }
+            total_bytes += size
+            total_groups += 1
+            if file_matches and file_may_match({ 'partition': {}, 'stats': stats }, predicates):
+                read_bytes += size
+                read_groups += 1
+
+    return {
+        'bytesRead': read_bytes,
+        'bytesTotal': total_bytes,
+        'readShare': round(read_bytes / total_bytes, 4) if total_bytes else 0.0,
+        'rowGroupsRead': read_groups,
+        'rowGroups': total_groups
+    }
+
+
+def write_layout(bucket: str, layout: dict, workload: dict) -> tuple:
+    """
+    Partition the source with the layout, and upload it (with its manifest) under
+    layouts/<name>: return the local files and the glob to query.
+    """
+    local_dir = os.path.join(workload['local_dir'], layout['name'])
+    options = { k: v for k, v in layout.items() if k != 'name' }
+    print(f"\n====> Writing the {layout['name']} layout {options}")
+    files = partition_dataset(workload['source'], local_dir, **options)
+    prefix = f"{LAYOUTS_PREFIX}/{layout['name']}"
+    s3_client = get_s3_client()
+    uploaded = upload_directory(s3_client, local_dir, bucket, prefix)
+    write_manifest(s3_client, build_manifest(f"s3://{bucket}/{prefix}", describe_uploaded_files(uploaded)))
+
+    return files, f"s3://{bucket}/{prefix}/*/*.parquet"
+
+
+def run_layout_query(mode: str, sql: str, workload: dict, con=None) -> dict:
+    if mode == 'local':
+        return con.execute(sql).df().head(workload['limit']).to_dict('records')
+    # we measure the layout on S3: no result cache, no local copies of the files
+    response = invoke_lambda(json.dumps({
+        'q': sql,
+        'limit': workload['limit'],
+        'manifest': workload.get('manifest', False),
+        'cache': False,
+        'file_cache': False
+    }))
+    if 'errorMessage' in response:
+        print(response['errorMessage'])
+        raise Exception("There was an error in the serverless invocation")
+
+    return response['data']['records']
+
+
+def run_layout_benchmarks(bucket: str, workload: dict, is_debug: bool = False) -> dict:
+    cases = []
+    references = {}
+    for layout in workload['layouts']:
+        files, scan = write_layout(bucket, layout, workload)
+        local_scan = os.path.join(workload['local_dir'], layout['name'], '*', '*.parquet')
+        for query in workload['queries']:
+            scan_estimate = estimate_scan_bytes(files, query['sql'])
+            for mode in workload['modes']:
+                sql = query['sql'].format(scan=local_scan if mode == 'local' else scan)
+                # the local copy is on this disk: no httpfs needed
+                con = duckdb.connect(database=':memory:') if mode == 'local' else None
+                for i in range(workload.get('warmup', 0)):
+                    run_layout_query(mode, sql, workload, con)
+                times = []
+                for i in range(workload['repetitions']):
+                    start_time = time.time()
+                    records = run_layout_query(mode, sql, workload, con)
+                    times.append(time.time() - start_time)
+                results = to_results(records, query['key'])
+                # the layout changes how fast we get the results, not the results
+                reference = references.setdefault(query['name'], results)
+                assert same_results(reference, results), f"The results of {query['name']} on {layout['name']} are not the same!"
+                if is_debug:
+                    print(f"{layout['name']} {query['name']} {mode}: {times}")
+                cases.append({
+                    'layout': layout['name'],
+                    'query': query['name'],
+                    'mode': mode,
+                    **scan_estimate,
+                    'warm': summarize(times)
+                })
+
+    return {
+        'createdAt': datetime.datetime.utcnow().isoformat(),
+        'workload': workload,
+        'cases': cases
+    }
+
+
+def display_layout_report(report: dict):
+    rows = [
+        {
+            'query': case['query'],
+            'layout': case['layout'],
+            'type': case['mode'],
+            'row groups read': f"{case['rowGroupsRead']}/{case['rowGroups']}",
+            'MB read': round(case['bytesRead'] / (1024 * 1024), 2),
+            'read share': case['readShare'],
+            'p50': case['warm']['p50'],
+            'p95': case['warm']['p95']
+        }
+        for case in sorted(report['cases'], key=lambda c: (c['query'], c['mode']))
+    ]
+    display_table(Console(), rows, title="Layouts", color="cyan")
+
+    return
+
 
 if __name__ == "__main__":
     # make sure the envs are set
     assert 'S3_BUCKET_NAME' in os.environ, "Please set the S3_BUCKET_NAME environment variable"
-    assert 'AWS_ACCESS_KEY_ID' in os.environ, "Please set the AWS_ACCESS_KEY_ID environment variable"
-    assert 'AWS_SECRET_ACCESS_KEY' in os.environ, "Please set the AWS_SECRET_ACCESS_KEY environment variable"
+    if not LOCAL_DATA_ROOT:
+        assert 'AWS_ACCESS_KEY_ID' in os.environ, "Please set the AWS_ACCESS_KEY_ID environment variable"
+        assert 'AWS_SECRET_ACCESS_KEY' in os.environ, "Please set the AWS_SECRET_ACCESS_KEY environment variable"
     # get args from command line
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-w",
+        type=str,
+        help="workload file",
+        default=DEFAULT_WORKLOAD)
     parser.add_argument(
         "-n",
         type=int,
-        help="number of repetitions", 
-        default=3)
-    # note: without reserved concurrency, too much concurrency will cause errors
+        help="number of measured repetitions (overrides the workload)",
+        default=None)
+    parser.add_argument(
+        "-warmup",
+        type=int,
+        help="number of warm-up runs, not measured (overrides the workload)",
+        default=None)
+    # note: without reserved concurrency, too much concurrency will cause throttling
+    # (throttled map tasks are retried with backoff, but the benchmark will be slower)
     parser.add_argument(
         "-t",
         type=int,
-        help="concurrent queries for map reduce", 
-        default=20)
+        nargs='+',
+        help="concurrent queries for map reduce (overrides the workload)",
+        default=None)
     parser.add_argument(
         "-d",
         type=int,
-        help="number of days in April to query", 
-        default=10)
+        nargs='+',
+        help="number of days in April to query (overrides the workload)",
+        default=None)
+    parser.add_argument(
+        "-o",
+        type=str,
+        help="write the results as json to this file",
+        default=None)
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="json output of a previous run to compare with",
+        default=None)
     parser.add_argument(
-        "--debug", 
+        "--tolerance",
+        type=float,
+        help="slowdown over the baseline flagged as regression (0.2 is 20%%)",
+        default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--layouts",
+        type=str,
+        nargs='?',
+        const=DEFAULT_LAYOUT_WORKLOAD,
+        help="compare data layouts for selective queries, with this workload file",
+        default=None)
+    parser.add_argument(
+        "--debug",
         action="store_true",
         help="increase output verbosity",
         default=False)
     args = parser.parse_args()
+    if args.layouts:
+        with open(args.layouts) as f:
+            workload = json.load(f)
+        workload.update({ k: v for k, v in { 'repetitions': args.n, 'warmup': args.warmup }.items() if v is not None })
+        report = run_layout_benchmarks(os.environ['S3_BUCKET_NAME'], workload, is_debug=args.debug)
+        display_layout_report(report)
+        if args.o:
+            with open(args.o, 'w') as f:
+                json.dump(report, f, indent=2)
+        print("All done! See you, duck cowboy!")
+        exit(0)
+    workload = load_workload(args.w, { 'repetitions': args.n, 'warmup': args.warmup, 'threads': args.t })
+    if args.d:
+        for query in workload['queries']:
+            query['days'] = args.d
     # run the main function
-    run_benchmarks(
+    report = run_benchmarks(
         bucket=os.environ['S3_BUCKET_NAME'],
-        repetitions=args.n,
-        threads=args.t,
-        days=args.d,
+        workload=workload,
         is_debug=args.debug
-    )
\ No newline at end of file
+    )
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+    display_report(report, regressions)
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(report, f, indent=2)
+    # all done, say goodbye
+    if regressions:
+        print(f"{len(regressions)} regressions over the baseline!")
+        exit(1)
+    print("All done! See you, duck cowboy!")
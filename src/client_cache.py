@@ -0,0 +1,143 @@
+"""
+
+Client-side query cache for quack.fetch_all (e.g. for the dashboard, which re-runs the same
+queries at every Streamlit rerun, for every user).
+
+* entries live for a TTL, and the least recently used ones are evicted past max_entries;
+* keys are built as in the lambda result cache (serverless/result_cache.py): normalized SQL,
+  the parameters shaping the response and the version (ETag) of the S3 objects the query
+  reads, so that a re-materialized file is a miss even before the TTL expires;
+* identical queries in flight are coalesced: the first caller invokes the lambda, the
+  others wait for its result, so N sessions asking the same thing make one invocation.
+
+The cache is a module-level object in quack.py, so it is shared by all the threads (i.e. the
+Streamlit sessions) of the process. AsyncQueryCache is the same cache for asyncio code (the
+query gateway, see gateway.py), shared by all the clients of the gateway.
+
+"""
+
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+DEFAULT_MAX_ENTRIES = 256
+
+
+class QueryCache:
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires at, value)
+        self._in_flight = {} # key -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_run(self, key: str, ttl: float, run, should_cache=None) -> tuple:
+        """
+        Return (value, status): the cached value ('hit'), the value of an identical call
+        already in flight ('coalesced'), or the value of run() ('miss'), cached for ttl seconds.
+        Errors are not cached, but are shared with the coalesced callers; neither are values
+        for which should_cache(value) is False (e.g. a batch with a failed query).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], 'hit'
+            if entry is not None:
+                del self._entries[key]
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not is_owner:
+            return future.result(), 'coalesced'
+        try:
+            value = run()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if should_cache is None or should_cache(value):
+                self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            del self._in_flight[key]
+        future.set_result(value)
+
+        return value, 'miss'
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        return
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                # coalesced calls did not invoke the lambda either
+                'hitRatio': round((self.hits + self.coalesced) / requests, 3) if requests else 0.0
+            }
+
+
+class AsyncQueryCache(QueryCache):
+    """
+    QueryCache for a single event loop: run is a coroutine function, and callers coalesced on
+    an identical call in flight wait for it without blocking the loop.
+    """
+
+    async def get_or_run(self, key: str, ttl: float, run, should_cache=None) -> tuple:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], 'hit'
+        if entry is not None:
+            del self._entries[key]
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield: a waiter giving up must not cancel the call for the others
+            return await asyncio.shield(future), 'coalesced'
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.misses += 1
+        try:
+            value = await run()
+        except asyncio.CancelledError:
+            del self._in_flight[key]
+            future.cancel()
+            raise
+        except Exception as e:
+            del self._in_flight[key]
+            future.set_exception(e)
+            # nobody may be waiting: don't let asyncio complain about an unretrieved exception
+            future.exception()
+            raise
+        if should_cache is None or should_cache(value):
+            self._entries[key] = (time.time() + ttl, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        del self._in_flight[key]
+        future.set_result(value)
+
+        return value, 'miss'
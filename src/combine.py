@@ -0,0 +1,82 @@
+"""
+
+Incremental, vectorized combine step for map-reduce queries (see planner.py).
+
+Partial results are arrow tables: instead of waiting for every map task and concatenating
+all of them, the Combiner takes them as they arrive and, once enough rows are buffered,
+compacts them with the merge query of the plan (partial states in, partial states out) in
+a local duckdb. Memory is then bounded by the number of groups, not by the number of tasks,
+and most of the merging overlaps with the tasks still running. The final values, ORDER BY
+and LIMIT included, come from the combine query over the compacted state.
+
+"""
+
+
+import duckdb
+import pyarrow as pa
+from planner import build_merge_query, PARTIALS_TABLE
+
+
+# compact the buffered partial results when they go over this many rows
+DEFAULT_COMPACT_ROWS = 1000000
+
+
+class Combiner:
+
+    def __init__(self, plan: dict, compact_rows: int = DEFAULT_COMPACT_ROWS):
+        self.plan = plan
+        self.compact_rows = compact_rows
+        self.merge_query = build_merge_query(plan['parsed'], PARTIALS_TABLE)
+        self.con = duckdb.connect(database=':memory:')
+        self._state = None # compacted partial states, one row per group
+        self._pending = [] # tables added since the last compaction
+        self._pending_rows = 0
+        self.tables = 0
+        self.rows = 0
+        self.compactions = 0
+
+    def add(self, table: pa.Table):
+        """
+        Add the partial results of a task: cheap, unless it triggers a compaction.
+        """
+        self._pending.append(table)
+        self._pending_rows += table.num_rows
+        self.tables += 1
+        self.rows += table.num_rows
+        if self._pending_rows >= self.compact_rows:
+            self.compact()
+
+        return
+
+    def _partials(self) -> pa.Table:
+        tables = ([self._state] if self._state is not None else []) + self._pending
+
+        return pa.concat_tables(tables, promote=True)
+
+    def compact(self):
+        """
+        Merge the state and the pending tables into a new state, in one columnar pass.
+        """
+        if not self._pending:
+            return
+        self.con.register(PARTIALS_TABLE, self._partials())
+        self._state = self.con.execute(self.merge_query).arrow()
+        self.con.unregister(PARTIALS_TABLE)
+        self._pending = []
+        self._pending_rows = 0
+        self.compactions += 1
+
+        return
+
+    def result(self, limit: int = None):
+        """
+        Run the combine query over everything received so far, and return a DataFrame.
+        """
+        if self._state is None and not self._pending:
+            raise ValueError("No partial results to combine")
+        # no need to compact first: the combine query merges partial states anyway
+        self.con.register(PARTIALS_TABLE, self._partials())
+        df = self.con.execute(self.plan['combine_query']).df()
+        self.con.unregister(PARTIALS_TABLE)
+
+        return df.head(limit) if limit is not None else df
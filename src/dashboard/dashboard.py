@@ -8,6 +8,7 @@ It re-uses through hugly imports the code from the quack.py script, and use seab
 
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
@@ -22,10 +23,19 @@ S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
 # note: this is the same file we exported in the top_pickup_locations.sql query
 # as part of our data transformation pipeline
 PARQUET_FILE = f"s3://{S3_BUCKET_NAME}/dashboard/my_view.parquet"
+# every rerun (and every user) asks the same queries: results are cached in quack for this
+# long, or until dbt re-materializes the file
+CACHE_TTL_SECONDS = 300
+# the raw trips, for the median trip distance
+TRIPS_FILE = f"s3://{S3_BUCKET_NAME}/dataset/taxi_2019_04.parquet"
+# while the exact median is computed, we show one from a sample of the trips (see
+# serverless/approximate.py): the row count comes from the parquet metadata, and the chart
+# reads the 200 rows of the view, so sampling them would only make them slower and wrong
+APPROXIMATE = { 'sample_percent': 10, 'confidence': 0.95 }
 
 # import querying functoin from the runner
 sys.path.insert(0,'..')
-from quack import fetch_all
+from quack import fetch_all, fetch_many
 # build up the dashboard
 st.markdown("# Trip Dashboard")
 st.write("This dashboard shows KPIs for our taxi business.")
@@ -33,12 +43,10 @@ st.header("Top pickup locations (map id) by number of trips")
 # hardcode the columns
 COLS = ['PICKUP_LOCATION_ID', 'TRIPS']
 
-# get the total row count
-query = f"SELECT COUNT(*) AS C FROM read_parquet(['{PARQUET_FILE}'])"
-df, metadata = fetch_all(query, limit=1, display=False, is_debug=False)
-st.write(f"Total row count: {df['C'][0]}")
-
-# get the interactive chart
+# the KPIs and the interactive chart are fetched in one invocation
+count_query = f"SELECT COUNT(*) AS C FROM read_parquet(['{PARQUET_FILE}'])"
+# the exact median has to sort the distance of every trip
+median_query = f"SELECT MEDIAN(trip_distance) AS M FROM read_parquet(['{TRIPS_FILE}'])"
 base_query = f"""
     SELECT 
         location_id AS {COLS[0]}, 
@@ -47,12 +55,70 @@ base_query = f"""
         read_parquet(['{PARQUET_FILE}'])
     """.strip()
 top_k = st.text_input('# of pickup locations', '5')
-# add a limit to the query based on the user input
-final_query = "{} LIMIT {};".format(base_query, top_k).format(top_k)
-df, metadata = fetch_all(final_query, limit=int(top_k), display=False, is_debug=False)
+# the user input is a parameter of the template, not a piece of SQL: the lambda prepares
+# the template once and binds top_k as an integer
+if not top_k.strip().isdigit() or int(top_k) < 1:
+    st.error(f"Please enter a positive number of locations, not '{top_k}'")
+    st.stop()
+
+
+def fetch_page():
+    return fetch_many(
+        [
+            { 'q': count_query, 'limit': 1 },
+            { 'q': median_query, 'limit': 1 },
+            {
+                'template': f"{base_query} LIMIT $1",
+                'template_id': 'top_pickup_locations',
+                'params': [int(top_k)],
+                'limit': int(top_k)
+            }
+        ],
+        display=False,
+        is_debug=False,
+        cache_ttl=CACHE_TTL_SECONDS
+    )
+
+
+def fetch_approximate_median():
+    """
+    The median from a sample of the raw trips, None if it failed: the exact one is on its way.
+    """
+    try:
+        median_df, _ = fetch_all(median_query, 1, approximate=APPROXIMATE, cache_ttl=CACHE_TTL_SECONDS, use_rollups=False)
+    except Exception as e:
+        print(f"Could not get the approximate median: {e}")
+        return None
+
+    return median_df
+
+
+def draw_count(count_df):
+    if count_df is not None:
+        count_slot.write(f"Total row count: {count_df['C'][0]}")
 
-# if no error is returned, we plot the data
-if df is not None:
+    return
+
+
+def draw_median(median_df, is_approximate: bool):
+    if median_df is None:
+        return
+    if is_approximate:
+        median_slot.write(
+            f"Median trip distance: ~{median_df['M'][0]:.2f} miles "
+            f"({APPROXIMATE['confidence']:.0%} interval {median_df['M_low'][0]:.2f} - {median_df['M_high'][0]:.2f}), refining..."
+        )
+    else:
+        median_slot.write(f"Median trip distance: {median_df['M'][0]:.2f} miles")
+
+    return
+
+
+def draw_chart(df):
+    # if no error is returned, we plot the data
+    if df is None:
+        chart_slot.write("Sorry, something went wrong :-(")
+        return
     fig = plt.figure(figsize=(10,5))
     sns.barplot(
         x = COLS[0],
@@ -61,12 +127,29 @@ if df is not None:
         order=df.sort_values(COLS[1],ascending = False)[COLS[0]])
     plt.xticks(rotation=70)
     plt.tight_layout()
-    st.pyplot(fig)
-else:
-    st.write("Sorry, something went wrong :-(")
+    chart_slot.pyplot(fig)
+
+    return
+
+
+# the median is drawn with the approximate answer first, then with the exact one
+count_slot = st.empty()
+median_slot = st.empty()
+chart_slot = st.empty()
+with ThreadPoolExecutor(max_workers=1) as executor:
+    # the exact page is computed in the background...
+    exact = executor.submit(fetch_page)
+    # ... unless it comes from the cache, we show an approximate median in the meantime
+    if not exact.done():
+        draw_median(fetch_approximate_median(), is_approximate=True)
+    (count_df, _), (median_df, _), (df, metadata) = exact.result()
+draw_count(count_df)
+draw_median(median_df, is_approximate=False)
+draw_chart(df)
 
 # display metadata
-st.write(f"Roundtrip ms: {metadata['roundtrip_time']}")
+batch = metadata['batch']
+st.write(f"Roundtrip ms (all queries): {batch['roundtrip_time']}")
 st.write(f"Query exec. time ms: {metadata['timeMs']}")
-st.write(f"Lambda is warm: {metadata['warm']}")
-        
+st.write(f"Lambda is warm: {batch['warm']}")
+st.write(f"Client cache: {batch['clientCache']} (hit ratio {batch['clientCacheHitRatio']:.0%}, {batch['clientCacheLatencyMs']} ms)")
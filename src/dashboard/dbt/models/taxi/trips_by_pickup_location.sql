@@ -1,3 +1,5 @@
+{{ config(materialized='external', location="s3://{{ env_var('S3_BUCKET_NAME') }}/rollups/trips_by_pickup_location.parquet") }}
+
 SELECT 
     pickup_location_id AS location_id, 
     COUNT(*) AS counts 
@@ -0,0 +1,315 @@
+"""
+
+Execution backends for the queries sent by quack.py: all of them take the same json payload
+the lambda receives, and return the same response.
+
+* LambdaExecutor invokes the real lambda function on AWS;
+* LocalExecutor runs serverless/app.handler in a pool of worker processes: each worker
+  keeps its own duckdb connection across calls, so the first call in a worker is "cold"
+  and the following ones are "warm", as in the lambda;
+* LocalDataExecutor is a LocalExecutor pointing s3 uris to a local folder (bucket names
+  are sub-folders of the data root) or to an S3-compatible stand-in like MinIO;
+* GatewayExecutor sends the payloads to the query gateway (gateway.py), which runs them on
+  one of the backends above for all its clients.
+
+The backend is picked by quack.get_executor from the QUACK_EXECUTOR environment variable
+(lambda, local, local-data or gateway), or can be set explicitly with quack.set_executor.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+import traceback
+import urllib.request
+import urllib.error
+import boto3
+from concurrent.futures import ProcessPoolExecutor
+from botocore.config import Config
+
+
+# if you did not change the serverless.yml file, the lambda should be called like this
+DEFAULT_FUNCTION_NAME = 'quack-reduce-lambda-dev-duckdb'
+# same memory as the lambda in serverless.yml
+DEFAULT_MEMORY_MB = 3008
+SERVERLESS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serverless')
+# where gateway.py listens by default
+DEFAULT_GATEWAY_URL = 'http://localhost:8765'
+# a full queue at the gateway (429) is retried, with full jitter exponential backoff, as
+# botocore retries the throttles of the lambda
+GATEWAY_MAX_ATTEMPTS = 8
+GATEWAY_BASE_DELAY_S = 0.2
+GATEWAY_MAX_DELAY_S = 10.0
+# the handler module, imported once per worker process
+_app = None
+
+
+class LambdaExecutor:
+
+    name = 'lambda'
+
+    def __init__(
+        self,
+        function_name: str = None,
+        max_pool_connections: int = 10,
+        max_attempts: int = None
+    ):
+        self.function_name = function_name or os.environ.get('QUACK_FUNCTION_NAME', DEFAULT_FUNCTION_NAME)
+        config = { 'max_pool_connections': max_pool_connections, 'read_timeout': 900 }
+        if max_attempts is not None:
+            config['retries'] = { 'max_attempts': max_attempts }
+        self.client = boto3.client('lambda', config=Config(**config))
+
+    def invoke(self, json_payload_as_str: str) -> dict:
+        response = self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=json_payload_as_str
+        )
+
+        return json.loads(response['Payload'].read().decode("utf-8"))
+
+    def with_concurrency(self, concurrency: int):
+        """
+        Return an executor whose connection pool can sustain `concurrency` calls in flight,
+        without botocore retries (callers retry per task, see quack.invoke_lambda_async).
+        """
+        return LambdaExecutor(self.function_name, max_pool_connections=concurrency, max_attempts=0)
+
+
+def _init_worker(env: dict, memory_mb: int, hard_memory_limit: bool):
+    """
+    Runs once in every worker process: set up the "lambda" environment and import the handler.
+    """
+    global _app
+    os.environ.update(env)
+    # each worker is a container of its own, with its own caches and spill folder in /tmp
+    for variable, folder in (('QUACK_CACHE_DIR', 'quack-results'), ('QUACK_FILE_CACHE_DIR', 'quack-files'), ('QUACK_SPILL_DIR', 'quack-spill')):
+        os.environ.setdefault(variable, f"/tmp/{folder}-{os.getpid()}")
+    if hard_memory_limit:
+        # as the lambda, die when going over the memory: note this caps virtual memory, which
+        # is (way) more than resident memory, so it's a loose approximation
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    sys.path.insert(0, SERVERLESS_FOLDER)
+    import app
+    _app = app
+
+
+def _run_handler(json_payload_as_str: str) -> dict:
+    """
+    Call the handler as the lambda runtime would: json in, json out, and errors
+    returned as errorMessage / errorType instead of raised.
+    """
+    try:
+        response = _app.handler(json.loads(json_payload_as_str), None)
+        return json.loads(json.dumps(response))
+    except Exception as e:
+        return {
+            'errorMessage': str(e),
+            'errorType': type(e).__name__,
+            'stackTrace': traceback.format_exc().splitlines()
+        }
+
+
+class LocalExecutor:
+    """
+    Run the handler in `workers` processes on this machine: each worker gets the memory
+    and threads of the lambda (3008 MB in serverless.yml) unless told otherwise.
+    """
+
+    name = 'local'
+
+    def __init__(
+        self,
+        workers: int = 4,
+        memory_mb: int = DEFAULT_MEMORY_MB,
+        threads: int = None,
+        hard_memory_limit: bool = False,
+        env: dict = None
+    ):
+        self.workers = workers
+        self.memory_mb = memory_mb
+        self.hard_memory_limit = hard_memory_limit
+        self.env = {
+            'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': str(memory_mb),
+            'AWS_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+            # leave some room for python and pyarrow, as duckdb does on the lambda
+            'QUACK_MEMORY_LIMIT_MB': str(int(memory_mb * 0.75)),
+            **({ 'QUACK_THREADS': str(threads) } if threads else {}),
+            **(env or {})
+        }
+        self._pool = None
+        # the first calls may come from many threads at once: they must share one pool
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self.env, self.memory_mb, self.hard_memory_limit)
+                )
+
+            return self._pool
+
+    def invoke(self, json_payload_as_str: str) -> dict:
+        try:
+            return self._get_pool().submit(_run_handler, json_payload_as_str).result()
+        except Exception as e:
+            # a worker died (e.g. out of memory): the pool is broken, start a fresh (cold) one
+            self.reset()
+            return { 'errorMessage': str(e), 'errorType': 'Runtime.ExitError' }
+
+    def with_concurrency(self, concurrency: int):
+        # the concurrency is capped by the number of workers anyway
+        return self
+
+    def reset(self):
+        """
+        Shut the workers down: the next calls will be cold starts.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        return
+
+
+class LocalDataExecutor(LocalExecutor):
+    """
+    A LocalExecutor that never talks to AWS: s3 uris are read from a local folder
+    (data_root/bucket/key), or from an S3-compatible endpoint (e.g. http://localhost:9000).
+    """
+
+    name = 'local-data'
+
+    def __init__(self, data_root: str = None, endpoint_url: str = None, **kwargs):
+        assert bool(data_root) != bool(endpoint_url), "Please specify either a data root or an S3 endpoint"
+        env = kwargs.pop('env', {}) or {}
+        if data_root:
+            env['QUACK_LOCAL_DATA_ROOT'] = os.path.abspath(data_root)
+        else:
+            env['QUACK_S3_ENDPOINT_URL'] = endpoint_url
+        self.data_root = data_root
+        self.endpoint_url = endpoint_url
+        super().__init__(env=env, **kwargs)
+
+    def s3_client(self):
+        """
+        The S3 client the caller should use for the same data (listing partitions, manifests...).
+        """
+        if self.data_root:
+            sys.path.insert(0, SERVERLESS_FOLDER)
+            from local_storage import LocalS3Client
+            return LocalS3Client(os.path.abspath(self.data_root))
+
+        return boto3.client('s3', endpoint_url=self.endpoint_url)
+
+
+class GatewayError(Exception):
+    """
+    The gateway did not run the payload: the queue of the tenant was still full (429) after
+    our retries, or the backend kept failing (502).
+    """
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"Gateway error {status}: {body}")
+        self.status = status
+
+
+class GatewayExecutor:
+    """
+    Send the payloads to the query gateway, which shares its result cache, deduplication of
+    identical queries and concurrency quotas among all its clients: calls count against the
+    quota of the tenant.
+    """
+
+    name = 'gateway'
+
+    def __init__(self, url: str = None, tenant: str = None, timeout: float = 900, max_attempts: int = GATEWAY_MAX_ATTEMPTS):
+        self.url = (url or os.environ.get('QUACK_GATEWAY_URL', DEFAULT_GATEWAY_URL)).rstrip('/')
+        self.tenant = tenant or os.environ.get('QUACK_TENANT', 'default')
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def _request(self, path: str, data: bytes = None) -> dict:
+        request = urllib.request.Request(
+            f"{self.url}{path}",
+            data=data,
+            headers={ 'Content-Type': 'application/json', 'X-Quack-Tenant': self.tenant },
+            method='POST' if data is not None else 'GET'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            raise GatewayError(e.code, e.read().decode('utf-8'))
+
+    def invoke(self, json_payload_as_str: str) -> dict:
+        """
+        Send the payload, waiting and trying again while the queue of the tenant is full.
+        """
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                return self._request('/invoke', json_payload_as_str.encode('utf-8'))
+            except GatewayError as e:
+                if e.status != 429 or attempts >= self.max_attempts:
+                    raise
+            time.sleep(random.uniform(0, min(GATEWAY_MAX_DELAY_S, GATEWAY_BASE_DELAY_S * 2 ** (attempts - 1))))
+
+    def metrics(self) -> dict:
+        return self._request('/metrics')
+
+    def with_concurrency(self, concurrency: int):
+        # the gateway decides how many calls run at once
+        return self
+
+    def s3_client(self):
+        """
+        The gateway does not serve data: we read it from where the backend of the gateway
+        does, i.e. the same QUACK_LOCAL_DATA_ROOT / QUACK_S3_ENDPOINT_URL settings, or S3.
+        """
+        if os.environ.get('QUACK_LOCAL_DATA_ROOT'):
+            sys.path.insert(0, SERVERLESS_FOLDER)
+            from local_storage import LocalS3Client
+            return LocalS3Client(os.path.abspath(os.environ['QUACK_LOCAL_DATA_ROOT']))
+
+        return boto3.client('s3', endpoint_url=os.environ.get('QUACK_S3_ENDPOINT_URL') or None)
+
+
+def executor_from_env(kind: str = None):
+    """
+    Build the executor configured through environment variables (see local.env): the kind
+    can be forced (e.g. by benchmark.py), the rest of the configuration still comes from there.
+    """
+    kind = kind or os.environ.get('QUACK_EXECUTOR', 'lambda')
+    workers = int(os.environ.get('QUACK_LOCAL_WORKERS', 4))
+    memory_mb = int(os.environ.get('QUACK_LOCAL_MEMORY_MB', DEFAULT_MEMORY_MB))
+    threads = int(os.environ['QUACK_LOCAL_THREADS']) if os.environ.get('QUACK_LOCAL_THREADS') else None
+    if kind == 'lambda':
+        return LambdaExecutor()
+    if kind == 'local':
+        return LocalExecutor(workers=workers, memory_mb=memory_mb, threads=threads)
+    if kind == 'local-data':
+        return LocalDataExecutor(
+            data_root=os.environ.get('QUACK_LOCAL_DATA_ROOT'),
+            endpoint_url=os.environ.get('QUACK_S3_ENDPOINT_URL'),
+            workers=workers,
+            memory_mb=memory_mb,
+            threads=threads
+        )
+    if kind == 'gateway':
+        return GatewayExecutor()
+
+    raise ValueError(f"Unknown executor {kind}, use one of lambda, local, local-data, gateway")
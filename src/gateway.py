@@ -0,0 +1,563 @@
+"""
+
+Query gateway: a small, long-running HTTP server all the clients (quack.py, benchmark.py,
+every Streamlit session...) send their payloads to, instead of each one invoking the lambda
+on its own, with no idea of what the others are doing. It runs on asyncio, and invokes the
+backend with the same code as quack.py (see executors.py: the lambda, or the handler in local
+worker processes, to test it all on one machine). The gateway has:
+
+* a result cache shared by all the clients, with the same keys as the client cache (normalized
+  SQL, response parameters and the ETags of the objects read), and deduplication: identical
+  queries in flight make one invocation;
+* admission control: at most `concurrency` invocations in flight overall (stay under the
+  account concurrency limit, instead of bursting into throttles), and at most the quota of a
+  tenant (the X-Quack-Tenant header) for each tenant; queries over the quota wait in the
+  queue of their tenant, and a tenant with a full queue gets a 429;
+* keep-warm: every warm_interval seconds, pings (events with 'warmup', see app.handler) hold
+  a pool of warm containers, minus the ones busy with queries;
+* GET /metrics: queue depth, in-flight calls, latency histograms, cache hit ratio, retries,
+  throttles and keep-warm stats, overall and per tenant.
+
+POST /invoke takes the event of the lambda and returns its response (function errors
+included, as the lambda does), with metadata['gateway'] for the cache status and the time
+spent queuing. Clients use it with QUACK_EXECUTOR=gateway (see executors.GatewayExecutor).
+
+"""
+
+
+import os
+import time
+import json
+import bisect
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from quack import invoke_lambda, is_retryable, client_cache_key, set_executor
+from executors import executor_from_env
+from client_cache import AsyncQueryCache
+from result_cache import is_cacheable
+
+
+DEFAULT_PORT = 8765
+# invocations in flight overall: keep it under the concurrency limit of the account
+DEFAULT_CONCURRENCY = 20
+# invocations in flight per tenant, and queries waiting for one
+DEFAULT_TENANT_QUOTA = 5
+DEFAULT_MAX_QUEUE = 100
+DEFAULT_TENANT = 'default'
+DEFAULT_CACHE_TTL_S = 60.0
+DEFAULT_CACHE_ENTRIES = 512
+DEFAULT_WARM_INTERVAL_S = 300.0
+# how long a keep-warm ping holds its container (see app.handler)
+WARMUP_HOLD_MS = 100
+# retries of throttles and transient errors, as in quack.invoke_lambda_async
+MAX_RETRIES = 5
+BASE_DELAY_S = 0.2
+MAX_DELAY_S = 10.0
+THROTTLE_ERROR_CODES = ('TooManyRequestsException', 'ThrottlingException')
+# upper bounds of the latency buckets (ms), the last bucket is everything above
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+HTTP_REASONS = { 200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests', 502: 'Bad Gateway' }
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class LatencyHistogram:
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+        return
+
+    def quantile(self, q: float):
+        """
+        The upper bound of the bucket the quantile falls in (the max for the last one).
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                break
+
+        return self.buckets[idx] if idx < len(self.buckets) else int(self.max_ms)
+
+    def snapshot(self) -> dict:
+        labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+
+        return {
+            'count': self.count,
+            'meanMs': round(self.total_ms / self.count, 1) if self.count else None,
+            'p50Ms': self.quantile(0.5),
+            'p95Ms': self.quantile(0.95),
+            'p99Ms': self.quantile(0.99),
+            'maxMs': int(self.max_ms),
+            'buckets': dict(zip(labels, self.counts))
+        }
+
+
+class Tenant:
+
+    def __init__(self, name: str, quota: int):
+        self.name = name
+        self.quota = quota
+        self.semaphore = asyncio.Semaphore(quota)
+        self.running = 0
+        self.queued = 0
+        self.requests = 0
+        self.rejected = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self) -> dict:
+        return {
+            'quota': self.quota,
+            'running': self.running,
+            'queued': self.queued,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'latencyMs': self.latency.snapshot()
+        }
+
+
+class Gateway:
+    """
+    Admission, caching and keep-warm in front of a backend: create it (and use it) in the
+    event loop that serves the requests.
+    """
+
+    def __init__(
+        self,
+        backend,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        tenant_quota: int = DEFAULT_TENANT_QUOTA,
+        quotas: dict = None,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        cache_ttl: float = DEFAULT_CACHE_TTL_S,
+        cache_entries: int = DEFAULT_CACHE_ENTRIES,
+        warm_pool: int = 0,
+        warm_interval: float = DEFAULT_WARM_INTERVAL_S
+    ):
+        self.backend = backend.with_concurrency(concurrency)
+        self.concurrency = concurrency
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tenant_quota = tenant_quota
+        # quotas of specific tenants, the others get tenant_quota
+        self.quotas = quotas or {}
+        self.max_queue = max_queue
+        self.cache_ttl = cache_ttl
+        self.cache = AsyncQueryCache(max_entries=cache_entries)
+        self.warm_pool = warm_pool
+        self.warm_interval = warm_interval
+        self.tenants = {}
+        # boto3 is not async: invocations run in threads, as many as the slots (plus the pings)
+        self.threads = ThreadPoolExecutor(max_workers=concurrency + warm_pool)
+        # the HEAD / LIST requests for the cache keys should not wait behind the invocations
+        self.key_threads = ThreadPoolExecutor(max_workers=4)
+        self.in_flight = 0
+        self.waiting_for_slot = 0
+        self.started_at = time.time()
+        self.counters = { 'requests': 0, 'invocations': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'rejected': 0 }
+        self.latency = LatencyHistogram()
+        self.queue_latency = LatencyHistogram()
+        self.invoke_latency = LatencyHistogram()
+        self.warm = { 'pings': 0, 'coldPings': 0, 'failedPings': 0, 'lastPingAt': None }
+        self._warm_task = None
+
+    def tenant(self, name: str) -> Tenant:
+        if name not in self.tenants:
+            self.tenants[name] = Tenant(name, self.quotas.get(name, self.tenant_quota))
+
+        return self.tenants[name]
+
+    async def cache_key(self, payload: dict):
+        """
+        The key of the payload in the shared cache, None if its response should not be
+        shared (volatile or profiled queries, results delivered through the bucket, batches).
+        """
+        query = payload.get('q')
+        if (
+            not self.cache_ttl or not isinstance(query, str) or payload.get('cache', True) is False
+            or payload.get('profile') or payload.get('delivery', 'inline') != 'inline'
+            or not is_cacheable(query)
+        ):
+            return None
+        params = { k: v for k, v in payload.items() if k not in ('q', 'limit') }
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.key_threads, lambda: client_cache_key(query, payload.get('limit'), **params))
+
+    async def invoke(self, payload_str: str, started: dict = None, max_retries: int = MAX_RETRIES, latency=None) -> dict:
+        """
+        Invoke the backend in a slot, retrying throttles and transient errors with full jitter
+        exponential backoff (without holding the slot). Invocation errors are raised after the
+        last retry, function errors are returned, as the lambda does.
+        """
+        loop = asyncio.get_running_loop()
+        attempts = 0
+        while True:
+            attempts += 1
+            error, response = None, None
+            self.waiting_for_slot += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting_for_slot -= 1
+            try:
+                if started is not None:
+                    started.setdefault('at', time.time())
+                self.in_flight += 1
+                self.counters['invocations'] += 1
+                invoke_start = time.time()
+                try:
+                    response = await loop.run_in_executor(self.threads, invoke_lambda, payload_str, self.backend)
+                except Exception as e:
+                    error = e
+                if latency is not None:
+                    latency.observe((time.time() - invoke_start) * 1000.0)
+            finally:
+                self.in_flight -= 1
+                self.slots.release()
+            if error is None and 'errorMessage' not in response:
+                return response
+            if isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+                self.counters['throttles'] += 1
+            if not is_retryable(error=error, response=response) or attempts > max_retries:
+                if error is not None:
+                    raise error
+                return response
+            self.counters['retries'] += 1
+            await asyncio.sleep(random.uniform(0, min(MAX_DELAY_S, BASE_DELAY_S * 2 ** (attempts - 1))))
+
+    async def admit(self, payload: dict, tenant: Tenant, timing: dict) -> dict:
+        """
+        Wait for a slot of the tenant (in its queue), then invoke the backend.
+        """
+        if tenant.queued >= self.max_queue:
+            tenant.rejected += 1
+            self.counters['rejected'] += 1
+            raise QueueFullError(f"Tenant {tenant.name} has {tenant.queued} queries queued already, try again later")
+        queue_start = time.time()
+        started = {}
+        tenant.queued += 1
+        try:
+            await tenant.semaphore.acquire()
+        finally:
+            tenant.queued -= 1
+        tenant.running += 1
+        try:
+            return await self.invoke(json.dumps(payload), started=started, latency=self.invoke_latency)
+        finally:
+            tenant.running -= 1
+            tenant.semaphore.release()
+            # from the request to the first invocation: the tenant queue, then the global one
+            timing['queueMs'] = int((started.get('at', time.time()) - queue_start) * 1000.0)
+            self.queue_latency.observe(timing['queueMs'])
+
+    async def query(self, payload: dict, tenant_name: str = DEFAULT_TENANT) -> dict:
+        """
+        Answer the payload from the cache, from an identical query in flight, or invoke the
+        backend: return its response, with metadata['gateway'].
+        """
+        start_time = time.time()
+        tenant = self.tenant(tenant_name)
+        tenant.requests += 1
+        self.counters['requests'] += 1
+        timing = {}
+        key = await self.cache_key(payload)
+        try:
+            if key is None:
+                response, status = await self.admit(payload, tenant, timing), 'disabled'
+            else:
+                response, status = await self.cache.get_or_run(
+                    key,
+                    self.cache_ttl,
+                    lambda: self.admit(payload, tenant, timing),
+                    should_cache=lambda r: 'errorMessage' not in r
+                )
+        except QueueFullError:
+            raise
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        if 'errorMessage' in response:
+            self.counters['errors'] += 1
+        elapsed = (time.time() - start_time) * 1000.0
+        self.latency.observe(elapsed)
+        tenant.latency.observe(elapsed)
+        # cached responses are shared: add our metadata to a copy
+        metadata = {
+            **response.get('metadata', {}),
+            'gateway': { 'cache': status, 'tenant': tenant.name, 'timeMs': int(elapsed), **timing }
+        }
+
+        return { **response, 'metadata': metadata }
+
+    async def ping(self):
+        """
+        Send one keep-warm ping per container of the pool that is not busy with a query: the
+        pings run at the same time, and hold their container for a moment, so that they
+        don't all land on the same one.
+        """
+        pings = max(self.warm_pool - self.in_flight, 0)
+        payload = json.dumps({ 'warmup': True, 'warmup_ms': WARMUP_HOLD_MS })
+        responses = await asyncio.gather(*[self.invoke(payload, max_retries=0) for _ in range(pings)], return_exceptions=True)
+        warmed = [r for r in responses if isinstance(r, dict) and 'errorMessage' not in r]
+        self.warm['pings'] += pings
+        # a cold ping started a container: one more in the pool
+        self.warm['coldPings'] += sum(1 for r in warmed if not r['metadata']['warm'])
+        self.warm['failedPings'] += pings - len(warmed)
+        self.warm['lastPingAt'] = int(time.time())
+
+        return
+
+    async def keep_warm(self):
+        while True:
+            try:
+                await self.ping()
+            except Exception as e:
+                print(f"Keep-warm ping failed: {e}")
+            await asyncio.sleep(self.warm_interval)
+
+    def start(self):
+        if self.warm_pool and self._warm_task is None:
+            self._warm_task = asyncio.ensure_future(self.keep_warm())
+
+        return self
+
+    def stop(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+            self._warm_task = None
+        self.threads.shutdown(wait=False)
+        self.key_threads.shutdown(wait=False)
+
+        return
+
+    def metrics(self) -> dict:
+        return {
+            'uptimeS': int(time.time() - self.started_at),
+            'backend': self.backend.name,
+            'concurrency': self.concurrency,
+            'inFlight': self.in_flight,
+            # queries waiting in the tenant queues, and invocations waiting for a global slot
+            'queueDepth': sum(t.queued for t in self.tenants.values()) + self.waiting_for_slot,
+            **self.counters,
+            'latencyMs': self.latency.snapshot(),
+            'queueMs': self.queue_latency.snapshot(),
+            'invokeMs': self.invoke_latency.snapshot(),
+            'cache': { 'ttlS': self.cache_ttl, **self.cache.stats() },
+            'keepWarm': { 'pool': self.warm_pool, 'intervalS': self.warm_interval, **self.warm },
+            'tenants': { name: t.snapshot() for name, t in self.tenants.items() }
+        }
+
+    async def route(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        path = path.split('?')[0]
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics()
+        if method == 'GET' and path == '/health':
+            return 200, { 'status': 'ok' }
+        if method != 'POST' or path != '/invoke':
+            return 404, { 'errorMessage': f"No route for {method} {path}" }
+        try:
+            payload = json.loads(body)
+            assert isinstance(payload, dict), "The payload must be a json object"
+        except (ValueError, AssertionError) as e:
+            return 400, { 'errorMessage': f"Invalid payload: {e}", 'errorType': 'InvalidRequestContentException' }
+        try:
+            return 200, await self.query(payload, headers.get('x-quack-tenant') or DEFAULT_TENANT)
+        except QueueFullError as e:
+            return 429, { 'errorMessage': str(e), 'errorType': 'TooManyRequestsException' }
+        except Exception as e:
+            # the backend could not be invoked, even after the retries
+            return 502, { 'errorMessage': str(e), 'errorType': type(e).__name__ }
+
+    async def handle_connection(self, reader, writer):
+        """
+        Just enough HTTP/1.1 for json requests and responses, with keep-alive.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.route(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(response, default=str).encode('utf-8')
+                writer.write((
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                ).encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # the client went away, or did not speak HTTP
+            pass
+        finally:
+            writer.close()
+
+        return
+
+
+async def serve(host: str, port: int, backend, ready=None, **kwargs):
+    """
+    Run the gateway until cancelled: ready (a threading.Event) is set once it listens.
+    """
+    gateway = Gateway(backend, **kwargs).start()
+    server = await asyncio.start_server(gateway.handle_connection, host, port)
+    if ready is not None:
+        ready.gateway = gateway
+        ready.port = server.sockets[0].getsockname()[1]
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        gateway.stop()
+
+
+class BackgroundGateway:
+    """
+    A gateway serving from a thread of this process, e.g. to test clients against the handler
+    in local workers: BackgroundGateway(LocalDataExecutor(...)).start().url
+    """
+
+    def __init__(self, backend, host: str = '127.0.0.1', port: int = 0, **kwargs):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self.gateway = None
+        self._loop = None
+        self._task = None
+        self._thread = None
+
+    def _run(self, ready: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(serve(self.host, self.port, self.backend, ready=ready, **self.kwargs))
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+        self.gateway = ready.gateway
+        self.port = ready.port
+
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join()
+
+        return
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-host",
+        type=str,
+        help="interface to listen on",
+        default='127.0.0.1')
+    parser.add_argument(
+        "-port",
+        type=int,
+        help="port to listen on",
+        default=DEFAULT_PORT)
+    parser.add_argument(
+        "-backend",
+        type=str,
+        choices=['lambda', 'local', 'local-data'],
+        help="where the gateway runs the queries (see executors.py)",
+        default=os.environ.get('QUACK_GATEWAY_BACKEND', 'lambda'))
+    parser.add_argument(
+        "-concurrency",
+        type=int,
+        help="invocations in flight overall, across tenants",
+        default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "-tenant-quota",
+        type=int,
+        help="invocations in flight per tenant (X-Quack-Tenant header)",
+        default=DEFAULT_TENANT_QUOTA)
+    parser.add_argument(
+        "-quota",
+        type=str,
+        action="append",
+        help="quota of a specific tenant, as tenant=N (can be repeated)",
+        default=[])
+    parser.add_argument(
+        "-max-queue",
+        type=int,
+        help="queries waiting per tenant before the gateway answers 429",
+        default=DEFAULT_MAX_QUEUE)
+    parser.add_argument(
+        "-cache-ttl",
+        type=float,
+        help="seconds a response stays in the shared cache (0 to turn it off)",
+        default=DEFAULT_CACHE_TTL_S)
+    parser.add_argument(
+        "-warm-pool",
+        type=int,
+        help="containers to keep warm with pings (0 to turn it off)",
+        default=0)
+    parser.add_argument(
+        "-warm-interval",
+        type=float,
+        help="seconds between two rounds of keep-warm pings",
+        default=DEFAULT_WARM_INTERVAL_S)
+    args = parser.parse_args()
+    backend = executor_from_env(args.backend)
+    # the cache keys read the object versions from the data of the backend
+    set_executor(backend)
+    print(f"Gateway on http://{args.host}:{args.port}, running the queries on {backend.name}")
+    asyncio.run(serve(
+        args.host,
+        args.port,
+        backend,
+        concurrency=args.concurrency,
+        tenant_quota=args.tenant_quota,
+        quotas={ q.split('=')[0]: int(q.split('=')[1]) for q in args.quota },
+        max_queue=args.max_queue,
+        cache_ttl=args.cache_ttl,
+        warm_pool=args.warm_pool,
+        warm_interval=args.warm_interval
+    ))
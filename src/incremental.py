@@ -0,0 +1,242 @@
+"""
+
+Incremental build of the taxi rollups: the dbt models (dashboard/dbt) re-aggregate the whole
+dataset at every run, which gets slower as days of data pile up. Here we work by partition
+of the hive-partitioned copy of the data (s3://bucket/partitioned/date=.../*.parquet):
+
+* the version of every partition is the list of its files with their ETags, from a LIST of
+  the bucket or from the dataset manifest (see serverless/manifest.py);
+* partitions that are new or changed since the last run are re-aggregated by the lambda into
+  per-partition partial aggregates (parquet files under rollups/<name>/partials/);
+* partials of unchanged partitions are reused, partials of deleted partitions dropped;
+* partials are merged (locally, they are small) into the serving files, under
+  rollups/partitioned/: the same two tables as the dbt models, but built from the
+  partitioned copy, so they have their own keys and entries in rollups.json (the router
+  answers queries over partitioned/*/*.parquet with them). They are stamped with the version
+  of the partitions they were built from (see router.py).
+
+The state of the build (partition versions -> partial files) is a json file next to the
+partials. With --full every partition is rebuilt, as dbt does. Every run reports its time
+and the bytes it scanned, which should follow the size of the change, not of the dataset.
+
+"""
+
+
+import os
+import io
+import json
+import time
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rich.console import Console
+from quack import get_s3_client, invoke_many, display_table
+from manifest import split_s3_uri, load_manifest, partition_values
+from result_cache import get_object_versions
+from router import source_fingerprint, stamp_table
+
+
+# the partitioned dataset, as uploaded by run_me_first.py
+DATASET_PREFIX = 'partitioned'
+# partial aggregate of a partition: same grain and measures as the dbt model
+PARTIAL_QUERY = """
+    SELECT pickup_location_id AS location_id, COUNT(*) AS counts
+    FROM read_parquet([{files}])
+    GROUP BY 1
+"""
+# merge of the partials: the serving rollup, and the top locations for the dashboard
+ROLLUP_QUERY = "SELECT location_id, CAST(SUM(counts) AS BIGINT) AS counts FROM partials GROUP BY 1"
+TOP_QUERY = "SELECT location_id, counts FROM rollup ORDER BY 2 DESC LIMIT 200"
+# schema of the partials and the rollup, for a build without any partition left
+ROLLUP_SCHEMA = pa.schema([('location_id', pa.int32()), ('counts', pa.int64())])
+ROLLUP_NAME = 'trips_by_pickup_location'
+# must be the source, location and top location of the entries in rollups.json
+SOURCE_URI = "s3://{bucket}/" + DATASET_PREFIX + "/*/*.parquet"
+ROLLUP_KEY = f"rollups/{DATASET_PREFIX}/{ROLLUP_NAME}.parquet"
+TOP_KEY = f"rollups/{DATASET_PREFIX}/top_pickup_locations.parquet"
+STATE_KEY = f"rollups/{ROLLUP_NAME}/_state.json"
+# reports of the last runs kept in the state, to see how build times evolve
+MAX_HISTORY = 50
+PARTIALS_PREFIX = f"rollups/{ROLLUP_NAME}/partials"
+
+
+def partition_versions(s3_client, bucket: str, use_manifest: bool = False) -> dict:
+    """
+    Return partition -> { 'files': { path: etag }, 'bytes': size }, e.g. for 'date=2019-04-01'.
+    """
+    if use_manifest:
+        manifest = load_manifest(s3_client, f"s3://{bucket}/{DATASET_PREFIX}")
+        assert manifest, f"No manifest for s3://{bucket}/{DATASET_PREFIX}, run `make manifest` first"
+        versions = [(f['path'], f['etag'], '', f['size']) for f in manifest['files']]
+    else:
+        versions = get_object_versions(s3_client, f"'{SOURCE_URI.format(bucket=bucket)}'")
+    partitions = {}
+    for path, etag, _, size in versions:
+        name = '/'.join(f"{k}={v}" for k, v in partition_values(path).items())
+        partition = partitions.setdefault(name, { 'files': {}, 'bytes': 0 })
+        partition['files'][path] = etag
+        partition['bytes'] += size
+
+    return partitions
+
+
+def load_state(s3_client, bucket: str) -> dict:
+    from botocore.exceptions import ClientError
+
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=STATE_KEY)['Body'].read()
+    except ClientError:
+        # first run: nothing to reuse
+        return { 'partitions': {} }
+
+    return json.loads(body)
+
+
+def save_state(s3_client, bucket: str, state: dict):
+    s3_client.put_object(Bucket=bucket, Key=STATE_KEY, Body=json.dumps(state).encode('utf-8'))
+
+    return
+
+
+def plan_build(current: dict, previous: dict, full: bool = False) -> tuple:
+    """
+    Split the partitions in the ones to (re)build, the ones whose partials we keep, and the
+    ones that are gone.
+    """
+    to_build = sorted(
+        name for name, partition in current.items()
+        if full or name not in previous or previous[name]['files'] != partition['files']
+    )
+    reused = sorted(name for name in current if name not in to_build)
+    dropped = sorted(name for name in previous if name not in current)
+
+    return to_build, reused, dropped
+
+
+def build_partials(bucket: str, current: dict, to_build: list, threads: int) -> dict:
+    """
+    Aggregate the partitions in the lambdas, one task per partition, each writing its partial
+    to the bucket: return partition -> partial files.
+    """
+    payloads = [
+        json.dumps({
+            'q': PARTIAL_QUERY.format(files=', '.join(f"'{p}'" for p in sorted(current[name]['files']))),
+            'limit': None,
+            'delivery': 's3',
+            'results_location': f"s3://{bucket}/{PARTIALS_PREFIX}/{name}",
+            'cache': False
+        })
+        for name in to_build
+    ]
+    tasks = invoke_many(payloads, concurrency=threads)
+    errors = [task['error'] for task in tasks if task['response'] is None]
+    if errors:
+        raise Exception(f"{len(errors)} partitions failed, the state was not updated: {errors[0]}")
+
+    return { name: task['response']['data']['files'] for name, task in zip(to_build, tasks) }
+
+
+def serving_files_exist(s3_client, bucket: str) -> bool:
+    try:
+        for key in (ROLLUP_KEY, TOP_KEY):
+            s3_client.head_object(Bucket=bucket, Key=key)
+    except Exception:
+        return False
+
+    return True
+
+
+def merge_partials(s3_client, bucket: str, partials: list, version: str) -> dict:
+    """
+    Merge all the partial files into the serving files, stamped with the version of the
+    source, and upload them. Return what we read and wrote, for the report.
+    """
+    tables = []
+    for f in partials:
+        partial_bucket, key = split_s3_uri(f['path'])
+        tables.append(pq.read_table(pa.BufferReader(s3_client.get_object(Bucket=partial_bucket, Key=key)['Body'].read())))
+    con = duckdb.connect(database=':memory:')
+    # every partition is gone: the rollups are empty, not missing
+    con.register('partials', pa.concat_tables(tables, promote=True) if tables else ROLLUP_SCHEMA.empty_table())
+    rollup = con.execute(ROLLUP_QUERY).arrow()
+    con.register('rollup', rollup)
+    top = con.execute(TOP_QUERY).arrow()
+    written = 0
+    for key, table in ((ROLLUP_KEY, rollup), (TOP_KEY, top)):
+        sink = io.BytesIO()
+        pq.write_table(stamp_table(table, SOURCE_URI.format(bucket=bucket), version), sink)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=sink.getvalue())
+        written += sink.tell()
+
+    return {
+        'partialBytesRead': sum(f['size'] for f in partials),
+        'rollupRows': rollup.num_rows,
+        'bytesWritten': written
+    }
+
+
+def run_build(bucket: str, full: bool = False, use_manifest: bool = False, threads: int = 20) -> dict:
+    start_time = time.time()
+    s3_client = get_s3_client()
+    state = load_state(s3_client, bucket)
+    current = partition_versions(s3_client, bucket, use_manifest=use_manifest)
+    to_build, reused, dropped = plan_build(current, state['partitions'], full=full)
+    built = build_partials(bucket, current, to_build, threads) if to_build else {}
+    partitions = {
+        **{ name: state['partitions'][name] for name in reused },
+        **{ name: { 'files': current[name]['files'], 'partials': built[name] } for name in built }
+    }
+    merge = merge_partials(
+        s3_client,
+        bucket,
+        [f for p in partitions.values() for f in p['partials']],
+        # the router compares this with the objects it lists: partitions are the whole source
+        source_fingerprint({ path: etag for p in current.values() for path, etag in p['files'].items() })
+    # nothing changed, but the serving files are missing (e.g. deleted, or never written there)
+    ) if (to_build or dropped or not serving_files_exist(s3_client, bucket)) else {}
+    report = {
+        'mode': 'full' if full else 'incremental',
+        'partitions': len(current),
+        'rebuilt': len(to_build),
+        'reused': len(reused),
+        'dropped': len(dropped),
+        # the raw data the lambdas read: this is what should scale with the change
+        'bytesScanned': sum(current[name]['bytes'] for name in to_build),
+        'datasetBytes': sum(p['bytes'] for p in current.values()),
+        **merge,
+        'buildMs': int((time.time() - start_time) * 1000.0),
+        'builtAt': int(time.time())
+    }
+    # the serving files are up to date: now we can forget (and delete) the old partials
+    history = (state.get('history', []) + [report])[-MAX_HISTORY:]
+    save_state(s3_client, bucket, { 'partitions': partitions, 'history': history })
+    replaced = [f for name in to_build + dropped if name in state['partitions'] for f in state['partitions'][name]['partials']]
+    for f in replaced:
+        partial_bucket, key = split_s3_uri(f['path'])
+        s3_client.delete_object(Bucket=partial_bucket, Key=key)
+
+    return report
+
+
+if __name__ == "__main__":
+    assert 'S3_BUCKET_NAME' in os.environ, "Please set the S3_BUCKET_NAME environment variable"
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild the partials of every partition, not just the new or changed ones",
+        default=False)
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="read the partition versions from the dataset manifest instead of listing the bucket",
+        default=False)
+    parser.add_argument(
+        "-t",
+        type=int,
+        help="concurrent lambdas for the partials",
+        default=20)
+    args = parser.parse_args()
+    report = run_build(os.environ['S3_BUCKET_NAME'], full=args.full, use_manifest=args.manifest, threads=args.t)
+    display_table(Console(), [{ 'Field': k, 'Value': str(v) } for k, v in report.items()], title="Rollup build", color="cyan")
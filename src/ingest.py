@@ -0,0 +1,297 @@
+"""
+
+Streaming ingest for the taxi dataset (or any parquet file with a timestamp column): the
+monthly files can be many times bigger than April 2019, so nothing here holds the full
+dataset in memory.
+
+* download_file streams the download to disk in chunks;
+* partition_dataset reads the source one row group at a time and writes a hive-partitioned
+  copy (date=.../part-N.parquet) with an arrow dataset writer, capping rows per file and per
+  row group, and the number of partitions buffered at once;
+* cluster_partitions rewrites each partition with a layout that lets duckdb skip row groups:
+  rows sorted (or Z-ordered) on the columns queries filter on, optionally hash bucketed into a
+  fixed number of files, with a target row group size and column statistics in the footers;
+* upload_directory uploads the files concurrently, with multipart uploads for the big ones,
+  and returns their sizes and ETags so that the manifest can be built from the local files,
+  without reading the footers back from S3.
+
+"""
+
+
+import os
+import sys
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+# the manifest code is shared with the lambda, and lives in the serverless folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serverless'))
+from manifest import describe_parquet_file, hash_buckets, BUCKETING_METADATA_KEY
+
+
+DOWNLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+# rows we read from the source at a time (never more than a row group)
+READ_BATCH_ROWS = 128 * 1024
+DEFAULT_ROWS_PER_FILE = 4 * 1024 * 1024
+DEFAULT_ROWS_PER_GROUP = 512 * 1024
+# partitions being written at the same time: each one buffers up to a row group
+MAX_OPEN_FILES = 64
+UPLOAD_THREADS = 8
+MULTIPART_THRESHOLD_BYTES = 64 * 1024 * 1024
+MULTIPART_CHUNK_BYTES = 16 * 1024 * 1024
+# bits per column in a Z-order key (at most 64 bits in total)
+Z_ORDER_BITS = 16
+
+
+def download_file(url: str, target_file: str, chunk_size: int = DOWNLOAD_CHUNK_BYTES):
+    """
+    Stream the url to target_file, one chunk at a time: we write to a temporary file first,
+    so that an interrupted download does not leave a truncated file behind.
+    """
+    import requests
+
+    tmp_file = f"{target_file}.part"
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(tmp_file, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    os.replace(tmp_file, target_file)
+
+    return target_file
+
+
+def iter_with_partition_column(source_path: str, timestamp_col: str, partition_col: str, batch_size: int = READ_BATCH_ROWS):
+    """
+    Read the source one batch at a time (pyarrow reads one row group at a time underneath),
+    adding the partition column as the date of the timestamp column.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(source_path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        dates = batch.column(timestamp_col).cast(pa.date32())
+        yield pa.RecordBatch.from_arrays(
+            batch.columns + [dates],
+            names=batch.schema.names + [partition_col]
+        )
+
+
+def partition_dataset(
+        source_path: str,
+        target_dir: str,
+        timestamp_col: str = 'pickup_at',
+        partition_col: str = 'date',
+        rows_per_file: int = DEFAULT_ROWS_PER_FILE,
+        rows_per_group: int = DEFAULT_ROWS_PER_GROUP,
+        compression: str = 'snappy',
+        sort_by: list = None,
+        z_order_by: list = None,
+        buckets: int = None,
+        bucket_by: str = None,
+        write_statistics=True
+        ):
+    """
+    Write a hive-partitioned copy of the source in target_dir (wiping what was there), and
+    return the list of files written. Memory is bounded by MAX_OPEN_FILES row groups.
+
+    With a layout (sort_by, z_order_by or buckets, see cluster_partitions), every partition is
+    then rewritten clustered: that step holds one partition at a time in memory.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    shutil.rmtree(target_dir, ignore_errors=True)
+    source_schema = pq.ParquetFile(source_path).schema_arrow
+    schema = source_schema.append(pa.field(partition_col, pa.date32()))
+    written = []
+    ds.write_dataset(
+        iter_with_partition_column(source_path, timestamp_col, partition_col),
+        target_dir,
+        schema=schema,
+        format='parquet',
+        file_options=ds.ParquetFileFormat().make_write_options(compression=compression, write_statistics=write_statistics),
+        partitioning=ds.partitioning(pa.schema([schema.field(partition_col)]), flavor='hive'),
+        basename_template='part-{i}.parquet',
+        max_rows_per_file=rows_per_file,
+        # small groups make for many footers to read, so we buffer up to rows_per_group
+        min_rows_per_group=rows_per_group,
+        max_rows_per_group=rows_per_group,
+        max_open_files=MAX_OPEN_FILES,
+        existing_data_behavior='overwrite_or_ignore',
+        file_visitor=lambda f: written.append(f.path)
+    )
+    if sort_by or z_order_by or buckets:
+        written = cluster_partitions(
+            written,
+            sort_by=sort_by,
+            z_order_by=z_order_by,
+            buckets=buckets,
+            bucket_by=bucket_by,
+            rows_per_file=rows_per_file,
+            rows_per_group=rows_per_group,
+            compression=compression,
+            write_statistics=write_statistics
+        )
+
+    return sorted(written)
+
+
+def z_order_key(table, columns: list):
+    """
+    Z-order (Morton) key of every row: the bits of the columns, interleaved. Values are
+    replaced by their dense rank scaled to the same number of bits first, so that columns of
+    any type (and range) weigh the same in the key.
+    """
+    import numpy as np
+
+    bits = min(Z_ORDER_BITS, 64 // len(columns))
+    scaled = []
+    for column in columns:
+        _, ranks = np.unique(table.column(column).to_numpy(), return_inverse=True)
+        top = max(int(ranks.max()), 1) if len(ranks) else 1
+        scaled.append(ranks.astype(np.uint64) * np.uint64((1 << bits) - 1) // np.uint64(top))
+    key = np.zeros(table.num_rows, dtype=np.uint64)
+    for bit in range(bits):
+        for i, values in enumerate(scaled):
+            key |= ((values >> np.uint64(bit)) & np.uint64(1)) << np.uint64(bit * len(columns) + i)
+
+    return key
+
+
+def cluster_table(table, sort_by: list = None, z_order_by: list = None):
+    """
+    Order the rows so that the values of the clustering columns are close together, and row
+    group statistics are narrow: sorting is best for filters on the first column, Z-order
+    balances filters on any of its columns.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if z_order_by:
+        order = np.argsort(z_order_key(table, z_order_by), kind='stable')
+        return table.take(pa.array(order))
+    if sort_by:
+        return table.sort_by([(column, 'ascending') for column in sort_by])
+
+    return table
+
+
+def cluster_partitions(
+        files: list,
+        sort_by: list = None,
+        z_order_by: list = None,
+        buckets: int = None,
+        bucket_by: str = None,
+        rows_per_file: int = DEFAULT_ROWS_PER_FILE,
+        rows_per_group: int = DEFAULT_ROWS_PER_GROUP,
+        compression: str = 'snappy',
+        write_statistics=True
+        ) -> list:
+    """
+    Rewrite the files of each partition (folder) clustered: with buckets, rows are split by
+    the hash of bucket_by into (at most) that many files, bucket-N.parquet, so that all the rows
+    of a value are in one file (the footer says which bucket, for the manifest); otherwise the partition is cut in files of rows_per_file rows.
+    Rows are sorted (or Z-ordered) within each bucket (or partition), and written in groups of
+    rows_per_group rows.
+    Return the new list of files.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    assert not (sort_by and z_order_by), "Either sort or Z-order the partitions, not both"
+    assert not buckets or bucket_by, "Hash bucketing needs a bucket_by column"
+    by_folder = {}
+    for f in files:
+        by_folder.setdefault(os.path.dirname(f), []).append(f)
+    written = []
+    for folder, folder_files in sorted(by_folder.items()):
+        table = pa.concat_tables([pq.read_table(f) for f in sorted(folder_files)])
+        for f in folder_files:
+            os.remove(f)
+        if buckets:
+            column = table.column(bucket_by)
+            ids = hash_buckets(column.to_numpy(), buckets)
+            # only integers and strings can be pruned on (see manifest.literal_bucket)
+            bucket_type = 'integer' if pa.types.is_integer(column.type) else ('string' if pa.types.is_string(column.type) else None)
+            parts = []
+            for b in range(buckets):
+                part = cluster_table(table.filter(pa.array(ids == b)), sort_by, z_order_by)
+                # the bucket goes in the footer, for the manifest to prune on it
+                bucketing = { 'column': bucket_by, 'type': bucket_type, 'buckets': buckets, 'bucket': b }
+                metadata = { **(part.schema.metadata or {}), BUCKETING_METADATA_KEY: json.dumps(bucketing) }
+                parts.append((f"bucket-{b}.parquet", part.replace_schema_metadata(metadata)))
+        else:
+            # cluster the whole partition first, so that each file gets a range of the order
+            table = cluster_table(table, sort_by, z_order_by)
+            parts = [
+                (f"part-{i}.parquet", table.slice(offset, rows_per_file))
+                for i, offset in enumerate(range(0, max(table.num_rows, 1), rows_per_file))
+            ]
+        for name, part in parts:
+            if part.num_rows == 0:
+                continue
+            path = os.path.join(folder, name)
+            pq.write_table(
+                part,
+                path,
+                row_group_size=rows_per_group,
+                compression=compression,
+                write_statistics=write_statistics
+            )
+            written.append(path)
+
+    return sorted(written)
+
+
+def upload_directory(s3_client, local_dir: str, bucket: str, prefix: str, files: list = None, threads: int = UPLOAD_THREADS) -> list:
+    """
+    Upload the files (all the ones in local_dir by default) under s3://bucket/prefix, keeping
+    the relative paths. Return path (s3 uri), size and etag for every file, plus the local
+    path, so that callers can describe the files without downloading them.
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    if files is None:
+        files = sorted(
+            os.path.join(folder, name) for folder, _, names in os.walk(local_dir) for name in names
+        )
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD_BYTES,
+        multipart_chunksize=MULTIPART_CHUNK_BYTES,
+        max_concurrency=4
+    )
+
+    def upload(local_path):
+        key = '/'.join([prefix.strip('/'), os.path.relpath(local_path, local_dir).replace(os.sep, '/')])
+        print(f"Uploading {key}")
+        s3_client.upload_file(local_path, bucket, key, Config=transfer_config)
+        # multipart ETags are not the md5 of the file: ask S3, the manifest needs the real one
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        return {
+            'path': f"s3://{bucket}/{key}",
+            'size': head['ContentLength'],
+            'etag': head['ETag'],
+            'local_path': local_path
+        }
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(upload, files))
+
+
+def describe_uploaded_files(uploaded: list) -> list:
+    """
+    Turn the output of upload_directory into manifest entries, reading the footers locally.
+    """
+    import pyarrow.parquet as pq
+
+    return [
+        {
+            'path': f['path'],
+            'size': f['size'],
+            'etag': f['etag'],
+            **describe_parquet_file(pq.ParquetFile(f['local_path']))
+        }
+        for f in uploaded
+    ]
@@ -0,0 +1,188 @@
+"""
+
+A (very) small map-reduce planner for aggregate queries over a hive-partitioned dataset.
+
+Given a query such as:
+
+    SELECT pickup_location_id AS location_id, COUNT(*) AS counts
+    FROM parquet_scan('s3://bucket/partitioned/*/*.parquet', HIVE_PARTITIONING=1)
+    WHERE DATE >= '2019-04-01' AND DATE < '2019-04-11'
+    GROUP BY 1
+
+the planner lists the partitions of the dataset (or reads them from the dataset manifest,
+see serverless/manifest.py), prunes them with the WHERE predicates on
+the partition columns, and produces one "map" query per partition and one "combine" query,
+which runs over the union of all the partial results (exposed as the `partials` table).
+
+For large fan-outs, partial results can also be reduced as a tree: "merge" queries turn a
+batch of partial results into a single partial result with the same columns, so that they
+can run level after level in the lambdas, and only the last level runs the combine query.
+
+Parsing the query and writing the map / merge / combine SQL lives in serverless/aggregates.py,
+as the lambda uses the same states for approximate queries (see serverless/approximate.py).
+
+"""
+
+
+import os
+import re
+import sys
+# SQL helpers are shared with the lambda, and live in the (flat) serverless folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serverless'))
+from queryparse import extract_predicates, value_matches
+from manifest import prune_files, validate_scan, StaleManifestError
+# the SQL of the plan is shared with the lambda: importing it from here keeps working
+from aggregates import parse_aggregate_query, build_map_query, build_merge_query, build_combine_query, PARTIALS_TABLE
+from approximate import plan_approximation
+from scheduler import schedule_tasks, describe_schedule
+
+
+def parquet_files_source(paths: list) -> str:
+    return "read_parquet([{}])".format(', '.join(f"'{p}'" for p in paths))
+
+
+def tree_reduce_depth(inputs: int, fan_in: int) -> int:
+    """
+    Number of levels needed to reduce `inputs` partial results when every task reads at most
+    `fan_in` of them: the last level being the combine query.
+    """
+    assert fan_in >= 2, "The fan-in of a tree reduce must be at least 2"
+    depth = 1
+    while inputs > fan_in:
+        inputs = -(-inputs // fan_in)
+        depth += 1
+
+    return depth
+
+
+def list_partitions(s3_client, scan_path: str) -> list:
+    """
+    List the hive partitions of a dataset, e.g. for s3://bucket/partitioned/*/*.parquet
+    return [({'date': '2019-04-01'}, 's3://bucket/partitioned/date=2019-04-01'), ...].
+    """
+    match = re.match(r"^s3://([^/]+)/(.*)$", scan_path)
+    if not match:
+        return []
+    bucket, key = match.group(1), match.group(2)
+    segments = key.split('/')
+    # the root of the dataset is everything before the first wildcard
+    root_segments = []
+    for segment in segments:
+        if any(c in segment for c in '*?['):
+            break
+        root_segments.append(segment)
+    if len(root_segments) == len(segments):
+        return []
+    prefixes = [('/'.join(root_segments) + '/' if root_segments else '', {})]
+    partitions = []
+    while prefixes:
+        prefix, values = prefixes.pop()
+        paginator = s3_client.get_paginator('list_objects_v2')
+        children = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                name = common_prefix['Prefix'][len(prefix):].rstrip('/')
+                if '=' in name:
+                    column, value = name.split('=', 1)
+                    children.append((common_prefix['Prefix'], {**values, column: value}))
+        if children:
+            prefixes.extend(children)
+        elif values:
+            partitions.append((values, f"s3://{bucket}/{prefix.rstrip('/')}"))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def prune_partitions(partitions: list, predicates: list) -> list:
+    pruned = []
+    for values, path in partitions:
+        lowered = {k.lower(): v for k, v in values.items()}
+        if all(value_matches(lowered[c], op, v) for c, op, v in predicates if c in lowered):
+            pruned.append((values, path))
+
+    return pruned
+
+
+def manifest_partitions(manifest: dict, parsed: dict) -> list:
+    """
+    Same as list_partitions + prune_partitions, but from the dataset manifest: no LIST
+    requests, and files are pruned with the column statistics too. Each partition comes with
+    the explicit list of its files, so the map tasks don't need to glob either.
+    """
+    matching, files = prune_files(manifest, parsed['scan_path'], extract_predicates(parsed['where']))
+    if not matching:
+        return []
+    partitions = {}
+    for f in files:
+        key = tuple(sorted(f['partition'].items()))
+        partitions.setdefault(key, []).append(f)
+
+    return [(dict(key), partitions[key]) for key in sorted(partitions)]
+
+
+def file_list_literal(files: list) -> str:
+    return '[{}]'.format(', '.join(f"'{f['path']}'" for f in files))
+
+
+def plan_map_reduce(query: str, s3_client, manifest: dict = None, task_bytes: int = None, approximate=None):
+    """
+    Plan the query: return None if it cannot be split, otherwise a dict with the
+    map queries (one per partition, after pruning), the combine query and the parsed query
+    (to build the merge queries of a tree reduce).
+
+    If the manifest of the dataset is available and still matches the bucket (one LIST of the
+    scan, see validate_scan), we use it instead of listing the partitions and, with a
+    task_bytes budget, map tasks are sized by bytes instead of partitions (see scheduler.py):
+    the plan then describes the schedule too.
+
+    With approximate (True or the options of serverless/approximate.py), map tasks sample
+    their rows and partial states use the mergeable sketches: the merge and combine queries
+    follow, as they read parsed['approximate'].
+    """
+    parsed = parse_aggregate_query(query)
+    if not parsed or 'hive_partitioning' not in parsed['scan_options'].lower().replace(' ', ''):
+        return None
+    if approximate:
+        plan_approximation(parsed, approximate, mergeable=True)
+    if manifest:
+        try:
+            # a partition added after the manifest was written would be silently left out
+            validate_scan(s3_client, manifest, parsed['scan_path'])
+        except StaleManifestError as e:
+            print(f"Stale manifest, listing the partitions instead: {e}")
+            manifest = None
+    partitions = manifest_partitions(manifest, parsed) if manifest else []
+    if partitions and task_bytes:
+        tasks = schedule_tasks(partitions, task_bytes)
+        return {
+            'map_queries': [build_map_query(parsed, file_list_literal(t['files']), t['rowRange']) for t in tasks],
+            'partitions': [values for values, _ in partitions],
+            'combine_query': build_combine_query(parsed),
+            'manifest': manifest['snapshotId'],
+            'parsed': parsed,
+            'tasks': tasks,
+            'schedule': describe_schedule(tasks, task_bytes)
+        }
+    if partitions:
+        map_queries = [build_map_query(parsed, file_list_literal(files)) for _, files in partitions]
+        return {
+            'map_queries': map_queries,
+            'partitions': [values for values, _ in partitions],
+            'combine_query': build_combine_query(parsed),
+            'manifest': manifest['snapshotId'],
+            'parsed': parsed
+        }
+    partitions = list_partitions(s3_client, parsed['scan_path'])
+    if not partitions:
+        return None
+    partitions = prune_partitions(partitions, extract_predicates(parsed['where']))
+    # the file pattern inside each partition is the last segment of the original glob
+    file_pattern = parsed['scan_path'].rsplit('/', 1)[-1]
+    map_queries = [build_map_query(parsed, f"'{path}/{file_pattern}'") for _, path in partitions]
+
+    return {
+        'map_queries': map_queries,
+        'partitions': [values for values, _ in partitions],
+        'combine_query': build_combine_query(parsed),
+        'parsed': parsed
+    }
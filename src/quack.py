@@ -12,75 +12,1005 @@ Check the README.md for more details.
 
 import os
 import time
+import uuid
+import base64
+import random
+import asyncio
 import boto3
+import duckdb
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import json
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 from rich.console import Console
 from rich.table import Table
 from dotenv import load_dotenv
+from planner import plan_map_reduce, build_merge_query, build_combine_query, parquet_files_source, tree_reduce_depth
+from executors import executor_from_env, DEFAULT_MEMORY_MB
+from scheduler import ScanThroughput, task_byte_budget
+# planner.py makes the shared helpers in the serverless folder importable
+from manifest import find_glob_scans, dataset_root, load_manifest, split_s3_uri
+from profiling import merge_profiles
+from combine import Combiner
+from client_cache import QueryCache
+from result_cache import build_cache_key, get_object_versions, is_cacheable
+from router import load_rollups, route_query
+from approximate import describe_approximation
 
 
 # get the environment variables from the .env file
 load_dotenv()
 # we don't allow to display more than 10 rows in the terminal
 MAX_ROWS_IN_TERMINAL = 10
-# instantiate the boto3 client to communicate with the lambda
-lambda_client = boto3.client('lambda')
+# the backend running the queries (the lambda by default, see executors.py)
+executor = None
+# s3 client, used by the planner to list the partitions of a dataset
+s3_client = None
+# dataset manifests we already downloaded, revalidated with a conditional GET
+manifests = {}
+# client-side cache for fetch_all(..., cache_ttl=...), shared by all the threads
+query_cache = QueryCache()
+# scan throughput of the map tasks, to size the next ones
+scan_throughput = ScanThroughput()
+# the rollups materialized by dbt (see rollups.json), loaded on first use
+rollups = None
+# invocation errors (from the lambda service) worth retrying: throttles and 5xx
+RETRYABLE_ERROR_CODES = (
+    'TooManyRequestsException',
+    'ThrottlingException',
+    'ServiceException',
+    'EC2ThrottledException',
+    'ResourceNotReadyException'
+)
+# function errors worth retrying: the runtime crashing or timing out, S3 hiccups
+RETRYABLE_FUNCTION_ERRORS = ('Runtime.', 'Sandbox.', 'IOException', 'HTTPException')
+# hedging of slow map tasks: a task gets a duplicate when it runs longer than the HEDGE_QUANTILE
+# of the completed ones times HEDGE_SLACK, once HEDGE_MIN_COMPLETED tasks are done, and at
+# most MAX_HEDGE_SHARE of the tasks are hedged (each hedge is an extra invocation to pay for)
+HEDGE_QUANTILE = 0.9
+HEDGE_SLACK = 1.5
+HEDGE_MIN_COMPLETED = 3
+MAX_HEDGE_SHARE = 0.1
+HEDGE_POLL_SECONDS = 0.05
 
 
-def invoke_lambda(json_payload_as_str: str):
+def get_executor():
+    global executor
+    if executor is None:
+        executor = executor_from_env()
+
+    return executor
+
+
+def set_executor(new_executor):
     """
-    Invoke our duckdb lambda function. Note that the payload is a string,
-    so the method should be called with json.dumps(payload)
+    Run the queries on a different backend, e.g. set_executor(LocalExecutor(workers=8)).
     """
-    response = lambda_client.invoke(
-        # the name of the lambda function should match what you have in your console
-        # if you did not change the serverless.yml file, it should be this one:
-        FunctionName='quack-reduce-lambda-dev-duckdb',
-        InvocationType='RequestResponse',
-        LogType='Tail',
-        Payload=json_payload_as_str
-    )
+    global executor, s3_client
+    executor = new_executor
+    # the s3 client must look at the same data as the executor
+    s3_client = None
+
+    return
+
+
+def get_rollups() -> list:
+    global rollups
+    if rollups is None:
+        rollups = load_rollups(os.environ['S3_BUCKET_NAME']) if os.environ.get('S3_BUCKET_NAME') else []
+
+    return rollups
+
+
+def exact_approximation(approximate):
+    """
+    The approximate options for a query routed to a rollup: the whole rollup is "sampled", so
+    the answer stays exact, whatever sample the caller asked for.
+    """
+    if not approximate:
+        return None
+    options = approximate if isinstance(approximate, dict) else {}
+
+    return { **options, 'sample_percent': 100 }
+
+
+def get_s3_client():
+    global s3_client
+    if s3_client is None:
+        _executor = get_executor()
+        s3_client = _executor.s3_client() if hasattr(_executor, 's3_client') else boto3.client('s3')
+
+    return s3_client
+
+
+def invoke_lambda(json_payload_as_str: str, backend=None):
+    """
+    Invoke our duckdb lambda function (or the configured backend). Note that the payload
+    is a string, so the method should be called with json.dumps(payload)
+    """
+    return (backend or get_executor()).invoke(json_payload_as_str)
+
+
+def is_retryable(error: Exception = None, response: dict = None) -> bool:
+    if error is not None:
+        if not isinstance(error, ClientError):
+            # connection errors, read timeouts etc.
+            return True
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return error.response.get('Error', {}).get('Code') in RETRYABLE_ERROR_CODES or status >= 500
+
+    return response.get('errorType', 'Runtime.Unknown').startswith(RETRYABLE_FUNCTION_ERRORS)
+
+
+async def invoke_lambda_async(
+    payloads: list,
+    concurrency: int = 20,
+    max_retries: int = 5,
+    base_delay: float = 0.2,
+    max_delay: float = 10.0,
+    on_result=None,
+    hedge: bool = False,
+    hedge_quantile: float = HEDGE_QUANTILE,
+    max_hedge_share: float = MAX_HEDGE_SHARE
+) -> list:
+    """
+    Invoke the lambda once per payload, with at most `concurrency` calls in flight.
+
+    boto3 is not async, so each call runs in a thread: the thread pool and the HTTP
+    connection pool of the lambda client are sized as the semaphore, so we never queue on (or
+    oversubscribe) connections. Throttles, 5xx and transient function errors are retried
+    per task, with full jitter exponential backoff, while the other tasks keep going.
+
+    Return one dict per payload, in order, with the response (None if the task failed
+    after all its retries), the last error, the number of attempts and the time in ms.
+
+    If on_result is given, it's called with (index, response) as soon as each task succeeds,
+    e.g. to combine partial results while the other tasks are still running. It runs in a
+    thread of its own, one call at a time, so that its downloads and compactions do not hold
+    up the event loop (and it does not have to be thread-safe).
+
+    With hedge=True, a task running longer than the hedge_quantile of the tasks completed so
+    far (times HEDGE_SLACK) gets a duplicate invocation, and the first response wins: a cold
+    start or a slow GET no longer sets the time of the whole batch. Duplicates are identical
+    queries, so either response will do, and on_result and the returned list only ever see one
+    of them. Duplicates do not wait for the slots of the tasks still queued, they have their
+    own (max_hedges), and as soon as a task has its response the other invocation is cancelled:
+    it gives up its slot and its retries, but a call already in flight still runs (and costs)
+    until the lambda returns, so at most max_hedge_share of the tasks are hedged. The tasks
+    report whether they were hedged and by whom they were won.
+    """
+    max_hedges = int(len(payloads) * max_hedge_share) if hedge else 0
+    # the primaries, the duplicates, and the losing calls we stopped waiting for: a thread
+    # (and a connection) each, until the lambda returns
+    max_workers = concurrency + 2 * max_hedges
+    backend = get_executor().with_concurrency(max_workers)
+    semaphore = asyncio.Semaphore(concurrency)
+    hedge_semaphore = asyncio.Semaphore(max(max_hedges, 1))
+    loop = asyncio.get_running_loop()
+    # times of the completed tasks, the base of the hedging threshold
+    completed_ms = []
+    hedges = { 'launched': 0 }
+
+    async def invoke_with_retries(payload: str, executor: ThreadPoolExecutor, started: dict, slots: asyncio.Semaphore) -> tuple:
+        attempts = 0
+        while True:
+            attempts += 1
+            error, response = None, None
+            # hold the slot only while invoking, not while backing off
+            async with slots:
+                # the task is running from here, time waiting for a slot does not count
+                started.setdefault('at', time.time())
+                try:
+                    response = await loop.run_in_executor(executor, invoke_lambda, payload, backend)
+                except Exception as e:
+                    error = e
+            if error is None and 'errorMessage' not in response:
+                break
+            retryable = is_retryable(error=error, response=response)
+            if not retryable or attempts > max_retries:
+                break
+            delay = min(max_delay, base_delay * 2 ** (attempts - 1))
+            await asyncio.sleep(random.uniform(0, delay))
+
+        return response, error, attempts
+
+    def hedge_threshold_ms():
+        # wait for a few tasks to complete before trusting the distribution
+        if len(completed_ms) < max(HEDGE_MIN_COMPLETED, int(len(payloads) * 0.1)):
+            return None
+        times = sorted(completed_ms)
+
+        return times[min(int(len(times) * hedge_quantile), len(times) - 1)] * HEDGE_SLACK
+
+    async def run_task(idx: int, payload: str, executor: ThreadPoolExecutor) -> dict:
+        start_time = time.time()
+        started = {}
+        primary = asyncio.ensure_future(invoke_with_retries(payload, executor, started, semaphore))
+        running = [primary]
+        duplicate = None
+        while True:
+            timeout = None
+            if duplicate is None and hedges['launched'] < max_hedges:
+                threshold = hedge_threshold_ms()
+                # until the task runs and we have a threshold, check again every now and then
+                timeout = HEDGE_POLL_SECONDS
+                if threshold is not None and 'at' in started:
+                    timeout = max(threshold / 1000.0 - (time.time() - started['at']), 0)
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                threshold = hedge_threshold_ms()
+                is_slow = threshold is not None and 'at' in started and (time.time() - started['at']) * 1000.0 >= threshold
+                if is_slow and hedges['launched'] < max_hedges:
+                    hedges['launched'] += 1
+                    duplicate = asyncio.ensure_future(invoke_with_retries(payload, executor, {}, hedge_semaphore))
+                    running.append(duplicate)
+                continue
+            winner = primary if primary in done else duplicate
+            response, error, attempts = winner.result()
+            running.remove(winner)
+            # if the first one to finish failed, the other one may still succeed
+            if (error is None and 'errorMessage' not in response) or not running:
+                break
+        # the loser, if any, is not needed anymore
+        for task in running:
+            task.cancel()
+        succeeded = error is None and 'errorMessage' not in response
+        if succeeded:
+            completed_ms.append((time.time() - started.get('at', start_time)) * 1000.0)
+        if on_result is not None and succeeded:
+            await loop.run_in_executor(results_executor, on_result, idx, response)
+
+        return {
+            'index': idx,
+            'response': response if succeeded else None,
+            'error': str(error) if error is not None else (response or {}).get('errorMessage'),
+            'attempts': attempts,
+            'timeMs': int((time.time() - start_time) * 1000.0),
+            'hedged': duplicate is not None,
+            'hedgeWon': duplicate is not None and winner is duplicate
+        }
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    results_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        return await asyncio.gather(*[run_task(i, p, executor) for i, p in enumerate(payloads)])
+    finally:
+        # do not wait for the losing calls: their responses are not needed
+        executor.shutdown(wait=False)
+        results_executor.shutdown(wait=True)
+
+
+def hedging_report(tasks: list, max_hedge_share: float = MAX_HEDGE_SHARE) -> dict:
+    hedged = sum(1 for task in tasks if task.get('hedged'))
+
+    return {
+        'hedgedTasks': hedged,
+        'hedgesWon': sum(1 for task in tasks if task.get('hedgeWon')),
+        # every hedge is one extra invocation, whether it wins or not
+        'extraInvocations': hedged,
+        'extraInvocationShare': round(hedged / len(tasks), 3) if tasks else 0.0,
+        'maxHedgeShare': max_hedge_share
+    }
+
+
+def invoke_many(payloads: list, concurrency: int = 20, **kwargs) -> list:
+    """
+    Sync wrapper around invoke_lambda_async, for scripts and the dashboard.
+    """
+    return asyncio.run(invoke_lambda_async(payloads, concurrency=concurrency, **kwargs))
+
+
+def decode_columnar_payload(data: dict) -> pa.Table:
+    """
+    Decode the base64 payload returned by the lambda when the format is arrow or parquet.
+
+    The arrow IPC stream is read in place: the table columns point to the decoded buffer,
+    so (when the stream is not compressed) there is no copy into a new table or DataFrame.
+    """
+    buffer = pa.py_buffer(base64.b64decode(data['payload']))
+    if data['format'] == 'parquet':
+        return pq.read_table(pa.BufferReader(buffer))
+
+    return pa.ipc.open_stream(buffer).read_all()
+
+
+class ResultCursor:
+    """
+    Lazy reader for results the lambda delivered as parquet files in the bucket: files are
+    downloaded one at a time, when the iteration gets there, and read batch by batch.
+    """
+
+    def __init__(self, data: dict, s3_client, batch_size: int = 65536):
+        self.files = data['files']
+        self.rows = data['rows']
+        self.schema = data['schema']
+        self.location = data['location']
+        self.s3_client = s3_client
+        self.batch_size = batch_size
+        self._batches = self._iter_batches()
+        self._buffer = None
+
+    def _iter_batches(self):
+        for f in self.files:
+            bucket, key = f['path'][len('s3://'):].split('/', 1)
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            parquet_file = pq.ParquetFile(pa.BufferReader(body))
+            for batch in parquet_file.iter_batches(batch_size=self.batch_size):
+                yield batch
+
+    def __iter__(self):
+        """
+        Iterate over the (remaining) arrow record batches.
+        """
+        if self._buffer is not None and self._buffer.num_rows:
+            yield from self._buffer.to_batches()
+            self._buffer = None
+        yield from self._batches
+
+    def fetch_page(self, page_size: int) -> pa.Table:
+        """
+        Return the next page_size rows as an arrow table (empty when we are done).
+        """
+        tables = [self._buffer] if self._buffer is not None else []
+        rows = self._buffer.num_rows if self._buffer is not None else 0
+        while rows < page_size:
+            batch = next(self._batches, None)
+            if batch is None:
+                break
+            tables.append(pa.Table.from_batches([batch]))
+            rows += batch.num_rows
+        if not tables:
+            return pa.table({})
+        table = pa.concat_tables(tables)
+        self._buffer = table.slice(page_size)
+
+        return table.slice(0, page_size)
+
+    def to_arrow(self) -> pa.Table:
+        """
+        Read all the (remaining) rows.
+        """
+        return pa.Table.from_batches(list(self))
 
-    # return response as dict
-    return json.loads(response['Payload'].read().decode("utf-8"))
+
+def response_to_table(response: dict) -> pa.Table:
+    """
+    Read the data of a response as an arrow table, whatever the format and delivery.
+    """
+    data = response['data']
+    if 'files' in data:
+        return ResultCursor(data, get_s3_client()).to_arrow()
+    if 'payload' in data:
+        return decode_columnar_payload(data)
+
+    return pa.Table.from_pylist(data['records'])
 
 
 def fetch_all(
     query: str,
     limit: int,
     display: bool=False,
-    is_debug = False
-)-> pd.DataFrame:
+    is_debug = False,
+    response_format: str='json',
+    compression: str=None,
+    use_manifest: bool=False,
+    delivery: str='inline',
+    lazy: bool=False,
+    use_cache: bool=True,
+    profile: bool=False,
+    cache_ttl: float=None,
+    params: list=None,
+    template_id: str=None,
+    use_rollups: bool=True,
+    approximate=None,
+    resources: dict=None,
+    use_file_cache: bool=False
+):
     """
-    Get results from lambda and display them
+    Get results from lambda and display them.
+
+    With the default json format we return a pandas DataFrame, with arrow / parquet
+    we return the arrow table decoded from the columnar payload.
+
+    If use_manifest is True, the lambda replaces glob scans with the (pruned) list of
+    files from the dataset manifest.
+
+    With delivery s3 (or auto, for results over the size threshold) the lambda writes the
+    results as parquet files in the bucket: with lazy=True we return a ResultCursor to
+    stream / page through them, otherwise we read them all. A None limit means all rows.
+
+    With use_cache=False the lambda skips its result cache (e.g. when benchmarking), with
+    profile=True it returns the execution profile of the query in metadata['profile'].
+
+    With a cache_ttl (in seconds), results are cached on this side too, and identical
+    queries in flight share one invocation (see fetch_cached).
+
+    With params (a list, possibly empty), the query is a template with $1, $2... placeholders:
+    the lambda prepares it once per container and binds the params as typed literals, so
+    user input never ends up in the SQL (see serverless/templates.py).
+
+    With use_rollups, aggregate queries that a rollup materialized by dbt can answer exactly
+    are rewritten to read it instead of the raw data (see router.py): metadata['rollup']
+    says which one, and has the original query.
+
+    With approximate (True, or a dict with sample_percent, confidence, method and seed), the
+    lambda answers aggregate queries from a sample of the rows, with sketches for distinct
+    counts and quantiles, and adds the {alias}_low / {alias}_high confidence bounds of every
+    aggregate to the results (see serverless/approximate.py): metadata['approximate'] says
+    what was approximated. A rollup is exact and cheap, so routed queries read all of it.
+
+    With resources (e.g. { 'memory_limit_mb': 2500, 'threads': 1 }), the lambda runs this
+    query with more memory or fewer threads than its defaults (see serverless/resources.py).
+    metadata['resources'] reports the peak memory and the bytes spilled to /tmp; a query
+    running out of memory fails with an OutOfMemory error, which has them too.
+
+    With use_file_cache, a warm lambda downloads the whole files of the query to its disk, and
+    the next queries on them read them from there (see serverless/file_cache.py): worth it
+    for queries reading most of their files, again and again, not for selective ones.
     """
+    if use_rollups and params is None:
+        routed_query, rollup = route_query(query, get_rollups(), get_s3_client())
+        if rollup is not None:
+            if display or is_debug:
+                print(f"Reading rollup {rollup['name']}: {routed_query}")
+            results, metadata = fetch_all(
+                routed_query,
+                limit,
+                display=display,
+                is_debug=is_debug,
+                response_format=response_format,
+                compression=compression,
+                use_manifest=use_manifest,
+                delivery=delivery,
+                lazy=lazy,
+                use_cache=use_cache,
+                profile=profile,
+                cache_ttl=cache_ttl,
+                use_rollups=False,
+                approximate=exact_approximation(approximate),
+                resources=resources,
+                use_file_cache=use_file_cache
+            )
+            return results, { **metadata, 'rollup': rollup }
+    if cache_ttl is not None and not lazy and not profile:
+        return fetch_cached(
+            query,
+            limit,
+            cache_ttl,
+            display=display,
+            is_debug=is_debug,
+            response_format=response_format,
+            compression=compression,
+            use_manifest=use_manifest,
+            delivery=delivery,
+            use_cache=use_cache,
+            params=params,
+            template_id=template_id,
+            approximate=approximate,
+            resources=resources,
+            use_file_cache=use_file_cache
+        )
     if is_debug:
-        print(f"Running query: {query}, with limit: {limit}")
+        print(f"Running query: {query}, with limit: {limit}, format: {response_format}")
     # run the query
     start_time = time.time()
-    response = invoke_lambda(json.dumps({'q': query, 'limit': limit}))
+    if params is None:
+        payload = {'q': query, 'limit': limit}
+    else:
+        payload = {'template': query, 'template_id': template_id, 'params': params, 'limit': limit}
+    if response_format != 'json':
+        payload['format'] = response_format
+        payload['compression'] = compression
+    if use_manifest:
+        payload['manifest'] = True
+    if delivery != 'inline':
+        payload['delivery'] = delivery
+    if not use_cache:
+        payload['cache'] = False
+    if profile:
+        payload['profile'] = True
+    if approximate:
+        payload['approximate'] = approximate
+    if resources:
+        payload.update(resources)
+    if use_file_cache:
+        payload['file_cache'] = True
+    response = invoke_lambda(json.dumps(payload))
     roundtrip_time =  int((time.time() - start_time) * 1000.0)
     # check for errors first
     if 'errorMessage' in response:
         print(f"Error: {response['errorMessage']}")
+        if response.get('errorType') in ('OutOfMemory', 'OutOfDisk'):
+            print(f"Resources of the query: {response['metadata']['resources']}")
         # just raise an exception now as we don't have a proper error handling
         raise Exception(response['errorMessage'])
     # no error returned, display the results
     if is_debug:
         print(f"Debug reponse: {response}")
 
-    rows = response['data']['records']
     # add the roundtrip time to the metadata
     response['metadata']['roundtrip_time'] = roundtrip_time
+    results, rows = read_response(response, response_format, display, lazy)
     # display in the console if required
     if display:
         console = Console()
         display_query_metadata(console, response['metadata'])
         display_table(console, rows)
     
-    # return the results as a pandas dataframe and metadata
-    return pd.DataFrame(rows), response['metadata']
+    # return the results (dataframe or arrow table) and metadata
+    return results, response['metadata']
+
+
+def read_response(response: dict, response_format: str, display: bool=False, lazy: bool=False):
+    """
+    Turn the data of a response into results (dataframe, arrow table or ResultCursor), plus
+    the first rows to display in the terminal.
+    """
+    if 'files' in response['data']:
+        response['metadata']['delivery'] = response['data']['location']
+        results = ResultCursor(response['data'], get_s3_client())
+        rows = results.fetch_page(MAX_ROWS_IN_TERMINAL).to_pylist() if display else []
+        if not lazy:
+            results = results.to_arrow()
+            results = results if response_format != 'json' else results.to_pandas()
+    elif 'payload' in response['data']:
+        results = decode_columnar_payload(response['data'])
+        # we only need to render the first few rows in the terminal
+        rows = results.slice(0, MAX_ROWS_IN_TERMINAL).to_pylist()
+    else:
+        rows = response['data']['records']
+        results = pd.DataFrame(rows)
+
+    return results, rows
+
+
+def fetch_many(
+    queries: list,
+    limit: int=None,
+    display: bool=False,
+    is_debug: bool=False,
+    response_format: str='json',
+    compression: str=None,
+    use_manifest: bool=False,
+    delivery: str='inline',
+    use_cache: bool=True,
+    cache_ttl: float=None
+):
+    """
+    Run many queries in a single invocation, e.g. all the charts of a dashboard page: one
+    round trip instead of one per query.
+
+    Queries are SQL strings or dicts with the same keys as the lambda event (e.g.
+    {'template': ..., 'template_id': ..., 'params': [...], 'limit': 5}): the arguments are
+    the defaults for all of them. We return a list with, for each query, results and metadata
+    as in fetch_all; a failed query has None results and its errorMessage in the metadata,
+    the others are not affected.
+
+    With a cache_ttl (in seconds), the whole batch goes through the client cache, unless
+    some query failed.
+    """
+    queries = [q if isinstance(q, dict) else { 'q': q } for q in queries]
+    if cache_ttl is not None and all(is_cacheable(q.get('q') or q.get('template') or '') for q in queries):
+        start_time = time.time()
+        key = build_cache_key(
+            'batch',
+            [],
+            queries=[
+                client_cache_key(
+                    q.get('q') or q.get('template'),
+                    q.get('limit', limit),
+                    **{ k: v for k, v in q.items() if k not in ('q', 'limit') }
+                )
+                for q in queries
+            ],
+            limit=limit,
+            response_format=response_format,
+            compression=compression,
+            use_manifest=use_manifest,
+            delivery=delivery
+        )
+        responses, status = query_cache.get_or_run(
+            key,
+            cache_ttl,
+            lambda: invoke_batch(queries, limit, is_debug, response_format, compression, use_manifest, delivery, use_cache),
+            should_cache=lambda value: not any('errorMessage' in r for r in value['data']['results'])
+        )
+        # each call reads its own copy of the results
+        responses = json.loads(json.dumps(responses))
+        responses['metadata'].update({
+            'clientCache': status,
+            'clientCacheHitRatio': query_cache.stats()['hitRatio'],
+            'clientCacheLatencyMs': int((time.time() - start_time) * 1000.0)
+        })
+    else:
+        responses = invoke_batch(queries, limit, is_debug, response_format, compression, use_manifest, delivery, use_cache)
+    batch_metadata = responses['metadata']
+    fetched = []
+    console = Console() if display else None
+    for response in responses['data']['results']:
+        # the batch metadata (round trip, cold start, cache) is shared by all the queries
+        response['metadata'] = { **response['metadata'], 'batch': { k: v for k, v in batch_metadata.items() if k != 'eventId' } }
+        if 'errorMessage' in response:
+            print(f"Error: {response['errorMessage']}")
+            fetched.append((None, { **response['metadata'], 'errorMessage': response['errorMessage'] }))
+            continue
+        results, rows = read_response(response, response_format, display)
+        if display:
+            display_query_metadata(console, response['metadata'])
+            display_table(console, rows)
+        fetched.append((results, response['metadata']))
+
+    return fetched
+
+
+def invoke_batch(
+    queries: list,
+    limit: int,
+    is_debug: bool,
+    response_format: str,
+    compression: str,
+    use_manifest: bool,
+    delivery: str,
+    use_cache: bool
+) -> dict:
+    payload = {'queries': queries, 'limit': limit}
+    if response_format != 'json':
+        payload['format'] = response_format
+        payload['compression'] = compression
+    if use_manifest:
+        payload['manifest'] = True
+    if delivery != 'inline':
+        payload['delivery'] = delivery
+    if not use_cache:
+        payload['cache'] = False
+    if is_debug:
+        print(f"Running {len(queries)} queries in one invocation: {payload}")
+    start_time = time.time()
+    response = invoke_lambda(json.dumps(payload))
+    roundtrip_time = int((time.time() - start_time) * 1000.0)
+    # errors of the whole invocation (e.g. a timeout), not of a single query
+    if 'errorMessage' in response:
+        print(f"Error: {response['errorMessage']}")
+        raise Exception(response['errorMessage'])
+    if is_debug:
+        print(f"Debug reponse: {response}")
+    response['metadata']['roundtrip_time'] = roundtrip_time
+
+    return response
+
+
+def client_cache_key(query: str, limit: int, **params) -> str:
+    """
+    Same key as the lambda result cache: if we cannot check the version of the objects,
+    we rely on the TTL alone.
+    """
+    try:
+        versions = get_object_versions(get_s3_client(), query)
+    except Exception as e:
+        print(f"Could not check object versions, caching on the TTL only: {e}")
+        versions = []
+
+    return build_cache_key(query, versions, limit=limit, **params)
+
+
+def fetch_cached(
+    query: str,
+    limit: int,
+    ttl: float,
+    display: bool=False,
+    is_debug: bool=False,
+    **kwargs
+):
+    """
+    fetch_all through the client cache: return the cached results if they are fresher than
+    ttl seconds and the objects did not change, wait for an identical query in flight if
+    there is one, otherwise run the query. The metadata reports the cache status, the hit
+    ratio so far and the time the cache lookup (or wait) took.
+
+    The query is run as it is: routing it to a rollup is up to the caller (fetch_all).
+    """
+    start_time = time.time()
+    if not is_cacheable(query):
+        results, metadata = fetch_all(query, limit, is_debug=is_debug, use_rollups=False, **kwargs)
+        status = 'disabled'
+    else:
+        key = client_cache_key(query, limit, **kwargs)
+        (results, metadata), status = query_cache.get_or_run(
+            key,
+            ttl,
+            # fetch_all routed the query already (see router.py)
+            lambda: fetch_all(query, limit, is_debug=is_debug, use_rollups=False, **kwargs)
+        )
+    metadata = {
+        **metadata,
+        'clientCache': status,
+        'clientCacheHitRatio': query_cache.stats()['hitRatio'],
+        'clientCacheLatencyMs': int((time.time() - start_time) * 1000.0)
+    }
+    # dataframes are mutable and may be shared across sessions: hand out copies
+    results = results.copy() if isinstance(results, pd.DataFrame) else results
+    if display:
+        console = Console()
+        display_query_metadata(console, metadata)
+        rows = results.head(MAX_ROWS_IN_TERMINAL).to_dict('records') if isinstance(results, pd.DataFrame) else results.slice(0, MAX_ROWS_IN_TERMINAL).to_pylist()
+        display_table(console, rows)
+
+    return results, metadata
+
+
+def fetch_map_reduce(
+    query: str,
+    limit: int,
+    threads: int=20,
+    display: bool=False,
+    is_debug: bool=False,
+    use_manifest: bool=True,
+    use_cache: bool=True,
+    profile: bool=False,
+    fan_in: int=None,
+    schedule: str='size',
+    task_bytes: int=None,
+    hedge: bool=False,
+    approximate=None,
+    resources: dict=None,
+    use_file_cache: bool=False
+):
+    """
+    Run an aggregate query as map-reduce: one lambda per partition computes partial
+    states, and we combine them locally with duckdb, as they arrive (see combine.py). If the planner cannot split the query,
+    we fall back to a single invocation through fetch_all.
+
+    With a fan_in, partial results are reduced as a tree instead (see tree_reduce): map
+    tasks write them to the bucket, lambdas merge them fan_in at a time, level after level,
+    and only the last one returns data to us.
+
+    When the dataset has a manifest, partitions and files come from there instead of
+    listing the bucket. With profile=True, the profiles of the map tasks are aggregated
+    in metadata['profile'].
+
+    With the manifest and schedule='size', map tasks are sized by bytes rather than by
+    partition (see scheduler.py): the budget is task_bytes if given, otherwise it comes from
+    the lambda memory and the scan throughput observed in the previous queries.
+    schedule='partition' keeps one task per partition.
+
+    With hedge=True, straggling map tasks get a duplicate invocation and the first response
+    wins (see invoke_lambda_async): metadata['hedging'] reports the extra invocations.
+
+    With approximate (see fetch_all), map tasks sample their rows and return mergeable
+    sketches, and the results have the confidence bounds of every aggregate.
+
+    Resources and use_file_cache (see fetch_all) apply to every map task.
+    """
+    start_time = time.time()
+    # a rollup beats any amount of parallelism
+    routed_query, rollup = route_query(query, get_rollups(), get_s3_client())
+    if rollup is not None:
+        if display or is_debug:
+            print(f"Reading rollup {rollup['name']}: {routed_query}")
+        results, metadata = fetch_all(
+            routed_query,
+            limit,
+            display=display,
+            is_debug=is_debug,
+            use_manifest=use_manifest,
+            use_cache=use_cache,
+            profile=profile,
+            use_rollups=False,
+            approximate=exact_approximation(approximate),
+            resources=resources,
+            use_file_cache=use_file_cache
+        )
+        return results, { **metadata, 'rollup': rollup }
+    manifest = None
+    scans = find_glob_scans(query)
+    if use_manifest and len(scans) == 1:
+        manifest = load_manifest(get_s3_client(), dataset_root(scans[0][1]), cache=manifests)
+    if manifest and schedule == 'size' and not task_bytes:
+        memory_mb = getattr(get_executor(), 'memory_mb', DEFAULT_MEMORY_MB)
+        task_bytes = task_byte_budget(memory_mb, scan_throughput.bytes_per_second())
+    plan = plan_map_reduce(
+        query,
+        get_s3_client(),
+        manifest=manifest,
+        task_bytes=task_bytes if schedule == 'size' else None,
+        approximate=approximate
+    )
+    if not plan or not plan['map_queries']:
+        if is_debug:
+            print("The query cannot be split, running it as a single invocation")
+        return fetch_all(query, limit, display=display, is_debug=is_debug, use_manifest=use_manifest, use_cache=use_cache, profile=profile, approximate=approximate, resources=resources, use_file_cache=use_file_cache)
+    if is_debug:
+        print(f"Running {len(plan['map_queries'])} map queries, e.g.: {plan['map_queries'][0]}")
+        print(f"Combine query: {plan['combine_query']}")
+    # partials travel as arrow, so that list columns (COUNT DISTINCT) and types survive the trip:
+    # we want all the groups, and the big partial results go through the bucket
+    payloads = [
+        {'q': q, 'limit': None, 'format': 'arrow', 'delivery': 'auto', 'cache': use_cache, 'profile': profile, 'file_cache': use_file_cache, **(resources or {})}
+        for q in plan['map_queries']
+    ]
+    if fan_in:
+        # in a tree reduce, all partial results go through the bucket
+        results_root = tree_results_root(plan)
+        for idx, payload in enumerate(payloads):
+            payload.update({ 'delivery': 's3', 'results_location': f"{results_root}/level-0/{idx:05d}" })
+    # without a tree reduce, partial results are combined here as they arrive
+    combiner = Combiner(plan) if not fan_in else None
+
+    def combine_partial(idx: int, response: dict):
+        combiner.add(response_to_table(response))
+        # partial results delivered through the bucket are not needed anymore
+        if 'files' in response['data']:
+            delete_results([f['path'] for f in response['data']['files']])
+
+        return
+
+    tasks = invoke_many(
+        [json.dumps(p) for p in payloads],
+        concurrency=threads,
+        on_result=combine_partial if combiner else None,
+        hedge=hedge
+    )
+    # failed tasks were already retried, if some still failed there's not much we can do
+    errors = [task['error'] for task in tasks if task['response'] is None]
+    if errors:
+        print(f"Error: {errors[0]} ({len(errors)} failed map tasks)")
+        raise Exception(errors[0])
+    responses = [task['response'] for task in tasks]
+    # learn how fast the lambdas scan, for the budget of the next queries
+    for planned, response in zip(plan.get('tasks', []), responses):
+        scan_throughput.observe(planned['bytes'], response['metadata'].get('executeMs'))
+    combine_start = time.time()
+    reduce_responses = []
+    if fan_in:
+        df, reduce_responses = tree_reduce(plan, responses, fan_in, threads, results_root, profile, is_debug)
+        df = df.head(limit)
+    else:
+        # the final step is just another query, over the (compacted) partial results
+        df = combiner.result(limit)
+    combine_ms = int((time.time() - combine_start) * 1000.0)
+    metadata = {
+        'mapTasks': len(plan['map_queries']),
+        'partitions': len(plan['partitions']),
+        'manifest': plan.get('manifest'),
+        'query': query,
+        'maxTaskTimeMs': max(response['metadata']['timeMs'] for response in responses),
+        'warmTasks': sum(1 for response in responses if response['metadata']['warm']),
+        'retries': sum(task['attempts'] - 1 for task in tasks),
+        'taskTimesMs': [task['timeMs'] for task in tasks],
+        **({ 'schedule': plan['schedule'] } if plan.get('schedule') else {}),
+        **({ 'hedging': hedging_report(tasks) } if hedge else {}),
+        **({ 'combineCompactions': combiner.compactions } if combiner else {}),
+        **({ 'approximate': describe_approximation(plan['parsed']) } if approximate else {}),
+        'roundtrip_time': int((time.time() - start_time) * 1000.0)
+    }
+    if fan_in:
+        metadata.update({
+            'reduce': 'tree',
+            'fanIn': fan_in,
+            'reduceLevels': tree_reduce_depth(len(responses), fan_in),
+            'reduceTasks': len(reduce_responses),
+            'reduceTimeMs': combine_ms
+        })
+    if profile:
+        metadata['profile'] = merge_profiles([r['metadata'].get('profile') for r in responses + reduce_responses])
+        if metadata['profile']:
+            metadata['profile']['combineMs'] = combine_ms
+    if display:
+        console = Console()
+        display_query_metadata(console, metadata)
+        display_table(console, df.head(MAX_ROWS_IN_TERMINAL).to_dict('records'))
+
+    return df, metadata
+
+
+def delete_results(paths: list):
+    """
+    Delete result files we are done with, e.g. the partial results of a map-reduce query, in
+    batches of 1000 keys. Failures are not fatal: the results/ prefix expires anyway (see
+    serverless.yml).
+    """
+    keys = {}
+    for path in paths:
+        bucket, key = split_s3_uri(path)
+        keys.setdefault(bucket, []).append(key)
+    for bucket, bucket_keys in keys.items():
+        for i in range(0, len(bucket_keys), 1000):
+            batch = bucket_keys[i:i + 1000]
+            try:
+                get_s3_client().delete_objects(Bucket=bucket, Delete={ 'Objects': [{ 'Key': k } for k in batch], 'Quiet': True })
+            except Exception as e:
+                print(f"Could not delete {len(batch)} result files in {bucket}: {e}")
+
+    return
+
+
+def delete_results_under(location: str):
+    """
+    Delete everything under a results location, including the files of the invocations whose
+    response we never read (e.g. the losers of a hedged task).
+    """
+    bucket, prefix = split_s3_uri(location.rstrip('/') + '/')
+    paths = []
+    try:
+        for page in get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            paths += [f"s3://{bucket}/{o['Key']}" for o in page.get('Contents', [])]
+    except Exception as e:
+        print(f"Could not list the result files under {location}: {e}")
+    delete_results(paths)
+
+    return
+
+
+def tree_results_root(plan: dict) -> str:
+    """
+    Partial results of a tree reduce go in the results folder of the dataset bucket.
+    """
+    bucket, _ = split_s3_uri(plan['parsed']['scan_path'])
+
+    return f"s3://{bucket}/results/tree-{uuid.uuid4()}"
+
+
+def tree_reduce(
+    plan: dict,
+    map_responses: list,
+    fan_in: int,
+    threads: int,
+    results_root: str,
+    profile: bool=False,
+    is_debug: bool=False
+):
+    """
+    Reduce the partial results written by the map tasks in the lambdas: every level merges
+    (up to) fan_in partial results into one, until fan_in or less are left, and the last
+    lambda combines those into the final results. The depth follows from the fan-in and the
+    number of map tasks (see planner.tree_reduce_depth).
+
+    Return the final results as a DataFrame, and the responses of the reduce tasks. The inputs
+    of each level are deleted once it has read them, the last ones once the final results are in.
+    """
+    inputs = [[f['path'] for f in response['data']['files']] for response in map_responses]
+    reduce_responses = []
+    level = 0
+    while len(inputs) > fan_in:
+        level += 1
+        groups = [inputs[i:i + fan_in] for i in range(0, len(inputs), fan_in)]
+        payloads = [
+            json.dumps({
+                'q': build_merge_query(plan['parsed'], parquet_files_source([p for paths in group for p in paths])),
+                'limit': None,
+                'delivery': 's3',
+                'results_location': f"{results_root}/level-{level}/{idx:05d}",
+                # inputs are new files every time, nothing to gain from the cache
+                'cache': False,
+                'profile': profile
+            })
+            for idx, group in enumerate(groups)
+        ]
+        if is_debug:
+            print(f"Reduce level {level}: {len(payloads)} merge tasks")
+        tasks = invoke_many(payloads, concurrency=threads)
+        errors = [task['error'] for task in tasks if task['response'] is None]
+        if errors:
+            print(f"Error: {errors[0]} ({len(errors)} failed merge tasks at level {level})")
+            raise Exception(errors[0])
+        reduce_responses += [task['response'] for task in tasks]
+        # this level read its inputs, they are not needed anymore
+        delete_results([p for paths in inputs for p in paths])
+        inputs = [[f['path'] for f in task['response']['data']['files']] for task in tasks]
+    # the last level returns the final (usually small) results: big ones still go through the bucket
+    combine_query = build_combine_query(plan['parsed'], parquet_files_source([p for paths in inputs for p in paths]))
+    table, metadata = fetch_all(combine_query, None, response_format='arrow', delivery='auto', use_cache=False, profile=profile)
+    reduce_responses.append({ 'metadata': metadata })
+    # the final results are in memory: the inputs of the last level can go, with whatever was
+    # left behind by the invocations whose response we did not read (e.g. hedges)
+    delete_results_under(results_root)
+    if metadata.get('delivery'):
+        delete_results_under(metadata['delivery'])
+
+    # through duckdb, so that types map to pandas as in the local combine (e.g. HUGEINT sums)
+    return duckdb.arrow(table).df(), reduce_responses
 
 
 def display_query_metadata(
@@ -92,8 +1022,41 @@ def display_query_metadata(
     few properties (total time, echo of the query, is warm, etc.)
     """
     # NOTE: we cut to 25 max the field values, to avoid the table to be too wide
-    values = [{ 'Field': k, 'Value': str(v)[:50] } for k, v in metadata.items()]
+    values = [{ 'Field': k, 'Value': str(v)[:50] } for k, v in metadata.items() if k != 'profile']
     display_table(console, values, title="Metadata", color="cyan")
+    if metadata.get('profile'):
+        display_profile(console, metadata['profile'])
+
+    return
+
+
+def display_profile(
+        console: Console,
+        profile: dict
+        ):
+    """
+    Display the execution profile as a breakdown: time by duckdb operator (summed over
+    the tasks for map-reduce queries), then I/O, serialization and memory.
+    """
+    total_ms = sum(v['timeMs'] for v in profile.get('operators', {}).values()) or 1
+    operators = sorted(profile.get('operators', {}).items(), key=lambda o: -o[1]['timeMs'])
+    display_table(console, [
+        { 'Operator': name, 'Time (ms)': v['timeMs'], 'Share': f"{100.0 * v['timeMs'] / total_ms:.1f}%", 'Rows': v['rows'] }
+        for name, v in operators
+    ], title="Profile", color="magenta")
+    s3 = profile.get('s3', {})
+    breakdown = {
+        'tasks': profile.get('tasks', 1),
+        'query time (ms)': profile.get('totalMs'),
+        'rows scanned': profile.get('rowsScanned'),
+        's3 requests': f"{s3.get('requests', 0)} {s3.get('byOperation', {})}",
+        's3 bytes read': s3.get('bytesRead', 0),
+        **{ k: v for k, v in (profile.get('pruning') or {}).items() },
+        'serialize (ms)': profile.get('serializeMs'),
+        'combine (ms)': profile.get('combineMs', '-'),
+        'peak memory (MB)': profile.get('peakRssMb')
+    }
+    display_table(console, [{ 'Field': k, 'Value': str(v) } for k, v in breakdown.items()], title="Profile breakdown", color="magenta")
 
     return
 
@@ -128,7 +1091,20 @@ def runner(
     bucket: str,
     query: str=None,
     limit: int=10,
-    is_debug: bool = False
+    is_debug: bool = False,
+    response_format: str='json',
+    map_reduce: bool = False,
+    threads: int = 20,
+    use_manifest: bool = False,
+    delivery: str = 'inline',
+    profile: bool = False,
+    fan_in: int = None,
+    schedule: str = 'size',
+    task_mb: float = None,
+    hedge: bool = False,
+    approximate: dict = None,
+    resources: dict = None,
+    use_file_cache: bool = False
 ):
     """
     Run queries against our serverless (and stateless) database.
@@ -145,10 +1121,40 @@ def runner(
         target_file = f"s3://{bucket}/dataset/taxi_2019_04.parquet"
         query = f"SELECT COUNT(*) AS COUNTS FROM read_parquet(['{target_file}'])"
         # since this is a test query, we force debug to be True
-        rows, metadata = fetch_all(query, limit, display=True, is_debug=True)
+        rows, metadata = fetch_all(query, limit, display=True, is_debug=True, response_format=response_format)
+    elif map_reduce:
+        # split the query across the partitions of the dataset, if we can
+        rows, metadata = fetch_map_reduce(
+            query,
+            limit,
+            threads=threads,
+            display=True,
+            is_debug=is_debug,
+            use_manifest=use_manifest,
+            profile=profile,
+            fan_in=fan_in,
+            schedule=schedule,
+            task_bytes=int(task_mb * 1024 * 1024) if task_mb else None,
+            hedge=hedge,
+            approximate=approximate,
+            resources=resources,
+            use_file_cache=use_file_cache
+        )
     else:
         # run the query as it is
-        rows, metadata = fetch_all(query, limit, display=True, is_debug=is_debug)
+        rows, metadata = fetch_all(
+            query,
+            limit,
+            display=True,
+            is_debug=is_debug,
+            response_format=response_format,
+            use_manifest=use_manifest,
+            delivery=delivery,
+            profile=profile,
+            approximate=approximate,
+            resources=resources,
+            use_file_cache=use_file_cache
+        )
 
     return
 
@@ -169,6 +1175,79 @@ if __name__ == "__main__":
         type=int,
         help="max rows to return from the lambda",
         default=10)
+    parser.add_argument(
+        "-format",
+        type=str,
+        choices=['json', 'arrow', 'parquet'],
+        help="response format from the lambda (json records or a columnar payload)",
+        default='json')
+    parser.add_argument(
+        "--map-reduce",
+        action="store_true",
+        help="split aggregate queries over hive-partitioned data into parallel lambdas",
+        default=False)
+    parser.add_argument(
+        "-t",
+        type=int,
+        help="concurrent lambdas for map reduce",
+        default=20)
+    parser.add_argument(
+        "-fan-in",
+        type=int,
+        help="reduce map-reduce partial results as a tree in the lambdas, merging this many at a time",
+        default=None)
+    parser.add_argument(
+        "-schedule",
+        type=str,
+        choices=['size', 'partition'],
+        help="with a manifest, size map tasks by bytes (bin-packing and splitting files), or one per partition",
+        default='size')
+    parser.add_argument(
+        "-task-mb",
+        type=float,
+        help="bytes per map task (MB), instead of the budget from the lambda memory and observed throughput",
+        default=None)
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="send a duplicate invocation for straggling map tasks, and take the first response",
+        default=False)
+    parser.add_argument(
+        "-delivery",
+        type=str,
+        choices=['inline', 's3', 'auto'],
+        help="return results in the response, as parquet files in the bucket, or pick based on size",
+        default='inline')
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="use the dataset manifest to replace glob scans with pruned file lists",
+        default=False)
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="return (and display) the execution profile of the query",
+        default=False)
+    parser.add_argument(
+        "-approximate",
+        type=float,
+        help="answer aggregate queries from this percent of the rows, with confidence bounds and sketches",
+        default=None)
+    parser.add_argument(
+        "-memory-limit-mb",
+        type=int,
+        help="duckdb memory limit for this query in the lambda, instead of 75%% of the function memory",
+        default=None)
+    parser.add_argument(
+        "-duckdb-threads",
+        type=int,
+        help="duckdb threads for this query in the lambda, instead of one per vCPU",
+        default=None)
+    parser.add_argument(
+        "--file-cache",
+        action="store_true",
+        help="have the lambda download the files of the query to its disk, for the next queries on them",
+        default=False)
     parser.add_argument(
         "--debug", 
         action="store_true",
@@ -180,5 +1259,20 @@ if __name__ == "__main__":
         bucket=os.environ['S3_BUCKET_NAME'],
         query=args.q,
         limit=args.limit,
-        is_debug=args.debug
+        is_debug=args.debug,
+        response_format=args.format,
+        map_reduce=args.map_reduce,
+        threads=args.t,
+        use_manifest=args.manifest,
+        delivery=args.delivery,
+        profile=args.profile,
+        fan_in=args.fan_in,
+        schedule=args.schedule,
+        task_mb=args.task_mb,
+        hedge=args.hedge,
+        approximate={ 'sample_percent': args.approximate } if args.approximate else None,
+        resources={
+            k: v for k, v in (('memory_limit_mb', args.memory_limit_mb), ('threads', args.duckdb_threads)) if v
+        } or None,
+        use_file_cache=args.file_cache
     )
\ No newline at end of file
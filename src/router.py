@@ -0,0 +1,349 @@
+"""
+
+Aggregate-aware routing: answer aggregate queries from the rollups materialized by dbt
+(see dashboard/dbt), instead of scanning the raw data again.
+
+The registry (rollups.json) describes every rollup: where it is, the raw data it aggregates,
+its grain (raw expression -> rollup column), its measures (raw aggregate -> rollup column,
+and how partial values merge), the filters it was built with and, for "top k" tables, the
+measure they are sorted by and how many rows they keep. A query can be answered exactly
+from a rollup when:
+
+* it is an aggregate over the same source (see planner.parse_aggregate_query);
+* its group keys are in the grain of the rollup, and its WHERE is made of the filters of the
+  rollup plus simple predicates on grain columns;
+* each aggregate is a measure of the rollup, or MIN / MAX / COUNT DISTINCT of a grain column;
+* for a top k table: same grain, no other filter, and the query asks for at most the top k
+  rows by the same measure (rows tied at the cut may differ, as with any LIMIT).
+
+The rollup is then re-aggregated to the grain of the query, which is always correct, and cheap
+on a rollup. Among the rollups that can answer, the smallest object wins; when none can (or
+none is materialized yet), the query goes to the raw data as it is.
+
+A rollup is only as good as the data it was built from: its builders stamp it (in the parquet
+footer metadata) with its source and a fingerprint of the ETags of the source objects, and
+the router checks both against the source as it is now. A rollup without a stamp, built from
+another source or from older data is skipped. dbt cannot write footer metadata, so
+`python router.py --dbt` runs dbt and stamps what it wrote, if the source did not change
+during the run (incremental.py stamps its rollups itself).
+
+"""
+
+
+import os
+import re
+import json
+import hashlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+from planner import parse_aggregate_query
+from queryparse import find_top_level, split_between_aware, PREDICATE_PATTERN, BETWEEN_PATTERN
+from manifest import split_s3_uri
+from result_cache import get_object_versions
+
+
+DEFAULT_REGISTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rollups.json')
+# how partial values of each aggregate merge in a rollup
+MERGE_FUNCTIONS = { 'COUNT': 'SUM', 'SUM': 'SUM', 'MIN': 'MIN', 'MAX': 'MAX' }
+# footer metadata of a rollup: the source it was built from, and the version of that source
+SOURCE_KEY = b'quack.rollup.source'
+SOURCE_VERSION_KEY = b'quack.rollup.source_version'
+# (location, etag) -> stamp of the rollup, so that we read a footer once per version of the file
+stamps = {}
+
+
+def normalize_expression(expression: str) -> str:
+    collapsed = ' '.join(expression.split()).lower()
+
+    return re.sub(r"\s*([(),*])\s*", r"\1", collapsed)
+
+
+def load_rollups(bucket: str, path: str = DEFAULT_REGISTRY) -> list:
+    """
+    Read the registry, for the rollups in this bucket.
+    """
+    with open(path) as f:
+        registry = json.loads(f.read().replace('{bucket}', bucket))
+
+    return [
+        {
+            **rollup,
+            'grain': { normalize_expression(k): v for k, v in rollup['grain'].items() },
+            'measures': { normalize_expression(k): v for k, v in rollup['measures'].items() },
+            'filters': [normalize_expression(f) for f in rollup.get('filters', [])]
+        }
+        for rollup in registry['rollups']
+    ]
+
+
+def measure_column(rollup: dict, aggregate: str, argument: str):
+    measure = rollup['measures'].get(f"{aggregate.lower()}({argument})")
+    if measure is None or measure['merge'].upper() != MERGE_FUNCTIONS[aggregate]:
+        return None
+
+    return measure['column']
+
+
+def rollup_expression(item: dict, rollup: dict):
+    """
+    The expression computing a select item from the rollup, or None if it cannot.
+    """
+    if 'aggregate' not in item:
+        return rollup['grain'].get(normalize_expression(item['expression']))
+    aggregate, argument = item['aggregate'], normalize_expression(item['argument'])
+    grain_column = rollup['grain'].get(argument)
+    if aggregate in ('MIN', 'MAX') and grain_column:
+        return f"{aggregate}({grain_column})"
+    if aggregate == 'COUNT_DISTINCT':
+        return f"COUNT(DISTINCT {grain_column})" if grain_column else None
+    if aggregate == 'AVG':
+        total, count = measure_column(rollup, 'SUM', argument), measure_column(rollup, 'COUNT', argument)
+        return f"SUM({total}) / CAST(SUM({count}) AS DOUBLE)" if total and count else None
+    column = measure_column(rollup, aggregate, argument)
+    if column is None:
+        return None
+    if aggregate == 'COUNT':
+        # SUM of a BIGINT is a HUGEINT, a COUNT must stay a BIGINT
+        return f"CAST(SUM({column}) AS BIGINT)"
+
+    return f"{MERGE_FUNCTIONS[aggregate]}({column})"
+
+
+def rollup_predicates(where: str, rollup: dict):
+    """
+    The WHERE of the query on the rollup columns, as a list of conjunctions, or None if the
+    rollup cannot apply it exactly.
+    """
+    if where and find_top_level(where, 'OR'):
+        return None
+    conjuncts = []
+    for part in (split_between_aware(where) if where else []):
+        part = part.strip()
+        while part.startswith('(') and part.endswith(')'):
+            part = part[1:-1].strip()
+        conjuncts.append(part)
+    normalized = [normalize_expression(c) for c in conjuncts]
+    # the rollup only has the rows passing its filters: the query must ask for them too
+    if any(f not in normalized for f in rollup['filters']):
+        return None
+    predicates = []
+    for conjunct, normalized_conjunct in zip(conjuncts, normalized):
+        if normalized_conjunct in rollup['filters']:
+            continue
+        match = BETWEEN_PATTERN.match(conjunct) or PREDICATE_PATTERN.match(conjunct)
+        column = rollup['grain'].get(match.group(1).lower()) if match else None
+        if column is None:
+            return None
+        predicates.append(column + conjunct[len(match.group(1)):])
+
+    return predicates
+
+
+def top_allows(parsed: dict, rollup: dict, predicates: list) -> bool:
+    """
+    A top k table answers the same top k, or fewer rows, and nothing else.
+    """
+    top = rollup.get('top')
+    if not top:
+        return True
+    keys = { normalize_expression(i['expression']) for i in parsed['items'] if 'aggregate' not in i }
+    if predicates or keys != set(rollup['grain']) or not parsed['order_by']:
+        return False
+    if parsed['limit'] is None or parsed['limit'] > top['limit']:
+        return False
+    match = re.match(r"^(.*?)\s+DESC(\s+NULLS\s+\w+)?$", parsed['order_by'][0], re.IGNORECASE)
+    if not match:
+        return False
+    target = match.group(1).strip()
+    items = parsed['items']
+    item = items[int(target) - 1] if target.isdigit() else next((i for i in items if i['alias'] == target), None)
+    if item is None or item.get('aggregate') not in ('COUNT', 'SUM'):
+        return False
+
+    return f"{item['aggregate'].lower()}({normalize_expression(item['argument'])})" == normalize_expression(top['measure'])
+
+
+def rewrite_for_rollup(parsed: dict, rollup: dict):
+    """
+    The query reading the rollup instead of the raw data, or None if the rollup cannot answer.
+    """
+    predicates = rollup_predicates(parsed['where'], rollup)
+    if predicates is None or not top_allows(parsed, rollup, predicates):
+        return None
+    columns = []
+    keys = []
+    for idx, item in enumerate(parsed['items']):
+        expression = rollup_expression(item, rollup)
+        if expression is None:
+            return None
+        columns.append(f"{expression} AS {item['alias']}")
+        if 'aggregate' not in item:
+            keys.append(str(idx + 1))
+    query = f"SELECT {', '.join(columns)} FROM read_parquet(['{rollup['location']}'])"
+    if predicates:
+        query += f" WHERE {' AND '.join(predicates)}"
+    if keys:
+        query += f" GROUP BY {', '.join(keys)}"
+    if parsed['order_by']:
+        query += f" ORDER BY {', '.join(parsed['order_by'])}"
+    if parsed['limit'] is not None:
+        query += f" LIMIT {parsed['limit']}"
+
+    return query
+
+
+def source_fingerprint(files: dict) -> str:
+    """
+    The version of a source: a hash of the ETag of every object in it (path -> etag).
+    """
+    return hashlib.sha256(json.dumps(sorted(files.items())).encode('utf-8')).hexdigest()
+
+
+def source_version(s3_client, source: str) -> str:
+    return source_fingerprint({ v[0]: v[1] for v in get_object_versions(s3_client, f"'{source}'") })
+
+
+def stamp_table(table: pa.Table, source: str, version: str) -> pa.Table:
+    """
+    Add the source and its version to the metadata of the table, for the parquet footer.
+    """
+    metadata = { **(table.schema.metadata or {}), SOURCE_KEY: source.encode('utf-8'), SOURCE_VERSION_KEY: version.encode('utf-8') }
+
+    return table.replace_schema_metadata(metadata)
+
+
+def read_stamp(s3_client, location: str, etag: str) -> tuple:
+    """
+    Return (source, version) from the footer of the rollup, (None, None) if it has no stamp.
+    """
+    if (location, etag) not in stamps:
+        bucket, key = split_s3_uri(location)
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        metadata = pq.read_schema(pa.BufferReader(body)).metadata or {}
+        stamps[(location, etag)] = tuple(
+            metadata[k].decode('utf-8') if k in metadata else None for k in (SOURCE_KEY, SOURCE_VERSION_KEY)
+        )
+
+    return stamps[(location, etag)]
+
+
+def is_fresh(rollup: dict, etag: str, versions: dict, s3_client) -> bool:
+    """
+    True if the rollup was built from its source as it is now: versions caches the version
+    of the sources we already listed for this query.
+    """
+    source, version = read_stamp(s3_client, rollup['location'], etag)
+    if source != rollup['source'] or version is None:
+        return False
+    if source not in versions:
+        versions[source] = source_version(s3_client, source)
+
+    return version == versions[source]
+
+
+def route_query(query: str, rollups: list, s3_client) -> tuple:
+    """
+    Return the query to run and, if it was routed to a rollup, the info for the metadata.
+    """
+    parsed = parse_aggregate_query(query) if rollups else None
+    if not parsed:
+        return query, None
+    candidates = []
+    versions = {}
+    for rollup in rollups:
+        if rollup['source'] != parsed['scan_path']:
+            continue
+        rewritten = rewrite_for_rollup(parsed, rollup)
+        if rewritten is None:
+            continue
+        bucket, key = split_s3_uri(rollup['location'])
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+        except Exception:
+            # not materialized (yet): dbt run has not written it
+            continue
+        try:
+            fresh = is_fresh(rollup, head['ETag'], versions, s3_client)
+        except Exception as e:
+            print(f"Could not check the version of rollup {rollup['name']}, skipping it: {e}")
+            fresh = False
+        if not fresh:
+            # built from other (or older) data: the raw scan is slower, but right
+            continue
+        candidates.append((head['ContentLength'], rollup, rewritten))
+    if not candidates:
+        return query, None
+    size, rollup, rewritten = min(candidates, key=lambda c: c[0])
+
+    return rewritten, {
+        'name': rollup['name'],
+        'location': rollup['location'],
+        'bytes': size,
+        'candidates': len(candidates),
+        'originalQuery': query
+    }
+
+
+def stamp_rollup(s3_client, rollup: dict, version: str):
+    """
+    Rewrite the rollup with its source and version in the footer.
+    """
+    bucket, key = split_s3_uri(rollup['location'])
+    table = pq.read_table(pa.BufferReader(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()))
+    sink = pa.BufferOutputStream()
+    pq.write_table(stamp_table(table, rollup['source'], version), sink)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=sink.getvalue().to_pybytes())
+
+    return
+
+
+def run_dbt_and_stamp(bucket: str, s3_client, dbt_folder: str) -> list:
+    """
+    Run dbt, then stamp the rollups it (re)wrote with the version of their source, unless the
+    source changed while dbt was running: we can't know which version dbt read then, and an
+    unstamped rollup is simply not used. Return the names of the stamped rollups.
+    """
+    import subprocess
+
+    def etag(rollup: dict):
+        bucket, key = split_s3_uri(rollup['location'])
+        try:
+            return s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+        except Exception:
+            return None
+
+    rollups = load_rollups(bucket)
+    sources = { r['source'] for r in rollups }
+    before = { source: source_version(s3_client, source) for source in sources }
+    etags = { r['name']: etag(r) for r in rollups }
+    subprocess.run(['dbt', 'run'], cwd=dbt_folder, check=True, env={ **os.environ, 'S3_BUCKET_NAME': bucket })
+    after = { source: source_version(s3_client, source) for source in sources }
+    stamped = []
+    for rollup in rollups:
+        written = etag(rollup)
+        if written is None or written == etags[rollup['name']]:
+            # not built by dbt (e.g. by incremental.py), or not in this run
+            continue
+        if before[rollup['source']] != after[rollup['source']]:
+            print(f"{rollup['source']} changed during the run, {rollup['name']} is left unstamped")
+            continue
+        stamp_rollup(s3_client, rollup, after[rollup['source']])
+        stamped.append(rollup['name'])
+
+    return stamped
+
+
+if __name__ == "__main__":
+    assert 'S3_BUCKET_NAME' in os.environ, "Please set the S3_BUCKET_NAME environment variable"
+    import argparse
+    from quack import get_s3_client
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dbt",
+        action="store_true",
+        help="run dbt, and stamp the rollups it wrote with the version of their source",
+        default=False)
+    args = parser.parse_args()
+    if args.dbt:
+        dbt_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dashboard', 'dbt')
+        print(f"Stamped rollups: {run_dbt_and_stamp(os.environ['S3_BUCKET_NAME'], get_s3_client(), dbt_folder)}")
@@ -8,11 +8,16 @@ Check the README.md for more details and for the prerequisites.
 
 
 import os
+import sys
 
 import boto3
-import requests
-import pandas as pd
 from dotenv import load_dotenv
+from ingest import download_file, partition_dataset, upload_directory, describe_uploaded_files
+
+
+# the manifest code is shared with the lambda, and lives in the serverless folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serverless'))
+from manifest import build_manifest, collect_s3_files, write_manifest
 
 
 # get the environment variables from the .env file
@@ -21,10 +26,10 @@ load_dotenv()
 
 def donwload_data(url: str, target_file: str):
     """
-    Download a file from a url and save it to a target file.
+    Download a file from a url and save it to a target file, streaming it
+    to disk in chunks (monthly files don't need to fit in memory).
     """
-    r = requests.get(url)
-    open(target_file, 'wb').write(r.content)
+    download_file(url, target_file)
 
     return True
 
@@ -59,10 +64,10 @@ def upload_file_to_bucket(s3_client, file_name, bucket, object_name=None):
     return True
 
 
-def upload_datasets(s3_client, bucket: str, taxi_dataset_path: str):
+def upload_datasets(s3_client, bucket: str, taxi_dataset_path: str, layout: dict = None):
     """
     Upload the datasets to the bucket, first as one parquet file, then as
-    a directory of parquet files with hive partitioning.
+    a directory of parquet files with hive partitioning (and the given layout).
     """
     file_name = os.path.basename(taxi_dataset_path)
     # upload file as is, a single parquet file in the data/ folder of the target bucket
@@ -72,35 +77,61 @@ def upload_datasets(s3_client, bucket: str, taxi_dataset_path: str):
         bucket,
         object_name=f"dataset/{file_name}"
     )
-    is_uploaded = upload_partioned_dataset(
+    uploaded_files = upload_partioned_dataset(
+        s3_client,
         bucket, 
-        taxi_dataset_path
+        taxi_dataset_path,
+        layout=layout
         )
+    # any ingest writing to the partitioned folder should end by updating the manifest:
+    # we just wrote the files, so we describe them locally instead of reading them back
+    update_manifest(s3_client, bucket, files=describe_uploaded_files(uploaded_files))
 
     return
 
 
+def update_manifest(s3_client, bucket: str, prefix: str = 'partitioned', files: list = None):
+    """
+    Write the manifest of the partitioned dataset: partitions, files, sizes, row counts and
+    column statistics, so that queries can skip listing the bucket and reading footers.
+
+    If files are not given, they are listed and described from the bucket.
+    """
+    root = f"s3://{bucket}/{prefix}"
+    print(f"Writing the manifest for {root}")
+    manifest = build_manifest(root, files if files is not None else collect_s3_files(s3_client, root))
+    write_manifest(s3_client, manifest)
+    print(f"Manifest {manifest['snapshotId']} written with {len(manifest['files'])} files")
+
+    return manifest
+
+
 def upload_partioned_dataset(
+        s3_client,
         bucket: str,
         taxi_dataset_path: str,
-        partition_col: str = 'date'
+        partition_col: str = 'date',
+        local_dir: str = 'data/partitioned',
+        layout: dict = None
         ):
     """
-    Use pandas to read the parquet file, then save it again as a directory
-    on our s3 bucket. The final directory will have a subdirectory for each
-    value of the partition column, and each subdirectory will contain parquet files.
-    """
+    Stream the parquet file (one row group at a time) into a local directory with
+    a subdirectory for each value of the partition column, then upload the files
+    concurrently to our s3 bucket. Return the uploaded files (path, size, etag).
 
-    df = pd.read_parquet(taxi_dataset_path)
-    df[partition_col] = pd.to_datetime(df['pickup_at']).dt.date
+    The layout holds the clustering options of ingest.partition_dataset (sort_by,
+    z_order_by, buckets, bucket_by, rows_per_group), e.g. to sort the rows of each
+    day by pickup_location_id so that filters on it can skip row groups.
+    """
+    print(f"Partitioning data with hive partitioning ({partition_col}) in {local_dir}" + (f", layout {layout}" if layout else ""))
+    partition_dataset(taxi_dataset_path, local_dir, partition_col=partition_col, **(layout or {}))
     target_folder = os.path.join('s3://', bucket, 'partitioned')
-    print(f"Saving data with hive partitioning ({partition_col}) in {target_folder}")
-    df.to_parquet(target_folder, partition_cols=[partition_col])
+    print(f"Uploading the partitions to {target_folder}")
     
-    return True
+    return upload_directory(s3_client, local_dir, bucket, 'partitioned')
 
 
-def setup_project():
+def setup_project(manifest_only: bool = False, layout: dict = None):
     # check vars are ok
     assert 'S3_BUCKET_NAME' in os.environ, "Please set the S3_BUCKET_NAME environment variable"
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
@@ -108,6 +139,10 @@ def setup_project():
     AWS_PROFILE = os.environ.get('AWS_PROFILE')
     assert (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY) or AWS_PROFILE, "Please set the AWS_ACCESS_KEY_ID & AWS_SECRET_ACCESS_KEY (or the AWS_PROFILE) environment variables"
     
+    if manifest_only:
+        # the data is already in the bucket, just refresh the manifest
+        update_manifest(boto3.client('s3'), os.environ['S3_BUCKET_NAME'])
+        return
     # first download the data
     taxi_dataset_path = download_taxi_data()
     # upload the data to the bucket
@@ -115,7 +150,8 @@ def setup_project():
     upload_datasets(
         s3_client,
         os.environ['S3_BUCKET_NAME'],
-        taxi_dataset_path
+        taxi_dataset_path,
+        layout=layout
         )
     # all done
     print("All done! See you, duck cowboy!")
@@ -123,4 +159,46 @@ def setup_project():
 
 
 if __name__ == "__main__":
-    setup_project()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--manifest-only",
+        action="store_true",
+        help="only (re)write the manifest of the partitioned dataset",
+        default=False)
+    parser.add_argument(
+        "--sort-by",
+        type=str,
+        nargs='+',
+        help="sort the rows of each partition by these columns, e.g. pickup_location_id pickup_at",
+        default=None)
+    parser.add_argument(
+        "--z-order-by",
+        type=str,
+        nargs='+',
+        help="Z-order the rows of each partition by these columns (instead of sorting)",
+        default=None)
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        help="hash bucket each partition into this many files (needs --bucket-by)",
+        default=None)
+    parser.add_argument(
+        "--bucket-by",
+        type=str,
+        help="column to hash bucket on, e.g. pickup_location_id",
+        default=None)
+    parser.add_argument(
+        "--rows-per-group",
+        type=int,
+        help="target rows per parquet row group",
+        default=None)
+    args = parser.parse_args()
+    layout = {
+        'sort_by': args.sort_by,
+        'z_order_by': args.z_order_by,
+        'buckets': args.buckets,
+        'bucket_by': args.bucket_by,
+        'rows_per_group': args.rows_per_group
+    }
+    setup_project(manifest_only=args.manifest_only, layout={ k: v for k, v in layout.items() if v is not None })
\ No newline at end of file
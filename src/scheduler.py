@@ -0,0 +1,145 @@
+"""
+
+Size-aware scheduling of the map tasks of a map-reduce query (see planner.py).
+
+One task per partition is simple, but partitions are not all the same size (a Sunday has
+far fewer trips than a Friday), and the query is as slow as its biggest task. With the
+dataset manifest we know the size, the row count and the row groups of every file, so we
+can size the tasks instead:
+
+* small files (of any partition) are bin-packed into the same task, up to the budget;
+* files over the budget are split into ranges of row groups, each one a task of its own,
+  which reads only its rows (duckdb skips the other row groups with file_row_number).
+
+The budget, in (compressed) bytes per task, is what a lambda scans in the target task time:
+the scan throughput grows with the lambda memory (memory buys vCPUs), and once we have run
+some tasks we use the throughput we actually observed instead of the default estimate.
+
+"""
+
+
+import threading
+
+
+MB = 1024 * 1024
+# lambda gives one full vCPU every 1769 MB of memory
+MB_PER_VCPU = 1769
+# conservative parquet scan throughput from S3, per vCPU, until we observe the real one
+DEFAULT_SCAN_BYTES_PER_VCPU_SECOND = 48 * MB
+# how long we want a map task to take: long enough to amortize the invocation overhead
+DEFAULT_TARGET_TASK_SECONDS = 2.0
+# never give a task more compressed bytes than this share of the lambda memory
+MAX_MEMORY_SHARE = 0.5
+# weight of the last observation in the throughput moving average
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class ScanThroughput:
+    """
+    Moving average of the bytes per second scanned by the map tasks (per lambda).
+    """
+
+    def __init__(self):
+        self._bytes_per_second = None
+        self._lock = threading.Lock()
+
+    def observe(self, bytes_scanned: int, execute_ms: int):
+        # tiny tasks are all overhead, they say nothing about the scan speed
+        if not bytes_scanned or not execute_ms or execute_ms < 50:
+            return
+        observed = bytes_scanned / (execute_ms / 1000.0)
+        with self._lock:
+            if self._bytes_per_second is None:
+                self._bytes_per_second = observed
+            else:
+                self._bytes_per_second += THROUGHPUT_SMOOTHING * (observed - self._bytes_per_second)
+
+        return
+
+    def bytes_per_second(self):
+        with self._lock:
+            return self._bytes_per_second
+
+
+def task_byte_budget(
+    memory_mb: int,
+    scan_bytes_per_second: float = None,
+    target_task_seconds: float = DEFAULT_TARGET_TASK_SECONDS
+) -> int:
+    """
+    Bytes a task should scan: the observed throughput (or the default estimate for this
+    much memory) times the target task time, capped by the memory of the lambda.
+    """
+    if not scan_bytes_per_second:
+        scan_bytes_per_second = DEFAULT_SCAN_BYTES_PER_VCPU_SECOND * max(memory_mb / MB_PER_VCPU, 1.0)
+    budget = scan_bytes_per_second * target_task_seconds
+
+    return int(max(min(budget, memory_mb * MB * MAX_MEMORY_SHARE), 1 * MB))
+
+
+def split_file(entry: dict, budget_bytes: int) -> list:
+    """
+    Split a file over the budget into (first row, last row + 1, estimated bytes) ranges of
+    whole row groups: row groups are the smallest unit duckdb can skip.
+    """
+    row_group_rows = entry.get('rowGroupRows') or [entry['rows']]
+    bytes_per_row = entry['size'] / max(entry['rows'], 1)
+    ranges = []
+    start = end = 0
+    for rows in row_group_rows:
+        if end > start and (end + rows - start) * bytes_per_row > budget_bytes:
+            ranges.append((start, end, int((end - start) * bytes_per_row)))
+            start = end
+        end += rows
+    ranges.append((start, end, int((end - start) * bytes_per_row)))
+
+    return ranges
+
+
+def schedule_tasks(partitions: list, budget_bytes: int) -> list:
+    """
+    Turn the (partition values, files) pairs of the planner into tasks: each task is a dict
+    with its files, an optional row range (then it has exactly one file), its estimated bytes
+    and the partitions it touches. Tasks come biggest first, so that the slow ones start first.
+    """
+    tasks = []
+    whole_files = []
+    for values, files in partitions:
+        for f in files:
+            ranges = split_file(f, budget_bytes) if f['size'] > budget_bytes else []
+            if len(ranges) > 1:
+                tasks += [
+                    { 'files': [f], 'rowRange': (start, end), 'bytes': size, 'partitions': [values] }
+                    for start, end, size in ranges
+                ]
+            else:
+                whole_files.append((values, f))
+    # first fit decreasing: good enough, and keeps the number of tasks close to the minimum
+    bins = []
+    for values, f in sorted(whole_files, key=lambda v_f: -v_f[1]['size']):
+        target = next((b for b in bins if b['bytes'] + f['size'] <= budget_bytes), None)
+        if target is None:
+            target = { 'files': [], 'rowRange': None, 'bytes': 0, 'partitions': [] }
+            bins.append(target)
+        target['files'].append(f)
+        target['bytes'] += f['size']
+        if values not in target['partitions']:
+            target['partitions'].append(values)
+
+    return sorted(tasks + bins, key=lambda t: -t['bytes'])
+
+
+def describe_schedule(tasks: list, budget_bytes: int) -> dict:
+    sizes = [t['bytes'] for t in tasks]
+    mean = sum(sizes) / len(sizes) if sizes else 0
+
+    return {
+        'budgetBytes': budget_bytes,
+        'tasks': len(tasks),
+        'splitTasks': sum(1 for t in tasks if t['rowRange']),
+        'packedTasks': sum(1 for t in tasks if len(t['files']) > 1),
+        'maxTaskBytes': max(sizes) if sizes else 0,
+        'minTaskBytes': min(sizes) if sizes else 0,
+        # how much bigger the biggest task is than the average: 1.0 is a perfect balance
+        'skew': round(max(sizes) / mean, 2) if mean else 0
+    }
@@ -0,0 +1,502 @@
+"""
+
+Mergeable aggregate states, the SQL shared by the map-reduce planner (planner.py, in the
+client) and the lambda (approximate queries, see approximate.py).
+
+An aggregate query is parsed into its select items, scan, WHERE, ORDER BY and LIMIT; each
+aggregate is then computed in three steps:
+
+* a "map" query computes partial states from the rows it reads (AVG becomes SUM and COUNT,
+  COUNT DISTINCT becomes the list of distinct values, etc.);
+* "merge" queries turn partial states into partial states, so that they can be reduced in
+  any order, in batches or as a tree;
+* the "combine" query computes the final values from the partial states, ORDER BY and LIMIT
+  included.
+
+Distinct counts and quantiles can also use sketches, which are small and merge like the other
+states: APPROX_COUNT_DISTINCT always does, COUNT DISTINCT and MEDIAN / QUANTILE_* do when the
+query is approximate (parsed['approximate'], see approximate.py). duckdb 0.7.1 cannot export
+the state of its own approx_count_distinct (HyperLogLog) or approx_quantile (t-digest), so we
+build ours from plain lists:
+
+* distinct counts keep the SKETCH_SIZE smallest distinct hashes of the values (a "k minimum
+  values" sketch): the union of two sketches is the smallest hashes of the union, and the k-th
+  smallest hash tells how many distinct values there are (about 3% of error for k=1024);
+* quantiles keep a uniform sample of SKETCH_SIZE values, the ones with the smallest random
+  priorities: merging keeps the smallest priorities of the union, which is a uniform sample
+  of the union.
+
+Building these lists costs more than an exact COUNT DISTINCT in a single query: they pay off
+when partial states travel and merge. When nothing is merged (approximate['mergeable'] is
+False, a single query in the lambda), distinct counts use approx_count_distinct and quantiles
+the values of the sample.
+
+When the query is approximate, the map queries can also read a sample of the rows (see
+sample_clause): COUNT and SUM are scaled up, and every aggregate gets a confidence interval,
+the {alias}_low / {alias}_high columns after the selected ones.
+
+We don't use a full SQL parser here: we support the common SELECT ... FROM scan WHERE ...
+GROUP BY ... ORDER BY ... LIMIT shape, and return None for anything else (joins, CTEs,
+HAVING, window functions, nested aggregates...), so that the caller can fall back to a
+single query.
+
+"""
+
+
+import re
+from queryparse import split_clauses, split_top_level
+
+
+# name of the table holding the partial results in the combine step
+PARTIALS_TABLE = 'partials'
+# the path can also be a list with a single path, e.g. read_parquet(['s3://...'])
+SCAN_PATTERN = re.compile(
+    r"^(parquet_scan|read_parquet)\s*\(\s*(\[\s*)?'([^']+)'\s*(?(2)\]\s*)(,[^)]*)?\)\s*(?:AS\s+)?(\w+)?$",
+    re.IGNORECASE | re.DOTALL
+)
+AGGREGATE_PATTERN = re.compile(
+    r"^(COUNT|SUM|MIN|MAX|AVG|MEDIAN|QUANTILE_CONT|QUANTILE_DISC|QUANTILE|APPROX_COUNT_DISTINCT|APPROX_QUANTILE)\s*\((.*)\)$",
+    re.IGNORECASE | re.DOTALL
+)
+ANY_AGGREGATE_PATTERN = re.compile(r"\b(COUNT|SUM|MIN|MAX|AVG|LIST|FIRST|LAST|MEDIAN|QUANTILE\w*|APPROX_\w+|STRING_AGG)\s*\(", re.IGNORECASE)
+ALIAS_PATTERN = re.compile(r"^(.*?)\s+AS\s+(\"[^\"]+\"|\w+)$", re.IGNORECASE | re.DOTALL)
+# the alias without AS, e.g. MIN(fare) mn: the expression must end with a word, a literal or a
+# parenthesis, not with a keyword waiting for its operand (NOT x, x IS NULL), and the alias
+# cannot be a keyword either (CASE ... END, INTERVAL 1 DAY)
+IMPLICIT_ALIAS_PATTERN = re.compile(r"^(.*?(\w+|[)'\"]))\s+(\"[^\"]+\"|[A-Za-z_]\w*)$", re.DOTALL)
+OPERAND_KEYWORDS = {
+    'AND', 'OR', 'NOT', 'IS', 'IN', 'LIKE', 'ILIKE', 'BETWEEN', 'CASE', 'WHEN', 'THEN', 'ELSE',
+    'DISTINCT', 'ALL', 'INTERVAL', 'DATE', 'TIMESTAMP', 'COLLATE'
+}
+NOT_ALIASES = OPERAND_KEYWORDS | {
+    'END', 'NULL', 'TRUE', 'FALSE', 'YEAR', 'MONTH', 'WEEK', 'DAY', 'HOUR', 'MINUTE', 'SECOND', 'ASC', 'DESC'
+}
+QUANTILE_PATTERN = re.compile(r"^(0(\.\d+)?|1(\.0+)?|\.\d+)$")
+# how each quantile function picks a value between two ranks (QUANTILE is QUANTILE_DISC in duckdb)
+QUANTILE_FUNCTIONS = {
+    'MEDIAN': 'quantile_cont',
+    'QUANTILE_CONT': 'quantile_cont',
+    'QUANTILE_DISC': 'quantile_disc',
+    'QUANTILE': 'quantile_disc',
+    'APPROX_QUANTILE': 'quantile_disc'
+}
+# values kept by a sketch: the relative error of a distinct count is about 1 / sqrt(k)
+SKETCH_SIZE = 1024
+# relative standard error of approx_count_distinct: duckdb's HyperLogLog has 4096 registers,
+# 1.04 / sqrt(4096) = 1.6% in theory, 1.8% measured
+HLL_ERROR = 0.018
+# hash() is a UBIGINT: we divide by the size of its range to get uniform values in [0, 1)
+HASH_RANGE = 18446744073709551616.0
+
+
+def split_alias(item: str) -> tuple:
+    """
+    The expression and the alias (None if there is none) of a select item, with or without AS.
+    """
+    match = ALIAS_PATTERN.match(item.strip())
+    if match:
+        return match.group(1).strip(), match.group(2)
+    match = IMPLICIT_ALIAS_PATTERN.match(item.strip())
+    if match and match.group(2).upper() not in OPERAND_KEYWORDS and match.group(3).upper() not in NOT_ALIASES:
+        return match.group(1).strip(), match.group(3)
+
+    return item.strip(), None
+
+
+def parse_select_item(item: str) -> dict:
+    expression, alias = split_alias(item)
+    aggregate = AGGREGATE_PATTERN.match(expression)
+    parsed = { 'expression': expression, 'alias': alias or '"{}"'.format(expression.replace('"', '')) }
+    if aggregate:
+        function, argument = aggregate.group(1).upper(), aggregate.group(2).strip()
+        if ANY_AGGREGATE_PATTERN.search(argument):
+            # nested aggregates, not something we can split
+            return None
+        if function in QUANTILE_FUNCTIONS:
+            return parse_quantile_item(parsed, function, argument)
+        is_distinct = bool(re.match(r"^DISTINCT\s", argument, re.IGNORECASE))
+        if is_distinct:
+            if function != 'COUNT':
+                return None
+            argument = argument[len('DISTINCT'):].strip()
+        parsed['aggregate'] = 'COUNT_DISTINCT' if is_distinct else function
+        parsed['argument'] = argument
+    elif ANY_AGGREGATE_PATTERN.search(expression):
+        # expressions over aggregates (e.g. SUM(x) / COUNT(*)) are not supported (yet)
+        return None
+
+    return parsed
+
+
+def parse_quantile_item(parsed: dict, function: str, argument: str):
+    """
+    MEDIAN(x), QUANTILE_CONT(x, 0.9) and friends: the quantile must be a single constant.
+    """
+    arguments = split_top_level(argument)
+    if function == 'MEDIAN':
+        arguments.append('0.5')
+    if len(arguments) != 2 or not QUANTILE_PATTERN.match(arguments[1]):
+        return None
+    parsed.update({
+        'aggregate': 'APPROX_QUANTILE' if function == 'APPROX_QUANTILE' else 'QUANTILE',
+        'argument': arguments[0],
+        'quantile': float(arguments[1]),
+        'interpolation': QUANTILE_FUNCTIONS[function]
+    })
+
+    return parsed
+
+
+def parse_aggregate_query(query: str):
+    """
+    Parse the query into its components, or return None if it's not an aggregate
+    query over a single parquet scan that we can split.
+    """
+    sql = query.strip().rstrip(';').strip()
+    clauses = split_clauses(sql)
+    if not clauses or 'FROM' not in clauses:
+        return None
+    scan = SCAN_PATTERN.match(clauses['FROM'])
+    if not scan:
+        return None
+    items = [parse_select_item(i) for i in split_top_level(clauses['SELECT'])]
+    if any(i is None for i in items) or not any('aggregate' in i for i in items):
+        return None
+    # group by can use ordinals or the expressions themselves
+    group_by = split_top_level(clauses['GROUP BY']) if 'GROUP BY' in clauses else []
+    key_expressions = []
+    for g in group_by:
+        if g.isdigit():
+            if int(g) > len(items) or 'aggregate' in items[int(g) - 1]:
+                return None
+            key_expressions.append(items[int(g) - 1]['expression'])
+        else:
+            key_expressions.append(g)
+    keys = [i for i in items if 'aggregate' not in i]
+    # every non aggregated column must be a group key, and every group key must be selected
+    if sorted(k['expression'] for k in keys) != sorted(key_expressions):
+        return None
+    order_by = []
+    if 'ORDER BY' in clauses:
+        for o in split_top_level(clauses['ORDER BY']):
+            match = re.match(r"^(.*?)(\s+(?:ASC|DESC))?(\s+NULLS\s+(?:FIRST|LAST))?$", o, re.IGNORECASE | re.DOTALL)
+            target, direction = match.group(1).strip(), (match.group(2) or '') + (match.group(3) or '')
+            # we can sort on ordinals, aliases and selected expressions, which all exist after combine
+            aliases = {i['alias'].strip('"').lower(): i['alias'] for i in items}
+            expressions = {i['expression'].lower(): i['alias'] for i in items}
+            if target.isdigit():
+                order_by.append(target + direction)
+            elif target.strip('"').lower() in aliases:
+                order_by.append(aliases[target.strip('"').lower()] + direction)
+            elif target.lower() in expressions:
+                order_by.append(expressions[target.lower()] + direction)
+            else:
+                return None
+    limit = clauses.get('LIMIT')
+    if limit is not None and not limit.isdigit():
+        return None
+
+    return {
+        'items': items,
+        'scan_function': scan.group(1),
+        'scan_path': scan.group(3),
+        'scan_options': scan.group(4) or '',
+        'scan_alias': scan.group(5),
+        'where': clauses.get('WHERE'),
+        'order_by': order_by,
+        'limit': int(limit) if limit is not None else None,
+        # exact unless the caller sets the sampling and sketches (see approximate.py)
+        'approximate': None
+    }
+
+
+def uses_sketch(item: dict, approximate: dict) -> bool:
+    if item['aggregate'] in ('APPROX_COUNT_DISTINCT', 'APPROX_QUANTILE'):
+        return True
+
+    return bool(approximate) and item['aggregate'] in ('COUNT_DISTINCT', 'QUANTILE')
+
+
+def is_sampled(approximate: dict) -> bool:
+    return bool(approximate) and approximate['fraction'] < 1.0
+
+
+def sample_clause(approximate: dict) -> str:
+    """
+    Rows are sampled by the scan of the map queries: system sampling keeps whole vectors
+    (2048 rows), bernoulli flips a coin for every row.
+    """
+    if not is_sampled(approximate):
+        return ''
+    seed = f", {approximate['seed']}" if approximate.get('seed') is not None else ''
+
+    return f" TABLESAMPLE {approximate['fraction'] * 100.0:g} PERCENT ({approximate['method']}{seed})"
+
+
+def partial_states(item: dict, idx: int, approximate: dict = None) -> list:
+    """
+    Return the (map expression, partial column) pairs needed to compute an aggregate later on.
+    """
+    column = f"__p{idx}"
+    argument = item['argument']
+    not_null = f"FILTER (WHERE ({argument}) IS NOT NULL)"
+    # on a sample, the spread of the values gives the confidence interval of SUM and AVG
+    squares = [(
+        f"SUM(CAST({argument} AS DOUBLE) * CAST({argument} AS DOUBLE))",
+        f"{column}_squares"
+    )] if is_sampled(approximate) and item['aggregate'] in ('SUM', 'AVG') else []
+    if item['aggregate'] == 'AVG':
+        return [(f"SUM({argument})", f"{column}_sum"), (f"COUNT({argument})", f"{column}_count")] + squares
+    if uses_sketch(item, approximate) and not (approximate or {}).get('mergeable', True):
+        if item['aggregate'] in ('COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT'):
+            return [(f"approx_count_distinct({argument})", column)]
+        if not is_sampled(approximate):
+            function = 'approx_quantile' if item['aggregate'] == 'APPROX_QUANTILE' else item['interpolation']
+            return [(f"{function}({argument}, {item['quantile']})", column)]
+        # the sample is small enough to keep its values
+        return [(f"list({argument}) {not_null}", column)]
+    if uses_sketch(item, approximate) and item['aggregate'] in ('COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT'):
+        # list_distinct drops the NULL (a FILTER on a DISTINCT aggregate crashes duckdb 0.7.1,
+        # when the query has other filtered aggregates)
+        distinct_hashes = f"list(DISTINCT CASE WHEN ({argument}) IS NOT NULL THEN hash({argument}) END)"
+        return [(f"list_slice(list_sort(list_distinct({distinct_hashes})), 1, {SKETCH_SIZE})", column)]
+    if uses_sketch(item, approximate):
+        # structs sort by their first field: the values with the smallest priorities
+        return [(f"list_slice(list_sort(list({{'p': random(), 'v': {argument}}}) {not_null}), 1, {SKETCH_SIZE})", column)]
+    if item['aggregate'] == 'COUNT_DISTINCT':
+        # the exact set of distinct values is our mergeable state
+        return [(f"list(DISTINCT {argument})", column)]
+    if item['aggregate'] == 'QUANTILE':
+        # exact quantiles need all the values
+        return [(f"list({argument}) {not_null}", column)]
+
+    return [(f"{item['aggregate']}({argument})", column)] + squares
+
+
+def combine_expression(item: dict, idx: int) -> str:
+    """
+    Return the expression computing the final value of an aggregate from its partial states.
+    """
+    column = f"__p{idx}"
+    aggregate = item['aggregate']
+    if aggregate in ('COUNT', 'SUM'):
+        # SUM of integers is a HUGEINT in duckdb, COUNT must stay a BIGINT
+        return f"CAST(SUM({column}) AS BIGINT)" if aggregate == 'COUNT' else f"SUM({column})"
+    if aggregate in ('MIN', 'MAX'):
+        return f"{aggregate}({column})"
+    if aggregate == 'AVG':
+        return f"SUM({column}_sum) / CAST(SUM({column}_count) AS DOUBLE)"
+    if aggregate == 'QUANTILE':
+        return f"list_aggr(flatten(list({column})), '{item['interpolation']}', {item['quantile']})"
+    # COUNT DISTINCT: union of the distinct values in every partition
+    return f"CAST(len(list_distinct(flatten(list({column})))) AS BIGINT)"
+
+
+def build_map_query(parsed: dict, scan_source: str, row_range: tuple = None) -> str:
+    """
+    The scan source is a SQL literal: a (glob) path in quotes, or a list of paths. With a
+    row range, the source is a single file and we only read rows [start, end) of it.
+    """
+    columns = []
+    for idx, item in enumerate(parsed['items']):
+        if 'aggregate' in item:
+            columns += [f"{expression} AS {column}" for expression, column in partial_states(item, idx, parsed['approximate'])]
+        else:
+            columns.append(f"{item['expression']} AS __k{idx}")
+    query = "SELECT {} FROM {}({}{}{}){}".format(
+        ', '.join(columns),
+        parsed['scan_function'],
+        scan_source,
+        parsed['scan_options'],
+        ', file_row_number=true' if row_range else '',
+        f" AS {parsed['scan_alias']}" if parsed['scan_alias'] else ''
+    ) + sample_clause(parsed['approximate'])
+    predicates = [f"({parsed['where']})"] if parsed['where'] else []
+    if row_range:
+        # the filter is pushed down to the scan, which skips the row groups out of range
+        predicates.append(f"file_row_number >= {row_range[0]} AND file_row_number < {row_range[1]}")
+    if predicates:
+        query += f" WHERE {' AND '.join(predicates)}"
+    if any('aggregate' not in item for item in parsed['items']):
+        # partial columns for AVG take two (or three) slots, so we need to count them
+        ordinals = []
+        position = 0
+        for idx, item in enumerate(parsed['items']):
+            position += 1 if 'aggregate' not in item else len(partial_states(item, idx, parsed['approximate']))
+            if 'aggregate' not in item:
+                ordinals.append(str(position))
+        query += f" GROUP BY {', '.join(ordinals)}"
+
+    return query
+
+
+def merge_expressions(item: dict, idx: int, approximate: dict = None) -> list:
+    """
+    Return the (expression, partial column) pairs merging partial states into partial states.
+    """
+    column = f"__p{idx}"
+    aggregate = item['aggregate']
+    squares = [(f"SUM({column}_squares)", f"{column}_squares")] if is_sampled(approximate) and aggregate in ('SUM', 'AVG') else []
+    if aggregate == 'COUNT':
+        return [(f"CAST(SUM({column}) AS BIGINT)", column)]
+    if aggregate == 'SUM':
+        return [(f"SUM({column})", column)] + squares
+    if aggregate in ('MIN', 'MAX'):
+        return [(f"{aggregate}({column})", column)]
+    if aggregate == 'AVG':
+        return [(f"SUM({column}_sum)", f"{column}_sum"), (f"CAST(SUM({column}_count) AS BIGINT)", f"{column}_count")] + squares
+    if uses_sketch(item, approximate) and aggregate in ('COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT'):
+        # the smallest hashes of the union, each hash once
+        return [(f"list_slice(list_sort(list_distinct(flatten(list({column})))), 1, {SKETCH_SIZE})", column)]
+    if uses_sketch(item, approximate):
+        return [(f"list_slice(list_sort(flatten(list({column}))), 1, {SKETCH_SIZE})", column)]
+    if aggregate == 'QUANTILE':
+        return [(f"flatten(list({column}))", column)]
+    # COUNT DISTINCT: the union of the sets is still a set
+    return [(f"list_distinct(flatten(list({column})))", column)]
+
+
+def build_merge_query(parsed: dict, source: str) -> str:
+    """
+    Merge partial results into one partial result, with the same columns as the map queries:
+    no ORDER BY nor LIMIT here, they only make sense on the final values.
+    """
+    columns = []
+    keys = []
+    for idx, item in enumerate(parsed['items']):
+        if 'aggregate' in item:
+            columns += [f"{expression} AS {column}" for expression, column in merge_expressions(item, idx, parsed['approximate'])]
+        else:
+            columns.append(f"__k{idx}")
+            keys.append(f"__k{idx}")
+    query = f"SELECT {', '.join(columns)} FROM {source}"
+    if keys:
+        query += f" GROUP BY {', '.join(keys)}"
+
+    return query
+
+
+def final_expressions(item: dict, idx: int, approximate: dict) -> tuple:
+    """
+    Return the (estimate, low, high) expressions of an aggregate over its merged partial
+    states: the bounds are the confidence interval of the estimate, and the estimate itself
+    when it is exact.
+    """
+    column = f"__p{idx}"
+    aggregate = item['aggregate']
+    sampled = is_sampled(approximate)
+    fraction = approximate['fraction'] if sampled else 1.0
+    z = approximate['z'] if approximate else 0.0
+    mergeable = (approximate or {}).get('mergeable', True)
+    if aggregate in ('COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT') and uses_sketch(item, approximate) and not mergeable:
+        error = f"{z * HLL_ERROR} * {column}"
+        return column, f"CAST(GREATEST(0, ROUND({column} - {error})) AS BIGINT)", f"CAST(ROUND({column} + {error}) AS BIGINT)"
+    if aggregate in ('COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT') and uses_sketch(item, approximate):
+        # fewer hashes than the sketch size: we kept them all, and the count is exact
+        estimate = (
+            f"CAST(CASE WHEN len({column}) < {SKETCH_SIZE} THEN len({column}) "
+            f"ELSE ROUND({SKETCH_SIZE - 1} / (list_extract({column}, {SKETCH_SIZE}) / {HASH_RANGE})) END AS BIGINT)"
+        )
+        error = f"CASE WHEN len({column}) < {SKETCH_SIZE} THEN 0 ELSE {z} * {estimate} / sqrt({SKETCH_SIZE - 2}) END"
+        return estimate, f"CAST(GREATEST(len({column}), ROUND({estimate} - {error})) AS BIGINT)", f"CAST(ROUND({estimate} + {error}) AS BIGINT)"
+    if uses_sketch(item, approximate) and not mergeable and not sampled:
+        return column, column, column
+    if uses_sketch(item, approximate):
+        # the values of the sample, or of the sketch
+        values = f"list_transform({column}, e -> e.v)" if mergeable else column
+        estimate = f"list_aggr({values}, '{item['interpolation']}', {item['quantile']})"
+        # distribution-free interval: the ranks around q * n, in the sorted sample
+        spread = f"{z} * sqrt(len({column}) * {item['quantile'] * (1.0 - item['quantile'])})"
+        low_rank = f"GREATEST(1, CAST(FLOOR(len({column}) * {item['quantile']} - {spread}) AS BIGINT))"
+        high_rank = f"LEAST(len({column}), CAST(CEIL(len({column}) * {item['quantile']} + {spread}) AS BIGINT) + 1)"
+        low, high = f"list_extract(list_sort({values}), {low_rank})", f"list_extract(list_sort({values}), {high_rank})"
+        if sampled:
+            return estimate, low, high
+        # fewer values than the sketch size: we kept them all, and the quantile is exact
+        return (
+            estimate,
+            f"CASE WHEN len({column}) < {SKETCH_SIZE} THEN {estimate} ELSE {low} END",
+            f"CASE WHEN len({column}) < {SKETCH_SIZE} THEN {estimate} ELSE {high} END"
+        )
+    if sampled and aggregate == 'COUNT':
+        # every row was kept with probability f: the count is binomial
+        estimate = f"CAST(ROUND({column} / {fraction}) AS BIGINT)"
+        error = f"{z} * sqrt({column} * {1.0 - fraction}) / {fraction}"
+        return estimate, f"CAST(GREATEST({column}, ROUND({column} / {fraction} - {error})) AS BIGINT)", f"CAST(ROUND({column} / {fraction} + {error}) AS BIGINT)"
+    if sampled and aggregate == 'SUM':
+        estimate = f"({column} / {fraction})"
+        error = f"{z} * sqrt({1.0 - fraction} * {column}_squares) / {fraction}"
+        return estimate, f"{estimate} - {error}", f"{estimate} + {error}"
+    if sampled and aggregate == 'AVG':
+        estimate = f"({column}_sum / CAST({column}_count AS DOUBLE))"
+        variance = f"({column}_squares - {column}_sum * {estimate}) / ({column}_count - 1)"
+        error = f"CASE WHEN {column}_count > 1 THEN {z} * sqrt(GREATEST({variance}, 0) / {column}_count * {1.0 - fraction}) END"
+        return estimate, f"{estimate} - {error}", f"{estimate} + {error}"
+    # exact values (MIN and MAX are never sampled, see approximate.py): their own bounds
+    if aggregate == 'AVG':
+        estimate = f"({column}_sum / CAST({column}_count AS DOUBLE))"
+    elif aggregate == 'COUNT_DISTINCT':
+        estimate = f"CAST(len({column}) AS BIGINT)"
+    elif aggregate == 'QUANTILE':
+        estimate = f"list_aggr({column}, '{item['interpolation']}', {item['quantile']})"
+    else:
+        estimate = column
+
+    return estimate, estimate, estimate
+
+
+def bound_alias(alias: str, suffix: str) -> str:
+    return f'"{alias[1:-1]}_{suffix}"' if alias.startswith('"') else f"{alias}_{suffix}"
+
+
+def build_combine_query(parsed: dict, source: str=PARTIALS_TABLE) -> str:
+    """
+    With sketches or an approximate query, the partial states are merged first, and the final
+    values (and their bounds) computed over the merged states, one row per group: duckdb
+    cannot run the lambdas reading the sketches inside an aggregate query.
+    """
+    approximate = parsed['approximate']
+    if approximate or any(uses_sketch(i, approximate) for i in parsed['items'] if 'aggregate' in i):
+        return build_final_query(parsed, f"({build_merge_query(parsed, source)}) AS __merged")
+    columns = []
+    keys = []
+    for idx, item in enumerate(parsed['items']):
+        if 'aggregate' in item:
+            columns.append(f"{combine_expression(item, idx)} AS {item['alias']}")
+        else:
+            columns.append(f"__k{idx} AS {item['alias']}")
+            keys.append(str(idx + 1))
+    query = f"SELECT {', '.join(columns)} FROM {source}"
+    if keys:
+        query += f" GROUP BY {', '.join(keys)}"
+    if parsed['order_by']:
+        query += f" ORDER BY {', '.join(parsed['order_by'])}"
+    if parsed['limit'] is not None:
+        query += f" LIMIT {parsed['limit']}"
+
+    return query
+
+
+def build_final_query(parsed: dict, source: str) -> str:
+    """
+    The final values over merged partial states: one row per group in the source.
+    """
+    approximate = parsed['approximate']
+    columns = []
+    bounds = []
+    for idx, item in enumerate(parsed['items']):
+        if 'aggregate' not in item:
+            columns.append(f"__k{idx} AS {item['alias']}")
+            continue
+        estimate, low, high = final_expressions(item, idx, approximate)
+        columns.append(f"{estimate} AS {item['alias']}")
+        if approximate:
+            # bounds go last, so that ordinals in ORDER BY still point to the same columns
+            bounds += [f"{low} AS {bound_alias(item['alias'], 'low')}", f"{high} AS {bound_alias(item['alias'], 'high')}"]
+    query = f"SELECT {', '.join(columns + bounds)} FROM {source}"
+    if parsed['order_by']:
+        query += f" ORDER BY {', '.join(parsed['order_by'])}"
+    if parsed['limit'] is not None:
+        query += f" LIMIT {parsed['limit']}"
+
+    return query
@@ -1,12 +1,68 @@
+import time
+# init phase timer: everything at module level runs once per (cold) container
+INIT_START = time.time()
 import uuid
 import os
-import time
+import json
+import base64
+import boto3
 import duckdb
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from result_cache import ResultCache, build_cache_key, get_object_versions, is_cacheable
+from local_storage import LocalS3Client, localize_paths
+from manifest import find_glob_scans, dataset_root, load_manifest, rewrite_scans, validate_files, StaleManifestError
+from result_delivery import ResultWriter, DEFAULT_ROWS_PER_FILE
+from profiling import IOStats, start_profiling, stop_profiling, peak_rss_mb
+from templates import TemplateRegistry, template_id_for
+from file_cache import FileCache
+from approximate import approximate_query
+from resources import runtime_resources, query_resources, apply_resources, resource_error, ResourceError, ResourceMonitor
 
 
 con = None # global conn object - we re-use this across calls
+connect_ms = 0 # time spent creating the connection
+invocations = 0 # invocations served by this container
+applied_credentials = None # the AWS credentials currently set on the connection
 DEFAULT_LIMIT = 20 # if we don't specify a limit, we will return at most 20 results
+DEFAULT_FORMAT = 'json' # row-wise records, the original (and default) response format
+# columnar formats are returned as a base64 encoded binary payload
+COLUMNAR_FORMATS = ('arrow', 'parquet')
+ARROW_BATCH_SIZE = 10000 # rows per arrow batch when fetching from duckdb
+# results are returned inline (the default), written to the bucket (s3), or
+# written to the bucket only when they are bigger than the threshold (auto)
+DELIVERY_MODES = ('inline', 's3', 'auto')
+# the lambda response is capped at 6 MB, and base64 / json add some overhead
+DEFAULT_SPILL_THRESHOLD_BYTES = 4 * 1024 * 1024
+# keep-warm pings hold the container at most this long (we pay for it)
+MAX_WARMUP_MS = 1000
+# where to write results delivered through the bucket, one folder per query
+RESULTS_PREFIX = os.environ.get('QUACK_RESULTS_PREFIX', f"s3://{os.environ.get('S3_BUCKET_NAME')}/results")
+# result cache, living as long as the warm container: memory first, then /tmp
+result_cache = ResultCache(
+    max_memory_bytes=int(os.environ.get('QUACK_CACHE_MEMORY_MB', 256)) * 1024 * 1024,
+    max_disk_bytes=int(os.environ.get('QUACK_CACHE_DISK_MB', 1024)) * 1024 * 1024,
+    spill_dir=os.environ.get('QUACK_CACHE_DIR', '/tmp/quack-results')
+)
+# parquet files read by the queries, kept on the ephemeral storage (0 MB to turn it off): queries
+# use the copies there, and download theirs only with 'file_cache': true in the event
+FILE_CACHE_MB = int(os.environ.get('QUACK_FILE_CACHE_MB', 1536))
+file_cache = FileCache(
+    cache_dir=os.environ.get('QUACK_FILE_CACHE_DIR', '/tmp/quack-files'),
+    max_bytes=FILE_CACHE_MB * 1024 * 1024,
+    max_file_bytes=int(os.environ.get('QUACK_FILE_CACHE_MAX_FILE_MB', 512)) * 1024 * 1024
+) if FILE_CACHE_MB > 0 else None
+s3_client = None # global s3 client, used to check the version of the objects we query
+# when emulating the lambda locally (see executors.py), s3 uris can point to a local folder...
+LOCAL_DATA_ROOT = os.environ.get('QUACK_LOCAL_DATA_ROOT')
+# ... or to an S3-compatible stand-in (e.g. MinIO) at this endpoint
+S3_ENDPOINT_URL = os.environ.get('QUACK_S3_ENDPOINT_URL')
+manifests = {} # dataset root -> (etag, manifest), revalidated with a conditional GET
+io_stats = IOStats() # S3 requests made through s3_client, for profiling
+templates = TemplateRegistry() # query templates prepared on the connection
+# threads, memory limit and spill folder from the function configuration (see resources.py)
+default_resources = runtime_resources()
+applied_resources = None # the resources currently set on the connection
 
 
 def return_duckdb_connection():
@@ -14,48 +70,527 @@ def return_duckdb_connection():
     Return a duckdb connection object
     """
     duckdb_connection = duckdb.connect(database=':memory:')
+    apply_resources(duckdb_connection, default_resources)
+    # keep parquet metadata (footers) in memory, so warm invocations don't read them again
+    duckdb_connection.execute("SET enable_object_cache=true;")
+    if LOCAL_DATA_ROOT:
+        # no need for httpfs, we read from disk
+        return duckdb_connection
     duckdb_connection.execute(f"""
         LOAD httpfs;
-        SET s3_region='{os.environ['AWS_REGION']}';
-        SET s3_session_token='{os.environ['AWS_SESSION_TOKEN']}';
+        SET s3_region='{os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))}';
     """
     )
+    if S3_ENDPOINT_URL:
+        # S3-compatible stand-ins are usually served over plain http, with path style urls
+        duckdb_connection.execute(f"""
+            SET s3_endpoint='{S3_ENDPOINT_URL.split('://')[-1]}';
+            SET s3_url_style='path';
+            SET s3_use_ssl={str(S3_ENDPOINT_URL.startswith('https')).lower()};
+        """)
+    refresh_credentials(duckdb_connection)
 
     return duckdb_connection
 
 
+def refresh_credentials(duckdb_connection):
+    """
+    Set the AWS credentials of the environment on the connection, if they changed since the
+    last time: the session token of the execution role is not forever, and the runtime
+    updates the environment when it rotates it.
+    """
+    global applied_credentials
+    credentials = tuple(os.environ.get(k, '') for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'))
+    if LOCAL_DATA_ROOT or credentials == applied_credentials:
+        return False
+    duckdb_connection.execute(f"""
+        SET s3_access_key_id='{credentials[0]}';
+        SET s3_secret_access_key='{credentials[1]}';
+        SET s3_session_token='{credentials[2]}';
+    """)
+    applied_credentials = credentials
+
+    return True
+
+
+def init_connection():
+    """
+    Create the connection: we do it when the module is imported, i.e. in the lambda init
+    phase, so that the first invocation does not pay for it.
+    """
+    global con, connect_ms, applied_resources
+    connect_start = time.time()
+    con = return_duckdb_connection()
+    applied_resources = default_resources
+    templates.reset()
+    connect_ms = int((time.time() - connect_start) * 1000.0)
+
+    return
+
+
+try:
+    init_connection()
+except Exception as e:
+    # we'll try again in the first invocation, where errors are reported to the caller
+    print(f"Could not create the connection at init: {e}")
+INIT_MS = int((time.time() - INIT_START) * 1000.0)
+
+
 def handler(event, context):
     """
     Run a SQL query in a memory db as a serverless function
     """
-
-    is_warm = False
+    global invocations
+    # the first invocation of a container is the cold one
+    is_warm = invocations > 0
+    invocations += 1
     # run a timer for info
     start = time.time()
-    global con
+    timings = { "initMs": 0 if is_warm else INIT_MS, "connectMs": 0 if is_warm else connect_ms }
     if not con:
-        # create a new connection
-        con = return_duckdb_connection()
+        # init failed, give it another go
+        init_connection()
+        timings["connectMs"] = connect_ms
     else:
-        # return to the caller the status of the lambda
-        is_warm = True
+        refresh_credentials(con)
+    # keep-warm ping (see gateway.py): no query, but hold the container for a moment, so that
+    # concurrent pings land on different containers
+    if event.get('warmup'):
+        time.sleep(min(int(event.get('warmup_ms', 0)), MAX_WARMUP_MS) / 1000.0)
+        return { "metadata": { "timeMs": elapsed_ms(start), "warm": is_warm, "warmup": True, **timings } }
+    # many queries in one event (e.g. all the charts of a dashboard): one round trip
+    if 'queries' in event:
+        return run_batch(event, is_warm, start, timings)
+    try:
+        return run_query(event, is_warm, start, timings)
+    except ResourceError as e:
+        # the container survived the query: tell the caller what it had to work with
+        print(f"Query ran out of resources: {e}")
+        return resource_error_response(e, start, event.get('q') or event.get('template') or event.get('template_id'))
+
+
+def resource_error_response(error: ResourceError, start: float, query: str) -> dict:
+    return {
+        "errorMessage": str(error),
+        "errorType": error.kind,
+        "metadata": {
+            "timeMs": elapsed_ms(start),
+            "query": query,
+            "resources": error.resources
+        }
+    }
+
+
+def use_resources(resources: dict):
+    """
+    Set the resources of the next query on the connection, if they are not there already.
+    """
+    global applied_resources
+    apply_resources(con, resources, applied_resources)
+    applied_resources = resources
+
+    return
+
 
+def run_batch(event: dict, is_warm: bool, start: float, timings: dict):
+    """
+    Run the queries of the event in sequence on the shared connection, and return one
+    response (data and metadata, or error) per query. Queries are strings or events of
+    their own (q, template, params, limit...), the other keys of the event are the defaults.
+
+    We do not use cursors to run them concurrently: a cursor is a separate connection, without
+    the prepared templates and profiling settings of this one, and duckdb already gives all the
+    threads of the lambda to each query.
+    """
+    defaults = { k: v for k, v in event.items() if k != 'queries' }
+    results = []
+    for item in event['queries']:
+        query_event = { **defaults, **(item if isinstance(item, dict) else { 'q': item }) }
+        query_start = time.time()
+        try:
+            results.append(run_query(query_event, is_warm, query_start, {}))
+        except ResourceError as e:
+            print(f"Query ran out of resources in batch: {e}")
+            results.append(resource_error_response(e, query_start, query_event.get('q') or query_event.get('template') or query_event.get('template_id')))
+        except Exception as e:
+            # one failing query does not fail the batch
+            print(f"Query failed in batch: {e}")
+            results.append({
+                "errorMessage": str(e),
+                "errorType": type(e).__name__,
+                "metadata": {
+                    "timeMs": elapsed_ms(query_start),
+                    "query": query_event.get('q') or query_event.get('template') or query_event.get('template_id')
+                }
+            })
+
+    return {
+        "metadata": {
+            "timeMs": elapsed_ms(start),
+            "epochMs": int(time.time() * 1000),
+            "eventId": str(uuid.uuid4()),
+            "warm": is_warm,
+            "queries": len(results),
+            "errors": sum(1 for r in results if 'errorMessage' in r),
+            **timings
+        },
+        "data": { "results": results }
+    }
+
+
+def run_query(event: dict, is_warm: bool, start: float, timings: dict):
+    """
+    Run the query of the event and wrap the results and metadata in the response.
+    """
     # get the query to be executed from the payload
     event_query = event.get('q', None)
-    limit = int(event.get('limit', DEFAULT_LIMIT))
-    results = []
-    if not event_query:
-        print("No query provided, will return empty results")
+    # an explicit null limit means all the rows (use it with the s3 / auto delivery!)
+    limit = event.get('limit', DEFAULT_LIMIT)
+    limit = int(limit) if limit is not None else None
+    delivery = event.get('delivery', 'inline')
+    if delivery not in DELIVERY_MODES:
+        raise ValueError(f"Unsupported delivery {delivery}, use one of {DELIVERY_MODES}")
+    # the client can negotiate a columnar format, json records stay the default
+    response_format = event.get('format', DEFAULT_FORMAT)
+    compression = event.get('compression', None)
+    if response_format != DEFAULT_FORMAT and response_format not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unsupported format {response_format}, use one of {(DEFAULT_FORMAT,) + COLUMNAR_FORMATS}")
+    # profiling is opt-in, and skips the result cache (there would be nothing to profile)
+    profile = bool(event.get('profile', False))
+    # the event can ask for more memory or fewer threads than the defaults, for this query
+    resources = query_resources(default_resources, event)
+    io_before = io_stats.snapshot()
+    data = { "records": [] }
+    extra_metadata = { "cache": "disabled", "cacheBytesSaved": 0, **timings }
+    plan_start = time.time()
+    # templates are prepared once per container, then we only bind the parameters
+    statement = None
+    params = event.get('params', [])
+    if event.get('template_id') or event.get('template'):
+        statement, event_query, extra_metadata['templatePrepared'] = templates.execute_query(
+            con,
+            event.get('template_id'),
+            event.get('template'),
+            params,
+            prepare_sql=resolve_paths
+        )
+        extra_metadata['template'] = event.get('template_id') or template_id_for(event_query)
+    query = event_query
+    # approximate queries read a sample and use sketches: the manifest and the caches then
+    # work on the rewritten query, as the sampled results are not the exact ones
+    if event_query and event.get('approximate') and not statement:
+        query, extra_metadata['approximate'] = approximate_query(event_query, event['approximate'])
+    # if asked, replace glob scans with the files listed in the dataset manifest (not for
+    # templates: the files would change the prepared statement)
+    versions = None
+    if event_query and event.get('manifest') and not statement:
+        options = event['manifest'] if isinstance(event['manifest'], dict) else {}
+        query, versions, extra_metadata['manifest'] = apply_manifests(query, options.get('validate', True))
+    cache_key = None
+    checked_versions = None
+    if event_query and event.get('cache', True) and not profile and is_cacheable(event_query):
+        # for templates, the parameters are part of the identity of the results
+        key_query = query if not statement else f"{query} -- {json.dumps(params)}"
+        cache_key, source_bytes, checked_versions = get_cache_key(key_query, limit, response_format, compression, versions, delivery)
+        cached_data = result_cache.get(cache_key) if cache_key else None
+        if cached_data is not None:
+            extra_metadata.update({ "cache": "hit", "cacheBytesSaved": source_bytes, "planMs": elapsed_ms(plan_start), "executeMs": 0 })
+            return wrap_response(start, event_query, json.loads(cached_data), is_warm, extra_metadata)
+        extra_metadata.update({ "cache": "miss", "cacheBytesSaved": 0 })
+    extra_metadata['planMs'] = elapsed_ms(plan_start)
+    execute_start = time.time()
+    # read the files from the local disk when we have them (not for templates: the prepared
+    # statement has its own paths), and download them first only if the event asks for it
+    download_files = bool(event.get('file_cache', False))
+    use_file_cache = event.get('file_cache') is not False and (download_files or (file_cache is not None and not file_cache.is_empty()))
+    if file_cache is not None and query and not statement and use_file_cache:
+        query, extra_metadata['fileCache'] = localize_files(query, checked_versions or versions, checked_versions is not None, download_files)
+    serialize_ms = 0
+    profile_path = start_profiling(con) if profile and event_query else None
+    run_sql = statement or (resolve_paths(query) if query else None)
+    use_resources(resources)
+    monitor = ResourceMonitor(resources['tempDirectory']).start()
+    try:
+        if not event_query:
+            print("No query provided, will return empty results")
+        else:
+            try:
+                data, serialize_ms = execute_query(run_sql, limit, delivery, event, response_format, compression)
+            except duckdb.OutOfMemoryException as e:
+                # hash aggregates do not spill in duckdb 0.7, and every thread builds its own
+                # hash table: one thread often fits (results in the bucket are not retried,
+                # some files may be written already)
+                if resources['threads'] == 1 or delivery != 'inline' or not event.get('oom_retry', True):
+                    raise
+                print(f"Out of memory with {resources['threads']} threads, retrying with one: {e}")
+                resources = { **resources, 'threads': 1 }
+                use_resources(resources)
+                extra_metadata['oomRetry'] = True
+                data, serialize_ms = execute_query(run_sql, limit, delivery, event, response_format, compression)
+    except Exception as e:
+        # out of memory (or of spill space) is an answer, not a crash
+        error = resource_error(e, monitor.stop(resources))
+        if error is None:
+            raise
+        raise error from e
+    finally:
+        # never leave the profiler on for the next invocation
+        query_profile = stop_profiling(con, profile_path) if profile_path else None
+        extra_metadata['resources'] = monitor.stop(resources)
+    extra_metadata['executeMs'] = elapsed_ms(execute_start)
+    if profile:
+        extra_metadata['profile'] = {
+            **(query_profile or {}),
+            'serializeMs': serialize_ms,
+            'peakRssMb': peak_rss_mb(),
+            's3': IOStats.since(io_before, io_stats.snapshot()),
+            'pruning': pruning_info(extra_metadata.get('manifest'))
+        }
+
+    # results in the bucket may be deleted at any time, so we only cache inline results
+    if cache_key and 'files' not in data:
+        # default=str covers the few types json does not know about (e.g. dates)
+        result_cache.put(cache_key, json.dumps(data, default=str).encode('utf-8'))
+    
+    # return response to the client with metadata
+    return wrap_response(start, event_query, data, is_warm, extra_metadata)
+
+
+def execute_query(run_sql, limit: int, delivery: str, event: dict, response_format: str, compression: str) -> tuple:
+    """
+    Run the query (or prepared statement) and return the data of the response, and the
+    milliseconds spent serializing it.
+    """
+    serialize_ms = 0
+    if delivery != 'inline':
+        data = deliver_results(con, run_sql, limit, delivery, event, response_format, compression)
+    elif response_format in COLUMNAR_FORMATS:
+        # fetch arrow batches straight from duckdb, no pandas involved
+        _table = fetch_arrow_table(con, run_sql, limit)
+        serialize_start = time.time()
+        data = convert_table_to_payload(_table, response_format, compression)
+        serialize_ms = elapsed_ms(serialize_start)
     else:
         # execute the query and return a pandas dataframe
-        _df = con.execute(event_query).df()
+        _df = con.execute(run_sql).df()
         # take rows up the limit, to avoid crashing the lambda
         # by returning too many results
-        _df = _df.head(limit)
-        results = convert_records_to_json(_df)
+        _df = _df.head(limit) if limit is not None else _df
+        serialize_start = time.time()
+        data = { "records": convert_records_to_json(_df) }
+        serialize_ms = elapsed_ms(serialize_start)
+
+    return data, serialize_ms
+
+
+def elapsed_ms(since: float) -> int:
+    return int((time.time() - since) * 1000.0)
+
+
+def pruning_info(manifest_info: dict) -> dict:
+    """
+    Files, row groups and bytes scanned vs pruned: we only know them when the manifest was used.
+    """
+    if not manifest_info or manifest_info.get('status') not in ('used', 'validated'):
+        return None
+
+    return {
+        'filesScanned': manifest_info['filesScanned'],
+        'filesPruned': manifest_info['filesTotal'] - manifest_info['filesScanned'],
+        'rowGroupsScanned': manifest_info['rowGroupsScanned'],
+        'rowGroupsPruned': manifest_info['rowGroupsTotal'] - manifest_info['rowGroupsScanned'],
+        'bytesScanned': manifest_info['bytesScanned'],
+        'bytesPruned': manifest_info['bytesTotal'] - manifest_info['bytesScanned']
+    }
+
+
+def get_s3_client():
+    global s3_client
+    if not s3_client:
+        s3_client = LocalS3Client(LOCAL_DATA_ROOT) if LOCAL_DATA_ROOT else boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+        io_stats.attach(s3_client)
+
+    return s3_client
+
+
+def resolve_paths(query: str) -> str:
+    """
+    Everything (cache keys, manifests...) works on s3 uris, but when running on local data,
+    duckdb needs to read from the local folder instead.
+    """
+    return localize_paths(query, LOCAL_DATA_ROOT) if LOCAL_DATA_ROOT else query
+
+
+def apply_manifests(query: str, validate: bool):
+    """
+    Rewrite the glob scans in the query using the manifests of the datasets, so that duckdb
+    does not need to list the bucket nor to read the footers of the files we pruned.
+
+    Return the query to run, the versions of the files it reads (None if we don't know them)
+    and the info for the metadata. If the manifest is stale (files added, removed or changed
+    under the globs since it was written), we run the original query.
+    """
+    globs = [glob for _, glob in find_glob_scans(query)]
+    loaded = { root: load_manifest(get_s3_client(), root, cache=manifests) for root in { dataset_root(g) for g in globs } }
+    new_query, files, info = rewrite_scans(query, { r: m for r, m in loaded.items() if m })
+    if not files:
+        return query, None, { **info, 'status': 'not found' }
+    if not validate:
+        # trust the manifest: the ETags it recorded become the versions for the cache key
+        return new_query, [(f['path'], f['etag'], '', f['size']) for f in files], { **info, 'status': 'used' }
+    try:
+        scans = [(g, loaded[dataset_root(g)]) for g in globs if loaded[dataset_root(g)]]
+        versions = validate_files(get_s3_client(), files, scans)
+    except StaleManifestError as e:
+        print(f"Stale manifest, falling back to the glob scan: {e}")
+        return query, None, { **info, 'status': 'stale' }
+
+    return new_query, versions, { **info, 'status': 'validated' }
+
+
+def get_cache_key(
+    query: str,
+    limit: int,
+    response_format: str,
+    compression: str,
+    known_versions: list = None,
+    delivery: str = 'inline'
+):
+    """
+    Build the result cache key, checking the current version of the S3 objects in the query:
+    return the key, the total size of the objects (i.e. the bytes we don't need to
+    read again on a hit) and their versions. If we cannot check the versions, we don't cache.
+
+    Versions we already know (e.g. checked against the manifest) are not fetched again.
+    """
+    known_versions = known_versions or []
+    try:
+        versions = known_versions + get_object_versions(
+            get_s3_client(),
+            query,
+            skip={ v[0] for v in known_versions }
+        )
+    except Exception as e:
+        print(f"Could not check object versions, skipping the cache: {e}")
+        return None, 0, None
+    key = build_cache_key(
+        query,
+        versions,
+        limit=limit,
+        format=response_format,
+        compression=compression,
+        delivery=delivery
+    )
+
+    return key, sum(v[3] for v in versions), versions
+
+
+def localize_files(query: str, known_versions: list, is_complete: bool, download: bool):
+    """
+    Point the query to the local copies of its files (see file_cache.py): versions we do not
+    know yet are checked here, unless the ones we have already cover the whole query.
+    """
+    known_versions = known_versions or []
+    try:
+        versions = known_versions if is_complete else known_versions + get_object_versions(
+            get_s3_client(),
+            query,
+            skip={ v[0] for v in known_versions }
+        )
+        return file_cache.localize(get_s3_client(), query, versions, download=download)
+    except Exception as e:
+        print(f"Could not use the file cache, reading from S3: {e}")
+
+    return query, None
+
+
+def limited_batches(reader, limit: int):
+    """
+    Yield arrow record batches until we reach the limit (if any), so that
+    we never materialize more rows than the ones we are going to return.
+    """
+    rows = 0
+    for batch in reader:
+        if limit is not None and rows + batch.num_rows > limit:
+            # slicing a batch is zero-copy
+            batch = batch.slice(0, limit - rows)
+        yield batch
+        rows += batch.num_rows
+        if limit is not None and rows >= limit:
+            break
+
+    return
+
+
+def fetch_arrow_table(connection, query: str, limit: int):
+    reader = connection.execute(query).fetch_record_batch(ARROW_BATCH_SIZE)
+
+    return pa.Table.from_batches(list(limited_batches(reader, limit)), schema=reader.schema)
+
+
+def deliver_results(connection, query: str, limit: int, delivery: str, event: dict, response_format: str, compression: str):
+    """
+    Stream the results to parquet files in the bucket, and return a pointer to them. With the
+    auto delivery, we keep batches in memory until they go over the threshold: if they never
+    do, the results are returned inline as usual.
+    """
+    threshold = int(event.get('spill_threshold_bytes', DEFAULT_SPILL_THRESHOLD_BYTES))
+    location = f"{event.get('results_location', RESULTS_PREFIX).rstrip('/')}/{uuid.uuid4()}"
+    reader = connection.execute(query).fetch_record_batch(ARROW_BATCH_SIZE)
+    batches = []
+    size = 0
+    writer = None
+    if delivery == 's3':
+        writer = ResultWriter(reader.schema, location, rows_per_file=int(event.get('rows_per_file', DEFAULT_ROWS_PER_FILE)))
+    try:
+        for batch in limited_batches(reader, limit):
+            if writer is not None:
+                writer.write(batch)
+                continue
+            batches.append(batch)
+            size += batch.nbytes
+            if size > threshold:
+                # too big for the response: from now on, everything goes to the bucket
+                writer = ResultWriter(reader.schema, location, rows_per_file=int(event.get('rows_per_file', DEFAULT_ROWS_PER_FILE)))
+                for b in batches:
+                    writer.write(b)
+                batches = []
+    except Exception:
+        # the next invocations of this container would find the files in /tmp
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        return writer.close(get_s3_client())
+    _table = pa.Table.from_batches(batches, schema=reader.schema)
+    if response_format in COLUMNAR_FORMATS:
+        return convert_table_to_payload(_table, response_format, compression)
+
+    return { "records": convert_records_to_json(_table.to_pandas()) }
+
+
+def convert_table_to_payload(_table, response_format: str, compression: str = None):
+    """
+    Serialize an arrow table as an arrow IPC stream or a parquet file, and encode it
+    in base64 so that it can travel inside the json response of the lambda.
     
-    # return response to the client with metadata
-    return wrap_response(start, event_query, results, is_warm)
+    For arrow, compression is applied to the IPC buffers (lz4 or zstd), for parquet
+    it is the codec of the column chunks (snappy, zstd, gzip, ...).
+    """
+    sink = pa.BufferOutputStream()
+    if response_format == 'arrow':
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_stream(sink, _table.schema, options=options) as writer:
+            writer.write_table(_table)
+    else:
+        pq.write_table(_table, sink, compression=compression or 'snappy')
+
+    return {
+        "format": response_format,
+        "compression": compression,
+        "rows": _table.num_rows,
+        "payload": base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii')
+    }
 
 
 def convert_records_to_json(_df):
@@ -67,9 +602,10 @@ def convert_records_to_json(_df):
     return _df.to_dict('records')
 
 
-def wrap_response(start, event_query, results, is_warm):
+def wrap_response(start, event_query, data, is_warm, extra_metadata):
     """
-    Wrap the response in a format that can be used by the client
+    Wrap the response in a format that can be used by the client: data is
+    either the json records or the encoded columnar payload.
     """
     return {
         "metadata": {
@@ -77,9 +613,8 @@ def wrap_response(start, event_query, results, is_warm):
             "epochMs": int(time.time() * 1000),
             "eventId": str(uuid.uuid4()),
             "query": event_query,
-            "warm": is_warm
+            "warm": is_warm,
+            **extra_metadata
         },
-        "data": {
-            "records": results
-        }
+        "data": data
     }
@@ -0,0 +1,115 @@
+"""
+
+Approximate queries: an opt-in mode (the 'approximate' key of the event, True or a dict of
+options) trading exactness for speed, e.g. for the dashboard while the user is typing.
+
+An aggregate query (see aggregates.parse_aggregate_query) is rewritten to:
+
+* read a sample of the rows, with TABLESAMPLE: COUNT and SUM are scaled up by the sampling
+  fraction, and every aggregate comes with a confidence interval, in the {alias}_low and
+  {alias}_high columns;
+* compute COUNT DISTINCT with approx_count_distinct (HyperLogLog), and quantiles over the
+  values of the sample. Across map-reduce partitions (mergeable=True, see planner.py), they
+  use the mergeable sketches of aggregates.py instead.
+
+Only COUNT, SUM, AVG and quantiles can be estimated from a sample: with a MIN, MAX or a
+distinct count in the query, we read all the rows and only the sketches are approximate.
+
+Note that in duckdb 0.7.1 the sample is taken after the scan: we save the aggregation work,
+not the bytes read from S3, so the gain is bigger for expensive aggregates (quantiles,
+distinct counts) than for a plain COUNT. Bernoulli sampling (the default) keeps every row with
+probability f, which is what the intervals assume. System sampling keeps whole vectors of 2048
+rows: it is faster, but rows come in clumps, and its intervals are way too narrow (use it for
+the estimates only).
+
+"""
+
+
+from statistics import NormalDist
+from aggregates import parse_aggregate_query, build_map_query, build_final_query, uses_sketch, SKETCH_SIZE
+
+
+DEFAULT_SAMPLE_PERCENT = 10.0
+DEFAULT_CONFIDENCE = 0.95
+# the first one is the default
+SAMPLE_METHODS = ('bernoulli', 'system')
+# aggregates we can estimate from a sample of the rows
+SAMPLEABLE_AGGREGATES = ('COUNT', 'SUM', 'AVG', 'QUANTILE', 'APPROX_QUANTILE')
+
+
+def approximate_options(value) -> dict:
+    """
+    The options from the event (True means the defaults), validated.
+    """
+    options = value if isinstance(value, dict) else {}
+    sample_percent = float(options.get('sample_percent', DEFAULT_SAMPLE_PERCENT))
+    confidence = float(options.get('confidence', DEFAULT_CONFIDENCE))
+    method = options.get('method', SAMPLE_METHODS[0])
+    if not 0.0 < sample_percent <= 100.0:
+        raise ValueError(f"The sample percent must be in (0, 100], not {sample_percent}")
+    if not 0.0 < confidence < 1.0:
+        raise ValueError(f"The confidence must be in (0, 1), not {confidence}")
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"Unsupported sampling method {method}, use one of {SAMPLE_METHODS}")
+
+    return {
+        'sample_percent': sample_percent,
+        'confidence': confidence,
+        'method': method,
+        'seed': options.get('seed')
+    }
+
+
+def plan_approximation(parsed: dict, value, mergeable: bool = False) -> dict:
+    """
+    Set the sampling and confidence of a parsed query: this is what the map, merge and
+    combine queries read in parsed['approximate'].
+    """
+    options = approximate_options(value)
+    sampleable = all(i['aggregate'] in SAMPLEABLE_AGGREGATES for i in parsed['items'] if 'aggregate' in i)
+    fraction = options['sample_percent'] / 100.0 if sampleable else 1.0
+    parsed['approximate'] = {
+        'fraction': fraction,
+        'method': options['method'],
+        'seed': options['seed'],
+        'confidence': options['confidence'],
+        'mergeable': mergeable,
+        # two-sided interval: e.g. 1.96 for 95%
+        'z': NormalDist().inv_cdf(0.5 + options['confidence'] / 2.0)
+    }
+
+    return parsed
+
+
+def describe_approximation(parsed: dict) -> dict:
+    """
+    What was approximated, for the metadata of the response.
+    """
+    approximate = parsed['approximate']
+    aggregates = [i for i in parsed['items'] if 'aggregate' in i]
+
+    return {
+        'status': 'approximated',
+        'samplePercent': approximate['fraction'] * 100.0,
+        'method': approximate['method'],
+        'confidence': approximate['confidence'],
+        # bounds are in the {alias}_low / {alias}_high columns
+        'bounds': [i['alias'].strip('"') for i in aggregates],
+        'sketched': [i['alias'].strip('"') for i in aggregates if uses_sketch(i, approximate)],
+        **({ 'sketchSize': SKETCH_SIZE } if approximate['mergeable'] else {})
+    }
+
+
+def approximate_query(query: str, value) -> tuple:
+    """
+    Return the approximate version of the query, and the info for the metadata: queries we
+    cannot parse run as they are.
+    """
+    parsed = parse_aggregate_query(query)
+    if not parsed:
+        return query, { 'status': 'unsupported' }
+    plan_approximation(parsed, value)
+    # a map-reduce with a single partition: the map query has one row per group already
+    map_query = build_map_query(parsed, f"'{parsed['scan_path']}'")
+
+    return build_final_query(parsed, f"({map_query}) AS __sample"), describe_approximation(parsed)
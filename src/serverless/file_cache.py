@@ -0,0 +1,148 @@
+"""
+
+Cache of the parquet files the queries read, on the ephemeral storage of the lambda (/tmp,
+3008 MB in serverless.yml): a warm container asked the same partitions again (the dashboard
+view, the map tasks of a recurring map-reduce) reads them from its local disk instead of
+going back to S3 through httpfs.
+
+* entries are whole objects, kept under <cache dir>/<bucket>/<key>, so that hive partition
+  folders (date=...) survive and hive_partitioning works on the local paths;
+* an entry is valid as long as the ETag of the object is the one we downloaded: versions come
+  from the same HEAD / LIST requests (or manifest) used for the result cache key;
+* the least recently used files are deleted when the cache goes over its byte budget, and
+  files too big for the budget are left to httpfs, which only reads the columns it needs;
+* downloading is opt-in (the 'file_cache' key of the event): a whole object is far more than
+  what httpfs reads for a query on a few columns or row groups, so only queries that will read
+  most of their files again should pay for it. Any query uses the copies that are there.
+
+"""
+
+
+import os
+import time
+import shutil
+import fnmatch
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from manifest import find_glob_scans, split_s3_uri
+
+
+# concurrent downloads when a query needs more than one file
+DOWNLOAD_THREADS = 8
+DOWNLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+class FileCache:
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_file_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes or max_bytes, max_bytes)
+        self._entries = OrderedDict() # uri -> (etag, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # start from a clean folder, /tmp may survive a restart of the runtime
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def local_path(self, uri: str) -> str:
+        bucket, key = split_s3_uri(uri)
+
+        return os.path.join(self.cache_dir, bucket, *key.split('/'))
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._entries
+
+    def fetch(self, s3_client, uri: str, etag: str, size: int, pinned: set = None, download: bool = True) -> tuple:
+        """
+        Return (local path, status): 'hit' if we have this version of the object, 'miss' if we
+        just downloaded it, or (None, 'skipped') if it should be read from S3 instead (always,
+        without download). Pinned uris (the other files of the same query) are never evicted
+        to make room.
+        """
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(uri)
+                return self.local_path(uri), 'hit'
+        if not download or size > self.max_file_bytes:
+            return None, 'skipped'
+        bucket, key = split_s3_uri(uri)
+        path = self.local_path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # download next to the final path, and move it there once complete
+        partial_path = f"{path}.{threading.get_ident()}.part"
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        if response['ETag'] != etag:
+            # the object changed since we checked its version: read it from S3 this time
+            response['Body'].close()
+            return None, 'skipped'
+        with open(partial_path, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f, DOWNLOAD_CHUNK_BYTES)
+        with self._lock:
+            self._discard(uri)
+            if not self._make_room(size, pinned or set()):
+                os.remove(partial_path)
+                return None, 'skipped'
+            os.replace(partial_path, path)
+            self._entries[uri] = (etag, size)
+            self._bytes += size
+
+        return path, 'miss'
+
+    def _discard(self, uri: str):
+        entry = self._entries.pop(uri, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+            os.remove(self.local_path(uri))
+
+        return
+
+    def _make_room(self, size: int, pinned: set) -> bool:
+        # least recently used first
+        for evicted_uri in [uri for uri in self._entries if uri not in pinned]:
+            if self._bytes + size <= self.max_bytes:
+                break
+            self._discard(evicted_uri)
+
+        return self._bytes + size <= self.max_bytes
+
+    def localize(self, s3_client, query: str, versions: list, download: bool = True) -> tuple:
+        """
+        Make the objects of the query local (with download, otherwise use the copies we have),
+        and point the query to them: explicit uris are replaced with the local paths, globs in
+        parquet scans with the list of their (local) files, if we have them all. Versions are
+        (uri, etag, last modified, size) for every object the query reads. Return the new
+        query and the stats for the metadata.
+        """
+        start = time.time()
+        by_uri = { v[0]: v for v in versions }
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as executor:
+            fetched = dict(zip(
+                by_uri.keys(),
+                executor.map(lambda v: self.fetch(s3_client, v[0], v[1], v[3], pinned=set(by_uri), download=download), by_uri.values())
+            ))
+        local = { uri: path for uri, (path, _) in fetched.items() if path }
+        for call, glob in find_glob_scans(query):
+            matched = sorted(uri for uri in by_uri if fnmatch.fnmatch(uri, glob))
+            if matched and all(uri in local for uri in matched):
+                file_list = '[{}]'.format(', '.join(f"'{local[uri]}'" for uri in matched))
+                query = query.replace(call, call.replace(f"'{glob}'", file_list, 1), 1)
+        for uri, path in local.items():
+            query = query.replace(f"'{uri}'", f"'{path}'")
+        statuses = [status for _, status in fetched.values()]
+        hits = statuses.count('hit')
+        info = {
+            'hits': hits,
+            'misses': statuses.count('miss'),
+            'skipped': statuses.count('skipped'),
+            'hitRate': round(hits / len(statuses), 3) if statuses else 0.0,
+            'bytesLocal': sum(by_uri[uri][3] for uri, (_, status) in fetched.items() if status == 'hit'),
+            'bytesDownloaded': sum(by_uri[uri][3] for uri, (_, status) in fetched.items() if status == 'miss'),
+            'cachedBytes': self._bytes,
+            'timeMs': int((time.time() - start) * 1000.0)
+        }
+
+        return query, info
@@ -0,0 +1,151 @@
+"""
+
+A local filesystem stand-in for the (few) S3 client calls we make, so that the lambda code
+and the client can run on one machine, e.g. with the local executors in executors.py.
+
+Buckets are folders under a data root: s3://my-bucket/dataset/file.parquet is read from
+<data root>/my-bucket/dataset/file.parquet. ETags are derived from size and modification
+time, which is enough for cache keys and manifests to notice rewritten files.
+
+"""
+
+
+import io
+import os
+import datetime
+from botocore.exceptions import ClientError
+
+
+def localize_paths(query: str, data_root: str) -> str:
+    """
+    Point s3 uris to the local data root: this is what duckdb will actually read.
+    """
+    return query.replace('s3://', data_root.rstrip('/') + '/')
+
+
+def _client_error(code: str, operation: str, status: int):
+    return ClientError({ 'Error': { 'Code': code }, 'ResponseMetadata': { 'HTTPStatusCode': status } }, operation)
+
+
+class LocalPaginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket: str, Prefix: str = '', Delimiter: str = None):
+        root = os.path.join(self.client.data_root, Bucket)
+        self.client._record('ListObjectsV2')
+        contents, common_prefixes = [], set()
+        for folder, _, files in os.walk(root):
+            for name in files:
+                key = os.path.relpath(os.path.join(folder, name), root).replace(os.sep, '/')
+                if not key.startswith(Prefix):
+                    continue
+                rest = key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    common_prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                else:
+                    contents.append({ 'Key': key, **self.client._describe(Bucket, key) })
+        # a single page is all we need locally
+        yield {
+            'Contents': sorted(contents, key=lambda c: c['Key']),
+            'CommonPrefixes': [{ 'Prefix': p } for p in sorted(common_prefixes)]
+        }
+
+
+class LocalS3Client:
+    """
+    Implements the subset of the boto3 S3 client used by quack and the lambda.
+    """
+
+    def __init__(self, data_root: str):
+        self.data_root = data_root
+        # callables (operation, bytes read), e.g. to count requests when profiling
+        self.request_hooks = []
+
+    def _record(self, operation: str, bytes_read: int = 0):
+        for hook in self.request_hooks:
+            hook(operation, bytes_read)
+
+        return
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.data_root, bucket, *key.split('/'))
+
+    def _describe(self, bucket: str, key: str) -> dict:
+        stat = os.stat(self._path(bucket, key))
+        return {
+            'ETag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            'LastModified': datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc),
+            'Size': stat.st_size
+        }
+
+    def get_paginator(self, operation_name: str):
+        assert operation_name == 'list_objects_v2', f"{operation_name} is not supported locally"
+        return LocalPaginator(self)
+
+    def head_object(self, Bucket: str, Key: str):
+        self._record('HeadObject')
+        if not os.path.isfile(self._path(Bucket, Key)):
+            raise _client_error('404', 'HeadObject', 404)
+        description = self._describe(Bucket, Key)
+        return { 'ETag': description['ETag'], 'LastModified': description['LastModified'], 'ContentLength': description['Size'] }
+
+    def get_object(self, Bucket: str, Key: str, IfNoneMatch: str = None, Range: str = None):
+        if not os.path.isfile(self._path(Bucket, Key)):
+            self._record('GetObject')
+            raise _client_error('NoSuchKey', 'GetObject', 404)
+        description = self._describe(Bucket, Key)
+        head = { 'ETag': description['ETag'], 'LastModified': description['LastModified'] }
+        if IfNoneMatch and IfNoneMatch == head['ETag']:
+            self._record('GetObject')
+            raise _client_error('304', 'GetObject', 304)
+        with open(self._path(Bucket, Key), 'rb') as f:
+            if Range:
+                start, end = Range.replace('bytes=', '').split('-')
+                f.seek(int(start))
+                body = f.read(int(end) - int(start) + 1)
+            else:
+                body = f.read()
+        self._record('GetObject', len(body))
+
+        return { **head, 'ContentLength': len(body), 'Body': io.BytesIO(body) }
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        self._record('PutObject')
+
+        return { 'ETag': self._describe(Bucket, Key)['ETag'] }
+
+    def delete_object(self, Bucket: str, Key: str):
+        path = self._path(Bucket, Key)
+        self._record('DeleteObject')
+        # as S3, deleting a missing key is not an error
+        if os.path.isfile(path):
+            os.remove(path)
+
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: dict):
+        self._record('DeleteObjects')
+        for obj in Delete['Objects']:
+            path = self._path(Bucket, obj['Key'])
+            if os.path.isfile(path):
+                os.remove(path)
+
+        return {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+        return
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, **kwargs):
+        with open(Filename, 'wb') as f:
+            f.write(self.get_object(Bucket=Bucket, Key=Key)['Body'].read())
+
+        return
@@ -0,0 +1,450 @@
+"""
+
+Partition manifest for a hive-partitioned dataset, e.g. s3://bucket/partitioned/date=.../*.parquet.
+
+The manifest is a json file at the root of the dataset (s3://bucket/partitioned/_manifest.json)
+listing every parquet file with its partition values, size, ETag, row counts, row groups and
+the min / max of each column. With it, a glob scan can be rewritten into an explicit list of
+files, pruned by the query predicates, without reading any footer.
+
+Manifests are versioned: `formatVersion` is the version of the layout below (readers refuse
+what they don't know), `snapshotId` identifies the state of the dataset it describes, and the
+ETag of each file lets readers check the dataset has not changed since: one LIST of the scan
+catches the files added, removed or rewritten after the manifest was written.
+
+Files of a hash-bucketed layout (see ingest.py) carry their bucket in the footer metadata: it
+ends up in the manifest, and an equality predicate on the bucket column keeps only one bucket.
+
+"""
+
+
+import re
+import json
+import uuid
+import fnmatch
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from queryparse import split_clauses, extract_predicates, value_matches
+
+
+MANIFEST_FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = '_manifest.json'
+GLOB_CHARS = ('*', '?', '[')
+# glob scans we can rewrite: the first argument must be a string literal
+SCAN_CALL_PATTERN = re.compile(r"\b(parquet_scan|read_parquet)\s*\(\s*'([^']*)'", re.IGNORECASE)
+# number of concurrent footer reads when building a manifest
+VALIDATION_THREADS = 16
+# parquet key-value metadata with the bucket of a file: { column, type, buckets, bucket }
+BUCKETING_METADATA_KEY = b'quack.bucketing'
+
+
+class StaleManifestError(Exception):
+    pass
+
+
+def split_s3_uri(uri: str):
+    match = re.match(r"^s3://([^/]+)/?(.*)$", uri)
+    return match.group(1), match.group(2)
+
+
+def dataset_root(glob: str) -> str:
+    """
+    The root of a dataset is everything before the first segment with a wildcard.
+    """
+    segments = glob.split('/')
+    root = []
+    for segment in segments:
+        if any(c in segment for c in GLOB_CHARS):
+            break
+        root.append(segment)
+
+    return '/'.join(root)
+
+
+def manifest_location(root: str) -> str:
+    return f"{root.rstrip('/')}/{MANIFEST_FILE_NAME}"
+
+
+def partition_values(path: str) -> dict:
+    return dict(s.split('=', 1) for s in path.split('/')[:-1] if '=' in s)
+
+
+def to_json_value(value):
+    """
+    Statistics come in all sorts of types: keep numbers, stringify the rest (dates and
+    timestamps become ISO strings, parsed back for pruning, see range_may_match).
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return value if value == value else None # NaN
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+
+    return str(value)
+
+
+def stats_type(value):
+    """
+    The type of a column, as far as pruning is concerned, from one of its statistics:
+    temporal values are compared as such, not as the strings they are stored as.
+    """
+    if isinstance(value, datetime.datetime):
+        return 'timestamp'
+    if isinstance(value, datetime.date):
+        return 'date'
+
+    return None
+
+
+def describe_parquet_file(parquet_file) -> dict:
+    """
+    Collect rows, row groups and column statistics from the footer of a pyarrow ParquetFile.
+    """
+    metadata = parquet_file.metadata
+    stats = {}
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        for c in range(row_group.num_columns):
+            column = row_group.column(c)
+            name = column.path_in_schema
+            statistics = column.statistics
+            if statistics is None or not statistics.has_min_max:
+                # without stats for a row group, we know nothing about the file
+                stats[name] = None
+                continue
+            if name in stats and stats[name] is None:
+                continue
+            _min, _max = to_json_value(statistics.min), to_json_value(statistics.max)
+            if _min is None or _max is None:
+                stats[name] = None
+                continue
+            current = stats.get(name)
+            stats[name] = {
+                'min': _min if current is None else min(current['min'], _min),
+                'max': _max if current is None else max(current['max'], _max),
+                **({ 'type': stats_type(statistics.min) } if stats_type(statistics.min) else {})
+            }
+
+    description = {
+        'rows': metadata.num_rows,
+        'rowGroups': metadata.num_row_groups,
+        'rowGroupRows': [metadata.row_group(rg).num_rows for rg in range(metadata.num_row_groups)],
+        'stats': { k: v for k, v in stats.items() if v is not None }
+    }
+    key_value_metadata = metadata.metadata or {}
+    if BUCKETING_METADATA_KEY in key_value_metadata:
+        description['bucket'] = json.loads(key_value_metadata[BUCKETING_METADATA_KEY])
+
+    return description
+
+
+def hash_buckets(values, buckets: int):
+    """
+    Bucket of each value of a numpy array: pandas' hash is stable across processes and
+    versions (unlike python's hash), and integers hash the same whatever their width.
+    """
+    import pandas as pd
+
+    return pd.util.hash_array(values) % buckets
+
+
+def literal_bucket(literal, bucketing: dict):
+    """
+    Bucket of a predicate literal, or None if the literal does not have the type of the
+    bucket column (then we cannot tell which bucket it would be in).
+    """
+    import numpy as np
+
+    if bucketing['type'] == 'integer' and isinstance(literal, float) and literal.is_integer():
+        return int(hash_buckets(np.array([int(literal)], dtype='int64'), bucketing['buckets'])[0])
+    if bucketing['type'] == 'string' and isinstance(literal, str):
+        return int(hash_buckets(np.array([literal], dtype=object), bucketing['buckets'])[0])
+
+    return None
+
+
+def build_manifest(root: str, files: list) -> dict:
+    """
+    Files are dicts with path, size, etag and the description of the parquet footer.
+    """
+    return {
+        'formatVersion': MANIFEST_FORMAT_VERSION,
+        'snapshotId': str(uuid.uuid4()),
+        'createdAt': datetime.datetime.utcnow().isoformat(),
+        'root': root.rstrip('/'),
+        'partitionColumns': sorted({k for f in files for k in partition_values(f['path'])}),
+        'files': sorted(
+            [{ **f, 'partition': partition_values(f['path']) } for f in files],
+            key=lambda f: f['path']
+        )
+    }
+
+
+def collect_s3_files(s3_client, root: str, filesystem=None) -> list:
+    """
+    List the parquet files under the root and read their footers (only the footer is
+    fetched, through range requests) with pyarrow.
+    """
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+
+    filesystem = filesystem or pyarrow.fs.S3FileSystem()
+    bucket, prefix = split_s3_uri(root.rstrip('/') + '/')
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects += [o for o in page.get('Contents', []) if o['Key'].endswith('.parquet')]
+
+    def describe(obj):
+        with filesystem.open_input_file(f"{bucket}/{obj['Key']}") as f:
+            return {
+                'path': f"s3://{bucket}/{obj['Key']}",
+                'size': obj['Size'],
+                'etag': obj['ETag'],
+                **describe_parquet_file(pq.ParquetFile(f))
+            }
+
+    with ThreadPoolExecutor(max_workers=VALIDATION_THREADS) as executor:
+        return list(executor.map(describe, objects))
+
+
+def write_manifest(s3_client, manifest: dict):
+    bucket, key = split_s3_uri(manifest_location(manifest['root']))
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(manifest).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+    return
+
+
+def load_manifest(s3_client, root: str, cache: dict = None):
+    """
+    Return the manifest for a dataset root, or None if there is none. If a cache dict is
+    passed, it's used to store manifests with their ETag: following calls just send a
+    conditional GET, and reuse the cached manifest if it did not change.
+    """
+    from botocore.exceptions import ClientError
+
+    bucket, key = split_s3_uri(manifest_location(root))
+    cached = cache.get(root) if cache is not None else None
+    try:
+        kwargs = { 'IfNoneMatch': cached[0] } if cached else {}
+        response = s3_client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('304', 'NotModified'):
+            return cached[1]
+        if code in ('NoSuchKey', '404', 'AccessDenied'):
+            return None
+        raise
+    manifest = json.loads(response['Body'].read())
+    if manifest.get('formatVersion') != MANIFEST_FORMAT_VERSION:
+        print(f"Unsupported manifest version {manifest.get('formatVersion')} for {root}, ignoring it")
+        return None
+    if cache is not None:
+        cache[root] = (response['ETag'], manifest)
+
+    return manifest
+
+
+def match_glob(path: str, glob: str) -> bool:
+    """
+    Match a path against a glob the way duckdb does: wildcards do not cross '/'.
+    """
+    path_segments, glob_segments = path.split('/'), glob.split('/')
+    if len(path_segments) != len(glob_segments):
+        return False
+
+    return all(fnmatch.fnmatchcase(p, g) for p, g in zip(path_segments, glob_segments))
+
+
+def parse_temporal(value: str, column_type: str):
+    """
+    Parse a date / timestamp (statistics or literal) as duckdb casts it to the type of the
+    column: a datetime, or None if we can't, or if a date column would truncate it.
+    """
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    if column_type == 'date' and parsed.time() != datetime.time(0):
+        return None
+
+    return parsed
+
+
+def range_may_match(_min, _max, operator: str, literal, column_type: str = None) -> bool:
+    """
+    Can a column with values in [min, max] satisfy the predicate? When in doubt, say yes.
+
+    Dates and timestamps are stored as ISO strings, which do not compare as the values they
+    stand for ('2019-04-02' < '2019-04-02 00:00:00'): with the type of the column (or for
+    statistics that look like timestamps, in manifests written without it) both sides are
+    parsed first.
+    """
+    if isinstance(literal, float) != isinstance(_min, (int, float)):
+        return True
+    if column_type is None and not isinstance(literal, float) and ' ' in str(_min):
+        column_type = 'timestamp' if parse_temporal(_min, 'timestamp') and parse_temporal(_max, 'timestamp') else None
+    if column_type in ('date', 'timestamp'):
+        _min, _max, literal = (parse_temporal(v, column_type) for v in (_min, _max, literal))
+        if _min is None or _max is None or literal is None:
+            return True
+        if (_min.tzinfo is None) != (literal.tzinfo is None):
+            # naive vs aware: it depends on the time zone of the session
+            return True
+    elif not isinstance(literal, float):
+        _min, _max = str(_min), str(_max)
+    if operator == '=':
+        return _min <= literal <= _max
+    if operator == '>=':
+        return _max >= literal
+    if operator == '>':
+        return _max > literal
+    if operator == '<=':
+        return _min <= literal
+    if operator == '<':
+        return _min < literal
+
+    return True
+
+
+def file_may_match(entry: dict, predicates: list) -> bool:
+    partition = { k.lower(): v for k, v in entry['partition'].items() }
+    stats = { k.lower(): v for k, v in entry.get('stats', {}).items() }
+    for column, operator, literal in predicates:
+        if column in partition:
+            if not value_matches(partition[column], operator, literal):
+                return False
+        elif column in stats:
+            if not range_may_match(stats[column]['min'], stats[column]['max'], operator, literal, stats[column].get('type')):
+                return False
+        bucketing = entry.get('bucket')
+        if bucketing and operator == '=' and column == bucketing['column'].lower():
+            bucket = literal_bucket(literal, bucketing)
+            if bucket is not None and bucket != bucketing['bucket']:
+                return False
+
+    return True
+
+
+def prune_files(manifest: dict, glob: str, predicates: list) -> tuple:
+    """
+    Return the files matching the glob, and the subset of those matching the predicates.
+    """
+    matching = [f for f in manifest['files'] if match_glob(f['path'], glob)]
+
+    return matching, [f for f in matching if file_may_match(f, predicates)]
+
+
+def find_glob_scans(query: str) -> list:
+    return [
+        (m.group(0), m.group(2)) for m in SCAN_CALL_PATTERN.finditer(query)
+        if m.group(2).startswith('s3://') and any(c in m.group(2) for c in GLOB_CHARS)
+    ]
+
+
+def rewrite_scans(query: str, manifests: dict) -> tuple:
+    """
+    Replace the glob in every parquet scan having a manifest with the explicit list of files,
+    pruned by the WHERE predicates when the query is a simple one over a single scan.
+
+    Manifests is a dict root -> manifest. Return the new query, the files we are going to
+    scan and some info for the response metadata.
+    """
+    scans = find_glob_scans(query)
+    clauses = split_clauses(query.strip().rstrip(';')) if len(scans) == 1 else None
+    predicates = extract_predicates(clauses.get('WHERE')) if clauses else []
+    info = {
+        'snapshots': [],
+        'filesTotal': 0,
+        'filesScanned': 0,
+        'rowGroupsTotal': 0,
+        'rowGroupsScanned': 0,
+        'bytesTotal': 0,
+        'bytesScanned': 0
+    }
+    scanned_files = []
+    for call, glob in scans:
+        manifest = manifests.get(dataset_root(glob))
+        if not manifest:
+            continue
+        matching, files = prune_files(manifest, glob, predicates)
+        if not matching:
+            # the manifest knows nothing about this glob: leave it to duckdb
+            continue
+        if not files:
+            # everything was pruned, but duckdb does not like empty lists: one file is
+            # enough to get the right (empty) result, since the WHERE clause still applies
+            files = matching[:1]
+        file_list = '[{}]'.format(', '.join(f"'{f['path']}'" for f in files))
+        query = query.replace(call, call.replace(f"'{glob}'", file_list, 1), 1)
+        scanned_files += files
+        info['snapshots'].append(manifest['snapshotId'])
+        info['filesTotal'] += len(matching)
+        info['filesScanned'] += len(files)
+        info['rowGroupsTotal'] += sum(f['rowGroups'] for f in matching)
+        info['rowGroupsScanned'] += sum(f['rowGroups'] for f in files)
+        info['bytesTotal'] += sum(f['size'] for f in matching)
+        info['bytesScanned'] += sum(f['size'] for f in files)
+
+    return query, scanned_files, info
+
+
+def list_scan(s3_client, glob: str) -> dict:
+    """
+    The objects matching the glob, as they are in the bucket now: path -> (uri, etag, last
+    modified, size), from a LIST of the prefix before the first wildcard.
+    """
+    bucket, key = split_s3_uri(glob)
+    prefix = key[:min(key.index(c) for c in GLOB_CHARS if c in key)]
+    listed = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            uri = f"s3://{bucket}/{obj['Key']}"
+            if match_glob(uri, glob):
+                listed[uri] = (uri, obj['ETag'], str(obj['LastModified']), obj['Size'])
+
+    return listed
+
+
+def validate_scan(s3_client, manifest: dict, glob: str) -> dict:
+    """
+    Check that the objects matching the glob are the files of the manifest, with the same
+    ETags: a file added (e.g. a new partition), removed or changed after the manifest was
+    written raises StaleManifestError. Return the versions of the objects, by path.
+    """
+    listed = list_scan(s3_client, glob)
+    recorded = { f['path']: f['etag'] for f in manifest['files'] if match_glob(f['path'], glob) }
+    for label, paths in (
+        ('not in the manifest', sorted(set(listed) - set(recorded))),
+        ('in the manifest but not in the bucket', sorted(set(recorded) - set(listed))),
+        ('changed after the manifest was written', sorted(p for p in recorded if p in listed and listed[p][1] != recorded[p]))
+    ):
+        if paths:
+            more = f" (and {len(paths) - 1} more)" if len(paths) > 1 else ''
+            raise StaleManifestError(f"{paths[0]}{more} {label}")
+
+    return listed
+
+
+def validate_files(s3_client, files: list, scans: list) -> list:
+    """
+    Check that the scans we rewrote, as (glob, manifest), still match their manifest (see
+    validate_scan): raise StaleManifestError if any does not, otherwise return the versions of
+    the files we are about to scan as (uri, etag, last modified, size).
+    """
+    versions = {}
+    for glob, manifest in scans:
+        # globs the manifest knows nothing about were left to duckdb
+        if any(match_glob(f['path'], glob) for f in manifest['files']):
+            versions.update(validate_scan(s3_client, manifest, glob))
+
+    return sorted({ versions[f['path']] for f in files })
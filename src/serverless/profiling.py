@@ -0,0 +1,191 @@
+"""
+
+Opt-in profiling for the handler (pass "profile": true in the event): where did the time go?
+
+* duckdb writes its json profile (the operator tree, with timings and cardinalities) to a
+  file in /tmp, which we summarize: total time per operator type, the tree, rows scanned;
+* IOStats counts the S3 requests (and the bytes we GET) made through our S3 client, i.e.
+  manifests, HEADs for the cache key and validation, result uploads. duckdb 0.7 does not
+  expose counters for its own httpfs reads: with a manifest, the files / row groups / bytes
+  of the pruned scan are the best proxy we have;
+* the peak resident memory of the container comes from getrusage.
+
+merge_profiles sums the profiles of many tasks (e.g. the map tasks of a map-reduce query).
+
+"""
+
+
+import os
+import json
+import uuid
+import resource
+import threading
+
+
+PROFILE_DIR = '/tmp/quack-profiles'
+# operators reading data: their output cardinality is the number of rows scanned
+SCAN_OPERATORS = ('PARQUET_SCAN', 'READ_PARQUET', 'TABLE_SCAN', 'SEQ_SCAN', 'ARROW_SCAN')
+
+
+class IOStats:
+    """
+    Count the S3 requests made through a client, by operation, and the bytes read by GETs.
+    Works with boto3 clients (through botocore events) and with the LocalS3Client.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def attach(self, s3_client):
+        if hasattr(s3_client, 'meta'):
+            s3_client.meta.events.register('after-call.s3', self._after_call)
+        else:
+            s3_client.request_hooks.append(self.record)
+
+        return s3_client
+
+    def _after_call(self, http_response, parsed, model, **kwargs):
+        # HEAD responses carry a ContentLength too, but no body
+        self.record(model.name, parsed.get('ContentLength', 0) if model.name == 'GetObject' else 0)
+
+    def record(self, operation: str, bytes_read: int = 0):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_read += bytes_read or 0
+
+        return
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return { 'requests': dict(self.requests), 'bytesRead': self.bytes_read }
+
+    @staticmethod
+    def since(before: dict, after: dict) -> dict:
+        """
+        The requests made between two snapshots (the counters live as long as the container).
+        """
+        by_operation = {
+            k: v - before['requests'].get(k, 0) for k, v in after['requests'].items()
+            if v - before['requests'].get(k, 0) > 0
+        }
+
+        return {
+            'requests': sum(by_operation.values()),
+            'byOperation': by_operation,
+            'bytesRead': after['bytesRead'] - before['bytesRead']
+        }
+
+
+def start_profiling(connection) -> str:
+    """
+    Turn the json profiler on: the profile of the next query is written to the returned path.
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{uuid.uuid4()}.json")
+    connection.execute("PRAGMA enable_profiling='json';")
+    connection.execute(f"PRAGMA profiling_output='{path}';")
+
+    return path
+
+
+def stop_profiling(connection, path: str) -> dict:
+    """
+    Turn the profiler off and summarize the profile of the last query. Note that a query
+    whose results were not fully fetched is finalized (and profiled) by the next statement.
+    """
+    connection.execute("PRAGMA disable_profiling;")
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        raw = json.load(f)
+    os.remove(path)
+
+    return summarize_profile(raw)
+
+
+def operator_tree(node: dict) -> dict:
+    return {
+        'name': node['name'],
+        'timeMs': round(node['timing'] * 1000.0, 3),
+        'rows': node['cardinality'],
+        'children': [operator_tree(c) for c in node.get('children', [])]
+    }
+
+
+def operator_totals(node: dict, totals: dict) -> dict:
+    """
+    Total time (ms) and rows by operator type, over the whole tree.
+    """
+    current = totals.setdefault(node['name'], { 'timeMs': 0.0, 'rows': 0 })
+    current['timeMs'] = round(current['timeMs'] + node['timeMs'], 3)
+    current['rows'] += node['rows']
+    for child in node['children']:
+        operator_totals(child, totals)
+
+    return totals
+
+
+def summarize_profile(raw: dict) -> dict:
+    tree = [operator_tree(c) for c in raw.get('children', [])]
+    totals = {}
+    for node in tree:
+        operator_totals(node, totals)
+
+    return {
+        'totalMs': round(raw.get('timing', 0) * 1000.0, 3),
+        'operators': totals,
+        'rowsScanned': sum(v['rows'] for k, v in totals.items() if k in SCAN_OPERATORS),
+        'tree': tree
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+def merge_profiles(profiles: list) -> dict:
+    """
+    Aggregate the profiles of many tasks: times, rows and requests add up, memory is the
+    peak of the biggest task, and we keep the tree of the slowest task.
+    """
+    profiles = [p for p in profiles if p]
+    if not profiles:
+        return None
+    merged = {
+        'tasks': len(profiles),
+        'totalMs': 0.0,
+        'operators': {},
+        'rowsScanned': 0,
+        'serializeMs': 0,
+        'peakRssMb': 0.0,
+        's3': { 'requests': 0, 'byOperation': {}, 'bytesRead': 0 },
+        'pruning': None,
+        'tree': None
+    }
+    slowest = None
+    for p in profiles:
+        merged['totalMs'] = round(merged['totalMs'] + p.get('totalMs', 0), 3)
+        merged['rowsScanned'] += p.get('rowsScanned', 0)
+        merged['serializeMs'] += p.get('serializeMs', 0)
+        merged['peakRssMb'] = max(merged['peakRssMb'], p.get('peakRssMb', 0))
+        for name, v in p.get('operators', {}).items():
+            current = merged['operators'].setdefault(name, { 'timeMs': 0.0, 'rows': 0 })
+            current['timeMs'] = round(current['timeMs'] + v['timeMs'], 3)
+            current['rows'] += v['rows']
+        s3 = p.get('s3', {})
+        merged['s3']['requests'] += s3.get('requests', 0)
+        merged['s3']['bytesRead'] += s3.get('bytesRead', 0)
+        for k, v in s3.get('byOperation', {}).items():
+            merged['s3']['byOperation'][k] = merged['s3']['byOperation'].get(k, 0) + v
+        if p.get('pruning'):
+            merged['pruning'] = {
+                k: (merged['pruning'] or {}).get(k, 0) + v for k, v in p['pruning'].items()
+            }
+        if slowest is None or p.get('totalMs', 0) > slowest.get('totalMs', 0):
+            slowest = p
+    merged['tree'] = slowest.get('tree')
+
+    return merged
@@ -0,0 +1,188 @@
+"""
+
+Minimal SQL helpers shared by the client (planner.py) and the lambda: we don't ship a SQL
+parser, so we only look at the top level clauses of a query and at simple predicates
+(column, operator, literal), which is all we need to skip data we know is not relevant.
+
+"""
+
+
+import re
+
+
+# top level clauses we know how to handle, in the order they must appear
+CLAUSES = ['SELECT', 'FROM', 'WHERE', 'GROUP BY', 'ORDER BY', 'LIMIT']
+# if any of these show up at the top level, the query is not for us
+UNSUPPORTED_KEYWORDS = ['JOIN', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT', 'QUALIFY', 'WINDOW', 'OVER', 'WITH']
+# simple predicates: column <op> literal, column BETWEEN literal AND literal
+PREDICATE_PATTERN = re.compile(r"^(\w+)\s*(>=|<=|<>|!=|=|<|>)\s*('[^']*'|-?\d+(?:\.\d+)?)$", re.DOTALL)
+BETWEEN_PATTERN = re.compile(r"^(\w+)\s+BETWEEN\s+('[^']*'|-?\d+(?:\.\d+)?)\s+AND\s+('[^']*'|-?\d+(?:\.\d+)?)$", re.IGNORECASE | re.DOTALL)
+
+
+def find_top_level(sql: str, keyword: str) -> list:
+    """
+    Return the positions of a keyword in the query, skipping string literals,
+    quoted identifiers and anything inside parentheses.
+    """
+    positions = []
+    depth = 0
+    quote = None
+    pattern = re.compile(r"\b" + keyword.replace(' ', r"\s+") + r"\b", re.IGNORECASE)
+    i = 0
+    while i < len(sql):
+        c = sql[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in ("'", '"'):
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0:
+            match = pattern.match(sql, i)
+            if match and (i == 0 or not (sql[i - 1].isalnum() or sql[i - 1] == '_')):
+                positions.append(i)
+                i = match.end()
+                continue
+        i += 1
+
+    return positions
+
+
+def split_top_level(sql: str, separator: str=',') -> list:
+    """
+    Split on the separator (a char or a keyword, like AND), ignoring nested ones.
+    """
+    if separator == ',':
+        parts, depth, quote, current = [], 0, None, ''
+        for c in sql:
+            if quote:
+                quote = None if c == quote else quote
+            elif c in ("'", '"'):
+                quote = c
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == ',' and depth == 0:
+                parts.append(current.strip())
+                current = ''
+                continue
+            current += c
+        parts.append(current.strip())
+        return parts
+    positions = find_top_level(sql, separator)
+    bounds = [0] + positions + [len(sql)]
+    parts = []
+    for idx in range(len(bounds) - 1):
+        start = bounds[idx] if idx == 0 else bounds[idx] + len(separator)
+        parts.append(sql[start:bounds[idx + 1]].strip())
+
+    return parts
+
+
+def split_clauses(sql: str):
+    """
+    Split the query into its top level clauses, return None if the shape is not supported.
+    """
+    if any(find_top_level(sql, k) for k in UNSUPPORTED_KEYWORDS):
+        return None
+    found = []
+    for clause in CLAUSES:
+        positions = find_top_level(sql, clause)
+        if len(positions) > 1:
+            return None
+        if positions:
+            found.append((positions[0], clause))
+    # clauses must be in the canonical order, and the query must start with SELECT
+    if not found or found[0] != (0, 'SELECT') or [c for _, c in found] != [c for _, c in sorted(found)]:
+        return None
+    clauses = {}
+    for idx, (position, clause) in enumerate(found):
+        end = found[idx + 1][0] if idx + 1 < len(found) else len(sql)
+        body = sql[position:end]
+        # drop the keyword itself (GROUP BY may have more than one space)
+        clauses[clause] = re.sub(r"^" + clause.replace(' ', r"\s+"), '', body, flags=re.IGNORECASE).strip()
+
+    return clauses
+
+
+def parse_literal(literal: str):
+    if literal.startswith("'"):
+        return literal[1:-1]
+    return float(literal)
+
+
+def extract_predicates(where: str) -> list:
+    """
+    Extract (column, operator, value) triples from a WHERE clause made of conjunctions of simple
+    comparisons with literals: anything else (ORs, functions...) is just ignored, which is
+    safe since we only use predicates to skip data, never to filter rows ourselves.
+    """
+    if not where or find_top_level(where, 'OR'):
+        return []
+    # BETWEEN contains an AND, so we take care of it first
+    predicates = []
+    for part in split_between_aware(where):
+        part = part.strip()
+        while part.startswith('(') and part.endswith(')'):
+            part = part[1:-1].strip()
+        match = BETWEEN_PATTERN.match(part)
+        if match:
+            predicates.append((match.group(1).lower(), '>=', parse_literal(match.group(2))))
+            predicates.append((match.group(1).lower(), '<=', parse_literal(match.group(3))))
+            continue
+        match = PREDICATE_PATTERN.match(part)
+        if match:
+            predicates.append((match.group(1).lower(), match.group(2), parse_literal(match.group(3))))
+
+    return predicates
+
+
+def split_between_aware(where: str) -> list:
+    """
+    Split on the top level ANDs, except the one of each BETWEEN: a part with a BETWEEN
+    (outside literals and parentheses, whatever its operand looks like, e.g.
+    '2019-04-01 00:00:00') has its upper bound in the next part.
+    """
+    merged = []
+    is_open = False
+    for part in split_top_level(where, 'AND'):
+        if is_open:
+            merged[-1] = f"{merged[-1]} AND {part}"
+            is_open = False
+        else:
+            merged.append(part)
+            is_open = bool(find_top_level(part, 'BETWEEN'))
+
+    return merged
+
+
+def value_matches(value, operator: str, literal) -> bool:
+    """
+    Compare a partition (or statistics) value with a literal: numbers are compared as numbers,
+    everything else as strings (which works for ISO dates and timestamps).
+    """
+    if isinstance(literal, float):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return True
+    else:
+        value = str(value)
+    if operator == '=':
+        return value == literal
+    if operator in ('<>', '!='):
+        return value != literal
+    if operator == '>=':
+        return value >= literal
+    if operator == '>':
+        return value > literal
+    if operator == '<=':
+        return value <= literal
+    if operator == '<':
+        return value < literal
+
+    return True
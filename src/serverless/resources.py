@@ -0,0 +1,198 @@
+"""
+
+Resources of the duckdb connection, sized to the function the handler runs in:
+
+* threads and memory_limit come from the memory of the function (AWS_LAMBDA_FUNCTION_MEMORY_SIZE):
+  lambda gives one vCPU every 1769 MB (up to 6), and we leave a quarter of the memory to
+  python, pyarrow and the result cache;
+* temp_directory is a folder on the ephemeral storage (/tmp, 3008 MB in serverless.yml),
+  where duckdb spills what does not fit in memory_limit, instead of the container being
+  OOM-killed (and losing its warm state);
+* an event can override threads and memory_limit_mb for one query, within the limits of
+  the function.
+
+While a query runs, a ResourceMonitor samples the resident memory of the process and the size
+of the spill folder, for the metadata. Note that in duckdb 0.7 joins and sorts spill, hash
+aggregates do not: a high-cardinality GROUP BY over the limit fails with an out-of-memory
+error, and it often fits with a single thread, as every thread builds its own hash table.
+
+"""
+
+
+import os
+import shutil
+import threading
+import duckdb
+
+
+LAMBDA_MB_PER_VCPU = 1769
+MAX_THREADS = 6
+# of the memory of the function, what duckdb gets by default, and at most with an override
+DEFAULT_MEMORY_SHARE = 0.75
+MAX_MEMORY_SHARE = 0.9
+DEFAULT_SPILL_DIR = '/tmp/quack-spill'
+# how often the monitor samples memory and spill (seconds)
+SAMPLE_INTERVAL_S = 0.05
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class ResourceError(Exception):
+    """
+    The query ran out of memory (or of disk to spill to): the handler reports it as a
+    structured error, with the resources it had, instead of crashing.
+    """
+
+    def __init__(self, message: str, kind: str, resources: dict):
+        super().__init__(message)
+        self.kind = kind
+        self.resources = resources
+
+
+def runtime_resources() -> dict:
+    """
+    The default resources of the connection: explicit QUACK_THREADS / QUACK_MEMORY_LIMIT_MB /
+    QUACK_SPILL_DIR settings win (e.g. from the local executors, to mimic the lambda on a
+    bigger machine).
+    """
+    memory_mb = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0))
+    threads = os.environ.get('QUACK_THREADS')
+    memory_limit_mb = os.environ.get('QUACK_MEMORY_LIMIT_MB')
+    if not threads and memory_mb:
+        threads = min(MAX_THREADS, max(1, -(-memory_mb // LAMBDA_MB_PER_VCPU)))
+    if not memory_limit_mb and memory_mb:
+        memory_limit_mb = int(memory_mb * DEFAULT_MEMORY_SHARE)
+
+    return {
+        'functionMemoryMb': memory_mb or None,
+        'threads': int(threads) if threads else None,
+        'memoryLimitMb': int(memory_limit_mb) if memory_limit_mb else None,
+        'tempDirectory': os.environ.get('QUACK_SPILL_DIR', DEFAULT_SPILL_DIR)
+    }
+
+
+def query_resources(defaults: dict, event: dict) -> dict:
+    """
+    The resources for the query of the event: the defaults, with the threads and
+    memory_limit_mb of the event if any.
+    """
+    resources = dict(defaults)
+    if event.get('threads') is not None:
+        threads = int(event['threads'])
+        if not 1 <= threads <= 2 * MAX_THREADS:
+            raise ValueError(f"Threads must be between 1 and {2 * MAX_THREADS}, not {threads}")
+        resources['threads'] = threads
+    if event.get('memory_limit_mb') is not None:
+        memory_limit_mb = int(event['memory_limit_mb'])
+        ceiling = int(defaults['functionMemoryMb'] * MAX_MEMORY_SHARE) if defaults['functionMemoryMb'] else None
+        if memory_limit_mb < 1 or (ceiling and memory_limit_mb > ceiling):
+            raise ValueError(f"The memory limit must be between 1 and {ceiling} MB, not {memory_limit_mb}")
+        resources['memoryLimitMb'] = memory_limit_mb
+
+    return resources
+
+
+def apply_resources(duckdb_connection, resources: dict, current: dict = None):
+    """
+    Set the resources on the connection, skipping the settings that did not change. A setting
+    without a value (e.g. no function memory to size it from) goes back to the duckdb default,
+    if an override of the previous query changed it.
+    """
+    current = current or {}
+    if resources['threads'] and resources['threads'] != current.get('threads'):
+        duckdb_connection.execute(f"SET threads={resources['threads']};")
+    elif not resources['threads'] and current.get('threads'):
+        duckdb_connection.execute("RESET threads;")
+    if resources['memoryLimitMb'] and resources['memoryLimitMb'] != current.get('memoryLimitMb'):
+        duckdb_connection.execute(f"SET memory_limit='{resources['memoryLimitMb']}MB';")
+    elif not resources['memoryLimitMb'] and current.get('memoryLimitMb'):
+        duckdb_connection.execute("RESET memory_limit;")
+    if resources['tempDirectory'] != current.get('tempDirectory'):
+        os.makedirs(resources['tempDirectory'], exist_ok=True)
+        duckdb_connection.execute(f"SET temp_directory='{resources['tempDirectory']}';")
+
+    return
+
+
+def resource_error(error: Exception, resources: dict):
+    """
+    Return a ResourceError if the duckdb error is about memory or spill space, None otherwise.
+    """
+    if isinstance(error, duckdb.OutOfMemoryException):
+        return ResourceError(str(error), 'OutOfMemory', resources)
+    if isinstance(error, duckdb.IOException) and 'No space left on device' in str(error):
+        return ResourceError(str(error), 'OutOfDisk', resources)
+
+    return None
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # no procfs (e.g. macOS): we won't know the peak of this query
+        return 0
+
+
+def folder_bytes(path: str) -> int:
+    try:
+        return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+    except OSError:
+        # the folder (or a file) is gone: duckdb removes spill files as it goes
+        return 0
+
+
+class ResourceMonitor:
+    """
+    Sample the resident memory of the process and the bytes in the spill folder, in a
+    thread, between start and stop.
+    """
+
+    def __init__(self, spill_dir: str, interval: float = SAMPLE_INTERVAL_S):
+        self.spill_dir = spill_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_spill = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.report = None
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, rss_bytes())
+        self.peak_spill = max(self.peak_spill, folder_bytes(self.spill_dir))
+
+        return
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+        return
+
+    def stop(self, resources: dict) -> dict:
+        """
+        Stop sampling (once), and return the resources of the query with what it used.
+        """
+        if self.report is None:
+            self._stop.set()
+            if self._thread:
+                self._thread.join()
+            self._sample()
+            free_bytes = shutil.disk_usage(self.spill_dir).free if os.path.isdir(self.spill_dir) else None
+            self.report = {
+                'threads': resources['threads'],
+                'memoryLimitMb': resources['memoryLimitMb'],
+                'peakMemoryMb': round(self.peak_rss / (1024.0 * 1024.0), 1),
+                # duckdb deletes its spill files when the query ends: this is the peak we saw
+                'spilledBytes': self.peak_spill,
+                'tmpFreeMb': int(free_bytes / (1024 * 1024)) if free_bytes is not None else None
+            }
+
+        return self.report
@@ -0,0 +1,168 @@
+"""
+
+Result cache for warm lambda containers: results are kept in memory and, when the memory
+budget is exceeded, spilled to the ephemeral storage in /tmp.
+
+Keys combine the normalized SQL, the parameters shaping the response (limit, format...)
+and the version (ETag + last modified) of every S3 object the query touches, so that
+when an object is rewritten (e.g. dbt re-materializing my_view.parquet) the old entries
+are simply never hit again and age out of the LRU.
+
+"""
+
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import fnmatch
+from collections import OrderedDict
+
+
+# s3 uris inside the query, e.g. read_parquet(['s3://bucket/dataset/file.parquet'])
+S3_URI_PATTERN = re.compile(r"s3://([^/'\"\s]+)/([^'\"\s\]\)]+)")
+GLOB_CHARS = ('*', '?', '[')
+# queries using these functions are not deterministic, so we never cache them
+VOLATILE_FUNCTIONS = ('random(', 'now(', 'current_timestamp', 'current_date', 'uuid(', 'gen_random_uuid(')
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Collapse whitespaces and trailing semicolons, so that the same query formatted
+    differently (e.g. an f-string with a different indentation) maps to the same key.
+    """
+    return ' '.join(query.split()).rstrip(';').strip()
+
+
+def is_cacheable(query: str) -> bool:
+    lowered = query.lower()
+    return not any(f in lowered for f in VOLATILE_FUNCTIONS)
+
+
+def extract_s3_uris(query: str) -> list:
+    """
+    Return the (bucket, key) pairs of all the s3 uris in the query: keys may contain globs.
+    """
+    return sorted(set(S3_URI_PATTERN.findall(query)))
+
+
+def get_object_versions(s3_client, query: str, skip: set = None) -> list:
+    """
+    Return (uri, etag, last modified, size) for all the objects the query touches.
+
+    Plain keys are resolved with a HEAD request, globbed keys by listing the prefix
+    before the first wildcard and matching the keys against the pattern. Uris in skip
+    are the ones we already know the version of.
+    """
+    versions = []
+    for bucket, key in extract_s3_uris(query):
+        if skip and f"s3://{bucket}/{key}" in skip:
+            continue
+        if not any(c in key for c in GLOB_CHARS):
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+            versions.append((f"s3://{bucket}/{key}", head['ETag'], str(head['LastModified']), head['ContentLength']))
+            continue
+        prefix = key[:min(key.index(c) for c in GLOB_CHARS if c in key)]
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if fnmatch.fnmatch(obj['Key'], key):
+                    versions.append((f"s3://{bucket}/{obj['Key']}", obj['ETag'], str(obj['LastModified']), obj['Size']))
+
+    return sorted(versions)
+
+
+def build_cache_key(query: str, versions: list, **params) -> str:
+    key_parts = {
+        'q': normalize_sql(query),
+        'params': params,
+        # sizes do not add anything to the identity of an object, etags do
+        'versions': [v[:3] for v in versions]
+    }
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Two tier LRU cache for serialized results: values are bytes, budgets are in bytes.
+
+    Entries evicted from memory are written to the spill folder, entries evicted from
+    disk are gone for good. A disk hit moves the entry back to memory.
+    """
+
+    def __init__(self, max_memory_bytes: int, max_disk_bytes: int, spill_dir: str):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_dir = spill_dir
+        self._memory = OrderedDict() # key -> bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict() # key -> size in bytes
+        self._disk_bytes = 0
+        # start from a clean folder, /tmp may survive a restart of the runtime
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def get(self, key: str):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if key in self._disk:
+            size = self._disk.pop(key)
+            self._disk_bytes -= size
+            path = os.path.join(self.spill_dir, key)
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.remove(path)
+            # promote back to memory, this may spill something else
+            self.put(key, value)
+            return value
+
+        return None
+
+    def put(self, key: str, value: bytes):
+        # replacing an entry, make sure the old value is not counted twice
+        self._discard(key)
+        if len(value) > self.max_memory_bytes:
+            # too big for memory, go straight to disk
+            self._spill(key, value)
+            return
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_memory_bytes:
+            evicted_key, evicted_value = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted_value)
+            self._spill(evicted_key, evicted_value)
+
+        return
+
+    def _discard(self, key: str):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)
+            os.remove(os.path.join(self.spill_dir, key))
+
+        return
+
+    def _spill(self, key: str, value: bytes):
+        if len(value) > self.max_disk_bytes:
+            return
+        with open(os.path.join(self.spill_dir, key), 'wb') as f:
+            f.write(value)
+        self._disk[key] = len(value)
+        self._disk_bytes += len(value)
+        while self._disk_bytes > self.max_disk_bytes:
+            evicted_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            os.remove(os.path.join(self.spill_dir, evicted_key))
+
+        return
+
+    def stats(self) -> dict:
+        return {
+            'memoryEntries': len(self._memory),
+            'memoryBytes': self._memory_bytes,
+            'diskEntries': len(self._disk),
+            'diskBytes': self._disk_bytes
+        }
@@ -0,0 +1,103 @@
+"""
+
+Deliver results too big for the lambda response (6 MB, and json + base64 make it worse) as
+compressed parquet files in the bucket: the response then only carries a pointer to the
+files, the row count and the schema, and the client reads (or pages through) the files.
+
+"""
+
+
+import os
+import uuid
+import shutil
+import pyarrow.parquet as pq
+from manifest import split_s3_uri
+
+
+DEFAULT_ROWS_PER_FILE = 1000000
+RESULTS_TMP_DIR = '/tmp/quack-delivery'
+
+
+class ResultWriter:
+    """
+    Write arrow batches to parquet files of at most rows_per_file rows (in /tmp), then
+    upload them under the results location. Batches are written as they come, so we never
+    hold the full result in memory.
+
+    /tmp survives between warm invocations: the local files are removed once uploaded, and
+    by abort() when the query fails halfway.
+    """
+
+    def __init__(self, schema, location: str, rows_per_file: int = DEFAULT_ROWS_PER_FILE, compression: str = 'zstd'):
+        self.schema = schema
+        self.location = location.rstrip('/')
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.local_dir = os.path.join(RESULTS_TMP_DIR, str(uuid.uuid4()))
+        os.makedirs(self.local_dir, exist_ok=True)
+        self.files = [] # local path, rows
+        self._writer = None
+        self._rows_in_file = 0
+
+    def write(self, batch):
+        offset = 0
+        while offset < batch.num_rows:
+            if self._writer is None:
+                path = os.path.join(self.local_dir, f"part-{len(self.files):05d}.parquet")
+                self._writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+                self.files.append([path, 0])
+                self._rows_in_file = 0
+            chunk = batch.slice(offset, self.rows_per_file - self._rows_in_file)
+            self._writer.write_batch(chunk)
+            self._rows_in_file += chunk.num_rows
+            self.files[-1][1] += chunk.num_rows
+            offset += chunk.num_rows
+            if self._rows_in_file >= self.rows_per_file:
+                self._writer.close()
+                self._writer = None
+
+        return
+
+    def close(self, s3_client) -> dict:
+        """
+        Upload the files and return the pointer for the response.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        if not self.files:
+            # no rows at all: still write an empty file, so that the client knows the schema
+            path = os.path.join(self.local_dir, "part-00000.parquet")
+            pq.write_table(self.schema.empty_table(), path, compression=self.compression)
+            self.files.append([path, 0])
+        bucket, prefix = split_s3_uri(self.location)
+        uploaded = []
+        try:
+            for path, rows in self.files:
+                key = f"{prefix}/{os.path.basename(path)}"
+                size = os.path.getsize(path)
+                s3_client.upload_file(path, bucket, key)
+                uploaded.append({ 'path': f"s3://{bucket}/{key}", 'rows': rows, 'size': size })
+        finally:
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+
+        return {
+            'format': 'parquet-files',
+            'location': self.location,
+            'files': uploaded,
+            'rows': sum(f['rows'] for f in uploaded),
+            'schema': [{ 'name': f.name, 'type': str(f.type) } for f in self.schema]
+        }
+
+    def abort(self):
+        """
+        Drop the local files of a query that failed before close().
+        """
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+        return
@@ -0,0 +1,113 @@
+"""
+
+Parameterized query templates: the event carries the template (SQL with $1, $2... placeholders,
+as in duckdb prepared statements) and / or its id, plus the parameters, e.g.
+
+    {
+        "template_id": "top_locations",
+        "template": "SELECT ... FROM read_parquet([...]) LIMIT $1",
+        "params": [5]
+    }
+
+The warm connection keeps one prepared statement per template, so later calls skip parsing
+and planning, and only bind the parameters. Parameters are never pasted into the SQL: each
+one is rendered as a literal of its type (inferred from json, or given as {"value", "type"}),
+so a "5; DROP TABLE ..." top k is just an invalid integer.
+
+"""
+
+
+import re
+import math
+import hashlib
+
+
+PARAM_TYPES = ('BOOLEAN', 'INTEGER', 'BIGINT', 'DOUBLE', 'VARCHAR', 'DATE', 'TIMESTAMP')
+# statement names are derived from the template id: keep them valid identifiers
+STATEMENT_NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def template_id_for(template: str) -> str:
+    return hashlib.sha256(' '.join(template.split()).encode('utf-8')).hexdigest()[:16]
+
+
+def statement_name(template_id: str) -> str:
+    return f"quack_{STATEMENT_NAME_PATTERN.sub('_', template_id)}"
+
+
+def render_literal(param) -> str:
+    """
+    Render a parameter as a SQL literal of its type, or raise ValueError.
+    """
+    value, param_type = (param.get('value'), param.get('type')) if isinstance(param, dict) else (param, None)
+    if param_type is None:
+        # infer the type from the json value
+        if isinstance(value, bool):
+            param_type = 'BOOLEAN'
+        elif isinstance(value, int):
+            param_type = 'BIGINT'
+        elif isinstance(value, float):
+            param_type = 'DOUBLE'
+        elif isinstance(value, str):
+            param_type = 'VARCHAR'
+        elif value is not None:
+            raise ValueError(f"Unsupported parameter {value!r}")
+    param_type = (param_type or 'VARCHAR').upper()
+    if param_type not in PARAM_TYPES:
+        raise ValueError(f"Unsupported parameter type {param_type}, use one of {PARAM_TYPES}")
+    if value is None:
+        return f"CAST(NULL AS {param_type})"
+    if param_type == 'BOOLEAN':
+        if not isinstance(value, bool):
+            raise ValueError(f"Invalid BOOLEAN parameter {value!r}")
+        return 'TRUE' if value else 'FALSE'
+    if param_type in ('INTEGER', 'BIGINT'):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"Invalid {param_type} parameter {value!r}")
+        return f"CAST({int(value)} AS {param_type})"
+    if param_type == 'DOUBLE':
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"Invalid DOUBLE parameter {value!r}")
+        return f"CAST({float(value)!r} AS DOUBLE)"
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid {param_type} parameter {value!r}")
+    # strings: quotes are doubled, and that's all there is to escape in a SQL string literal
+    escaped = value.replace("'", "''")
+
+    return f"CAST('{escaped}' AS {param_type})"
+
+
+class TemplateRegistry:
+    """
+    The templates prepared on a connection: id -> (statement name, template).
+    """
+
+    def __init__(self):
+        self.templates = {}
+
+    def reset(self):
+        # prepared statements belong to a connection: a new connection starts empty
+        self.templates = {}
+
+        return
+
+    def execute_query(self, connection, template_id: str, template: str, params: list, prepare_sql=None) -> tuple:
+        """
+        Prepare the template if this connection has not seen it (or if it changed), and return
+        the EXECUTE statement for the parameters, the template text and whether it was prepared
+        now. prepare_sql can rewrite the template before preparing it (e.g. local paths).
+        """
+        if template is None and template_id not in self.templates:
+            raise ValueError(f"Unknown template {template_id}, send its text along with the id")
+        template_id = template_id or template_id_for(template)
+        known = self.templates.get(template_id)
+        is_new = known is None or (template is not None and known[1] != template)
+        if is_new:
+            name = statement_name(template_id)
+            sql = template.strip().rstrip(';')
+            connection.execute(f"PREPARE {name} AS {prepare_sql(sql) if prepare_sql else sql}")
+            self.templates[template_id] = (name, template)
+        name, template = self.templates[template_id]
+        literals = ', '.join(render_literal(p) for p in params or [])
+
+        return (f"EXECUTE {name}({literals})" if literals else f"EXECUTE {name}"), template, is_new